@@ -1,13 +1,22 @@
 #!/usr/bin/env python
+import os
+import sys
+import threading
 import rospy
 import numpy as np
-from geometry_msgs.msg import PoseStamped
+from geometry_msgs.msg import PoseStamped, Point, Quaternion
 from apriltag_ros.msg import AprilTagDetectionArray
 import tf2_geometry_msgs
 import tf2_ros
 import tf
 from baseline_navi.srv import Stage_Totag, Stage_TotagResponse
-import math
+from goal_filter import GOAL_TAG_ID, ODOM_FRAME, TagDetection, \
+    TagGoalTracker
+from stage_stats import start_stage_stats
+sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
+from grasp_samplers.tracing import span
+
+GOAL_MAX_AGE = 1.0
 
 
 class ApriltagsToGoalPoint(object):
@@ -18,19 +27,25 @@ class ApriltagsToGoalPoint(object):
         self.tf_buffer = tf2_ros.Buffer(rospy.Duration(1200.0)) #tf buffer length
         self.tf_listener = tf2_ros.TransformListener(self.tf_buffer)
         self.tf_broadcast = tf.TransformBroadcaster()
-        self.stage = False
-        self.adjust_counter = 0
-        self.last_msg = 0
-        self.rate = rospy.Rate(5)
+        # Goal estimate in the odom frame, updated on every detection
+        self.tracker = TagGoalTracker(self._lookup_odom, GOAL_TAG_ID)
+        self.estimator = self.tracker.estimator
+        self.goal_cond = threading.Condition()
         self.goal = PoseStamped()
+        self.goal.header.frame_id = ODOM_FRAME
         # Setup the publisher and subscriber
         self.sub_tag = rospy.Subscriber("tag_detections", AprilTagDetectionArray, self.tagCallback)
         self.motion_stage_srv = rospy.Service('baseline_navi/stage_totag', Stage_Totag, self.totag_stage_service_cb)
 
     def totag_stage_service_cb(self, totag_request):
-        self.stage = True
-        while self.stage:
-            self.rate.sleep()
+        with span('stage_totag'), self.goal_cond:
+            # Wait for the next detection only if the estimate is stale
+            if not self.estimator.is_fresh(rospy.get_time(), GOAL_MAX_AGE):
+                version = self.estimator.version
+                while self.estimator.version == version and not rospy.is_shutdown():
+                    self.goal_cond.wait(1.0)
+            self.set_goal(Point(*self.estimator.position),
+                          Quaternion(*self.estimator.orientation), 1)
         return Stage_TotagResponse(
             self.goal.pose.position.x, self.goal.pose.position.y, self.goal.pose.position.z,
             self.goal.pose.orientation.x, self.goal.pose.orientation.y, self.goal.pose.orientation.z,
@@ -45,41 +60,62 @@ class ApriltagsToGoalPoint(object):
         self.goal.pose.orientation.z = rotation.z
         self.goal.pose.orientation.w = rotation.w
 
+    def _lookup_odom(self, frame, stamp):
+        # Never blocks: the transform at the detection time if the buffer
+        # already has it, else the latest one
+        for lookup_time in [rospy.Time.from_sec(stamp), rospy.Time(0)]:
+            try:
+                transform = self.tf_buffer.lookup_transform(ODOM_FRAME, frame, lookup_time)
+            except (tf2_ros.LookupException, tf2_ros.ConnectivityException,
+                    tf2_ros.ExtrapolationException):
+                continue
+            t = transform.transform.translation
+            r = transform.transform.rotation
+            return np.array([t.x, t.y, t.z]), np.array([r.x, r.y, r.z, r.w])
+        return None
+
     def tagCallback(self, msg_tags):
-        if self.stage:
-            self.msg_tags = msg_tags
-            self.msg_received = True
-        # added goal point pub code
-            for tag in self.msg_tags.detections:
-                if tag.id[0] == 1:
-                    self.tf_broadcast.sendTransform((0.0, -0.0, 0.5),
-                                      np.array([-0.5, 0.5, 0.5, 0.5]),
-                                      rospy.Time.now(),
-                                      'goal',
-                                      'tag_1')
+        with span('tag_callback'):
+            self._update_goal(msg_tags)
 
-                    transform_goal = self.tf_buffer.lookup_transform(
-                        'odom',
-                        'goal',  # source frame
-                        rospy.Time(0),  # get the tf at first available time
-                        rospy.Duration(1.0))
+    def _update_goal(self, msg_tags):
+        self.msg_tags = msg_tags
+        self.msg_received = True
+        with self.goal_cond:
+            goals = self.tracker.update(tag_detections(msg_tags))
+            if goals:
+                self.goal_cond.notify_all()
+        for stamp, position, orientation in goals:
+            self.tf_broadcast.sendTransform(position, orientation,
+                                            rospy.Time.from_sec(stamp),
+                                            'goal',
+                                            ODOM_FRAME)
 
-                    if self.last_msg == 0:
-                        self.last_msg = transform_goal.transform.translation.x
 
-                    # For debug
-                    # print("adjust_counter: {}, goal: [{}, {}, {}]".format(self.adjust_counter, transform_goal.transform.translation.x, transform_goal.transform.translation.y, y))
+def tag_detections(msg_tags):
+    """
+    Converts an apriltag_ros/AprilTagDetectionArray message.
 
-                    if math.sqrt((self.last_msg - transform_goal.transform.translation.x)**2) > 0.15:
-                        print("Tag frame bias too much, skip detection.")
-                        continue
+    :param msg_tags: Tag detections
+    :type msg_tags: AprilTagDetectionArray
 
-                    self.last_msg = transform_goal.transform.translation.x
-                    self.set_goal(transform_goal.transform.translation, transform_goal.transform.rotation, 1)
-                    self.stage = False
+    :returns: The detections of single tags
+    :rtype: list
+    """
+    detections = []
+    for tag in msg_tags.detections:
+        pose = tag.pose.pose.pose
+        detections.append(TagDetection(
+            tag.id[0], tag.pose.header.frame_id or msg_tags.header.frame_id,
+            tag.pose.header.stamp.to_sec(),
+            [pose.position.x, pose.position.y, pose.position.z],
+            [pose.orientation.x, pose.orientation.y, pose.orientation.z,
+             pose.orientation.w]))
+    return detections
 
 
 if __name__ == '__main__':
     rospy.init_node('tagDetections_to_goalpoint_node', anonymous=False)
     apriltags_to_goal_point = ApriltagsToGoalPoint()
+    start_stage_stats('apriltags_to_goalpoint')
     rospy.spin()
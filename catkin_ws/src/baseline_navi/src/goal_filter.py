@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Filtered estimate of the tag goal pose for ApriltagsToGoalPoint.
+
+Poses are (position, quaternion) pairs of numpy arrays, quaternions in
+(x, y, z, w) order like tf. Nothing in here imports ROS.
+"""
+
+import numpy as np
+
+GATE_DISTANCE = 0.15
+SMOOTHING = 0.5
+MAX_REJECTIONS = 5
+GOAL_TAG_ID = 1
+ODOM_FRAME = 'odom'
+# Pose of the goal in the tag frame
+GOAL_OFFSET = (np.array([0.0, -0.0, 0.5]), np.array([-0.5, 0.5, 0.5, 0.5]))
+
+
+def quaternion_multiply(q1, q2):
+    x1, y1, z1, w1 = q1
+    x2, y2, z2, w2 = q2
+    return np.array([w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+                     w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2])
+
+
+def quaternion_rotate(q, v):
+    q = np.asarray(q, dtype=np.float64)
+    u = q[:3]
+    v = np.asarray(v, dtype=np.float64)
+    return v + 2. * np.cross(u, np.cross(u, v) + q[3] * v)
+
+
+def compose(p1, q1, p2, q2):
+    """
+    Composes two poses, the second one being expressed in the frame of the
+    first one.
+
+    :returns: Composed position and quaternion
+    :rtype: tuple
+    """
+    return (np.asarray(p1) + quaternion_rotate(q1, p2),
+            quaternion_multiply(q1, q2))
+
+
+class GoalEstimator(object):
+    """
+    This class smooths goal poses and rejects detections that jump.
+    """
+
+    def __init__(self, gate=GATE_DISTANCE, smoothing=SMOOTHING,
+                 max_rejections=MAX_REJECTIONS):
+        """
+        The constructor for :class:`GoalEstimator` class.
+
+        :param gate: Detections further than this many meters from the
+                     estimate are rejected
+        :param smoothing: Weight of a new detection in the estimate
+        :param max_rejections: Number of consecutive rejections after which
+                               the estimate restarts from the next detection,
+                               in case the goal did move
+        :type gate: float
+        :type smoothing: float
+        :type max_rejections: int
+        """
+        self.gate = gate
+        self.smoothing = smoothing
+        self.max_rejections = max_rejections
+        self.position = None
+        self.orientation = None
+        self.stamp = None
+        self.version = 0
+        self.rejections = 0
+
+    def update(self, stamp, position, orientation):
+        """
+        Adds a goal detection.
+
+        :param stamp: Time of the detection
+        :param position: Goal position
+        :param orientation: Goal quaternion
+        :type stamp: float
+        :type position: np.ndarray
+        :type orientation: np.ndarray
+
+        :returns: Whether the detection was accepted
+        :rtype: bool
+        """
+        position = np.asarray(position, dtype=np.float64)
+        orientation = np.asarray(orientation, dtype=np.float64)
+        if self.position is None or self.rejections >= self.max_rejections:
+            self.position = position
+            self.orientation = orientation / np.linalg.norm(orientation)
+        else:
+            if np.linalg.norm(position - self.position) > self.gate:
+                self.rejections += 1
+                return False
+            a = self.smoothing
+            self.position = (1. - a) * self.position + a * position
+            # q and -q are the same rotation
+            if np.dot(orientation, self.orientation) < 0.:
+                orientation = -orientation
+            q = (1. - a) * self.orientation + a * orientation
+            self.orientation = q / np.linalg.norm(q)
+        self.rejections = 0
+        self.stamp = stamp
+        self.version += 1
+        return True
+
+    def is_fresh(self, now, max_age):
+        """
+        :returns: Whether an estimate exists and was updated at most
+                  `max_age` seconds before `now`
+        :rtype: bool
+        """
+        return self.stamp is not None and now - self.stamp <= max_age
+
+
+class TagDetection(object):
+    """
+    This class holds one tag detection, without its ROS message.
+    """
+
+    def __init__(self, tag_id, frame, stamp, position, orientation):
+        """
+        The constructor for :class:`TagDetection` class.
+
+        :param tag_id: Id of the tag
+        :param frame: Camera frame the pose is expressed in
+        :param stamp: Time of the detection in seconds
+        :param position: Tag position
+        :param orientation: Tag quaternion
+        :type tag_id: int
+        :type frame: string
+        :type stamp: float
+        :type position: np.ndarray
+        :type orientation: np.ndarray
+        """
+        self.tag_id = tag_id
+        self.frame = frame
+        self.stamp = stamp
+        self.position = np.asarray(position, dtype=np.float64)
+        self.orientation = np.asarray(orientation, dtype=np.float64)
+
+
+class TagGoalTracker(object):
+    """
+    This class turns detections of the goal tag into a filtered goal pose in
+    the odom frame.
+    """
+
+    def __init__(self, lookup_odom, tag_id=GOAL_TAG_ID, offset=GOAL_OFFSET,
+                 estimator=None):
+        """
+        The constructor for :class:`TagGoalTracker` class.
+
+        :param lookup_odom: Returns the (position, quaternion) of a camera
+                            frame in the odom frame at a time, or None if it
+                            is unknown, called as lookup_odom(frame, stamp)
+        :param tag_id: Id of the goal tag
+        :param offset: Pose of the goal in the tag frame
+        :param estimator: Filter of the goal poses
+        :type lookup_odom: function
+        :type tag_id: int
+        :type offset: tuple
+        :type estimator: GoalEstimator
+        """
+        self.lookup_odom = lookup_odom
+        self.tag_id = tag_id
+        self.offset = offset
+        self.estimator = estimator
+        if estimator is None:
+            self.estimator = GoalEstimator()
+
+    def update(self, detections):
+        """
+        Adds the detections of one camera frame.
+
+        :param detections: Tag detections
+        :type detections: list
+
+        :returns: (stamp, position, orientation) of the filtered goal after
+                  every accepted detection of the goal tag
+        :rtype: list
+        """
+        goals = []
+        for detection in detections:
+            if detection.tag_id != self.tag_id:
+                continue
+            odom_camera = self.lookup_odom(detection.frame, detection.stamp)
+            if odom_camera is None:
+                continue
+            camera_goal = compose(detection.position, detection.orientation,
+                                  *self.offset)
+            position, orientation = compose(odom_camera[0], odom_camera[1],
+                                            *camera_goal)
+            if not self.estimator.update(detection.stamp, position,
+                                         orientation):
+                print("Tag frame bias too much, skip detection.")
+                continue
+            goals.append((detection.stamp, self.estimator.position,
+                          self.estimator.orientation))
+        return goals
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Cache of grasp predictions keyed on a cheap perceptual signature of the
+scene, for the grasp node.
+
+A scene is summarized by a small grayscale image and a small depth image.
+Two scenes match when few of their signature pixels changed by more than a
+threshold, so a grasp predicted on a table that did not change (e.g. after a
+failed grasp) can be reused or re-scored instead of sampled again.
+
+Nothing in here imports ROS.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+CACHE_SIZE = 8
+# (width, height) of the signature images
+SIGNATURE_SIZE = (40, 30)
+# Per-pixel changes of the signature that count as a scene change
+RGB_CHANGE = 12.
+DEPTH_CHANGE = 0.02
+# Fraction of changed pixels above which two scenes are different
+MAX_CHANGED_FRACTION = 0.02
+RGB_QUANTUM = 32.
+DEPTH_QUANTUM = 0.1
+
+
+class SceneSignature(object):
+    """
+    This class summarizes a cropped RGB-D frame for change detection.
+    """
+
+    def __init__(self, rgb, depth, size=SIGNATURE_SIZE):
+        """
+        The constructor for :class:`SceneSignature` class.
+
+        :param rgb: RGB image
+        :param depth: Depth image in meters aligned with `rgb`
+        :param size: (width, height) of the signature images
+        :type rgb: np.ndarray
+        :type depth: np.ndarray
+        :type size: tuple
+        """
+        self.shape = rgb.shape[:2]
+        gray = cv2.cvtColor(np.ascontiguousarray(rgb), cv2.COLOR_RGB2GRAY)
+        self.gray = cv2.resize(gray.astype(np.float32), size,
+                               interpolation=cv2.INTER_AREA)
+        # NaNs and missing depths compare as 0
+        depth = np.nan_to_num(depth.astype(np.float32))
+        self.depth = cv2.resize(depth, size, interpolation=cv2.INTER_AREA)
+        # Coarse hash, equal for most unchanged scenes
+        self.key = hashlib.md5(
+            np.floor(self.gray / RGB_QUANTUM).astype(np.uint8).tobytes() +
+            np.floor(self.depth / DEPTH_QUANTUM).astype(np.int32).tobytes()
+        ).hexdigest()
+
+    def changed_fraction(self, other, rgb_change=RGB_CHANGE,
+                         depth_change=DEPTH_CHANGE):
+        """
+        :returns: Fraction of the signature pixels that changed between two
+                  scenes, 1 if they were cropped differently
+        :rtype: float
+        """
+        if self.shape != other.shape or \
+                self.gray.shape != other.gray.shape:
+            return 1.
+        changed = ((np.abs(self.gray - other.gray) > rgb_change) |
+                   (np.abs(self.depth - other.depth) > depth_change))
+        return float(changed.mean())
+
+
+class GraspCache(object):
+    """
+    This class keeps the grasps predicted on the last few scenes, evicting
+    the least recently used one.
+    """
+
+    def __init__(self, capacity=CACHE_SIZE,
+                 max_changed_fraction=MAX_CHANGED_FRACTION):
+        """
+        The constructor for :class:`GraspCache` class.
+
+        :param capacity: Number of scenes kept
+        :param max_changed_fraction: Fraction of changed signature pixels
+                                     above which a scene does not match
+        :type capacity: int
+        :type max_changed_fraction: float
+        """
+        self.capacity = capacity
+        self.max_changed_fraction = max_changed_fraction
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._epoch = None
+        self._lock = threading.Lock()
+
+    def set_epoch(self, epoch):
+        """
+        Clears the cache when the epoch changes, e.g. the time the arm or
+        camera last settled, since the grasps are tied to the camera pose.
+
+        :param epoch: Current epoch
+        :type epoch: float
+        """
+        with self._lock:
+            if epoch != self._epoch:
+                self._entries.clear()
+                self._epoch = epoch
+
+    def lookup(self, signature):
+        """
+        Finds the grasps of a scene matching the signature.
+
+        :param signature: Signature of the current scene
+        :type signature: SceneSignature
+
+        :returns: The cached value of the closest matching scene and its
+                  fraction of changed pixels, or None
+        :rtype: tuple
+        """
+        with self._lock:
+            keys = list(self._entries)
+            if signature.key in self._entries:
+                # The scene with the same coarse hash is the likely match
+                keys.remove(signature.key)
+                keys.insert(0, signature.key)
+            match = None
+            for key in keys:
+                changed = signature.changed_fraction(self._entries[key][0])
+                if changed <= self.max_changed_fraction and \
+                        (match is None or changed < match[1]):
+                    match = key, changed
+                    if changed == 0.:
+                        break
+            if match is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            key, changed = match
+            # Most recently used last
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[1], changed
+
+    def store(self, signature, value):
+        """
+        Caches the value computed for a scene.
+
+        :param signature: Signature of the scene
+        :param value: Grasps predicted on the scene
+        :type signature: SceneSignature
+        """
+        with self._lock:
+            self._entries.pop(signature.key, None)
+            self._entries[signature.key] = (signature, value)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Depth lookup, pixel back-projection and reach helpers for the grasp node.
+
+Kept free of ROS imports so that they can be used on recorded frames.
+"""
+
+import numpy as np
+
+BB_SIZE = 5
+MAX_DEPTH = 3.0
+MIN_DEPTH = 0.1
+# Horizontal reach of the LoCoBot arm for top-down grasps, in meters
+MIN_REACH = 0.12
+MAX_REACH = 0.45
+
+
+def window_depth_means(depth, pts, bb=BB_SIZE,
+                       min_depth=MIN_DEPTH, max_depth=MAX_DEPTH):
+    """
+    Averages the valid depth of the 2bb x 2bb window starting bb pixels
+    above and to the left of every point.
+
+    Window pixels outside of the image, NaNs and depths outside of
+    (min_depth, max_depth] are ignored. The depth image is not modified.
+
+    :param depth: Depth image in meters
+    :param pts: (row, column) pixel coordinates, shape (N, 2)
+    :param bb: Half size of the window
+    :param min_depth: Depths up to this value are ignored
+    :param max_depth: Depths above this value are ignored
+    :type depth: np.ndarray
+    :type pts: np.ndarray
+    :type bb: int
+    :type min_depth: float
+    :type max_depth: float
+
+    :returns: Mean depth of every window, 0 where no pixel is valid
+    :rtype: np.ndarray
+    """
+    pts = np.asarray(pts).reshape(-1, 2).astype(int)
+    offsets = np.arange(-bb, bb)
+    rows = pts[:, 0, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+    cols = pts[:, 1, np.newaxis, np.newaxis] + offsets[np.newaxis, :]
+    inside = ((rows >= 0) & (rows < depth.shape[0]) &
+              (cols >= 0) & (cols < depth.shape[1]))
+    z = depth[np.clip(rows, 0, depth.shape[0] - 1),
+              np.clip(cols, 0, depth.shape[1] - 1)].astype(np.float64)
+    # NaNs fail both comparisons
+    valid = inside & (z > min_depth) & (z <= max_depth)
+    count = valid.sum(axis=(1, 2))
+    total = np.where(valid, z, 0.).sum(axis=(1, 2))
+    return np.where(count > 0, total / np.maximum(count, 1), 0.)
+
+
+class CameraModel(object):
+    """
+    This class back-projects pixels of a camera with a 3x4 projection matrix.
+    """
+
+    def __init__(self, P):
+        """
+        The constructor for :class:`CameraModel` class.
+
+        :param P: Projection matrix, as in sensor_msgs/CameraInfo
+        :type P: list
+        """
+        self.P = np.array(P, dtype=np.float64).reshape(3, 4)
+
+    def back_project(self, pts, zs):
+        """
+        Back-projects pixels with known depths into the camera frame.
+
+        :param pts: (row, column) pixel coordinates, shape (N, 2)
+        :param zs: Depth of every pixel, shape (N,)
+        :type pts: np.ndarray
+        :type zs: np.ndarray
+
+        :returns: Points in the camera frame, shape (N, 3)
+        :rtype: np.ndarray
+        """
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        zs = np.asarray(zs, dtype=np.float64).reshape(-1)
+        # P [x, y, z, 1] ~ [u, v, 1] is linear in (x, y, 1) for a fixed z
+        P_n = np.empty((len(pts), 3, 3))
+        P_n[:, :, :2] = self.P[:, :2]
+        P_n[:, :, 2] = self.P[:, 3] + self.P[:, 2] * zs[:, np.newaxis]
+        uv = np.stack([pts[:, 1], pts[:, 0], np.ones(len(pts))], axis=1)
+        points = np.linalg.solve(P_n, uv[:, :, np.newaxis])[:, :, 0]
+        points /= points[:, 2:]
+        points[:, 2] = zs
+        return points
+
+
+def within_reach(points, min_reach=MIN_REACH, max_reach=MAX_REACH):
+    """
+    Checks which base frame points lie in front of the arm, within the
+    annulus its gripper can reach from above. This is a cheap filter before
+    the inverse kinematics of the motion node.
+
+    :param points: Points in the base frame, shape (N, 3)
+    :param min_reach: Closest reachable horizontal distance to the base
+    :param max_reach: Farthest reachable horizontal distance to the base
+    :type points: np.ndarray
+    :type min_reach: float
+    :type max_reach: float
+
+    :returns: Whether every point is within reach
+    :rtype: np.ndarray
+    """
+    points = np.asarray(points).reshape(-1, 3)
+    reach = np.hypot(points[:, 0], points[:, 1])
+    return (points[:, 0] > 0.) & (reach >= min_reach) & (reach <= max_reach)
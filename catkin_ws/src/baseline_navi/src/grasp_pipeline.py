@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Grasp computation of the grasp node, from an RGB-D frame to grasp candidates
+in the base frame.
+
+Nothing in here imports ROS: the node (or the replay driver) passes in the
+frames, the camera model, a transform lookup and a log function.
+"""
+
+import os
+import sys
+
+import numpy as np
+from goal_filter import quaternion_rotate
+from grasp_cache import CACHE_SIZE, GraspCache, SceneSignature
+from grasp_geometry import BB_SIZE, MAX_REACH, MIN_REACH, \
+    window_depth_means, within_reach
+from tabletop_roi import segment_tabletop
+sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
+from grasp_samplers.tracing import span
+
+BASE_FRAME = 'base_link'
+KINECT_FRAME = 'camera_color_optical_frame'
+# Workspace crop as (min, max) rows and (min, max) columns
+DEFAULT_DIMS = [(240, 480), (100, 540)]
+
+
+def print_log(message):
+    print(message)
+
+
+def pixel_color(img, h, w):
+    """
+    :returns: Name of the dominant channel of a pixel
+    :rtype: string
+    """
+    r, g, b = img[h][w][:3]
+    index = [r, g, b].index(max([r, g, b]))
+    return ['red', 'green', 'blue'][index]
+
+
+class GraspPipeline(object):
+    """
+    This class predicts grasps on RGB-D frames: it crops the objects on the
+    table, runs the grasp model (or reuses the grasps of an unchanged scene)
+    and back-projects the grasps into the base frame.
+    """
+
+    def __init__(self, grasp_model, patch_size, lookup_transform,
+                 use_roi=True, cache_size=CACHE_SIZE, min_reach=MIN_REACH,
+                 max_reach=MAX_REACH, log=print_log, warn=print_log):
+        """
+        The constructor for :class:`GraspPipeline` class.
+
+        :param grasp_model: Grasp model
+        :param patch_size: Size of the patches of the grasp model
+        :param lookup_transform: Returns the latest (translation, quaternion)
+                                 of a source frame in a target frame, called
+                                 as lookup_transform(target, source)
+        :param use_roi: Crop the image around the objects segmented on the
+                        table in the depth image, and sample patches on
+                        them only
+        :param cache_size: Number of scenes whose grasps are reused or
+                           re-scored while the scene does not change, 0 to
+                           predict on every frame
+        :param min_reach: Closest horizontal distance to the base of the
+                          grasps kept
+        :param max_reach: Farthest horizontal distance to the base of the
+                          grasps kept
+        :param log: Logs a message
+        :param warn: Logs a warning
+        :type grasp_model: GraspModel
+        :type patch_size: int
+        :type lookup_transform: function
+        :type use_roi: bool
+        :type cache_size: int
+        :type min_reach: float
+        :type max_reach: float
+        :type log: function
+        :type warn: function
+        """
+        self.grasp_model = grasp_model
+        self.patch_size = patch_size
+        self.lookup_transform = lookup_transform
+        self.use_roi = use_roi
+        self.min_reach = min_reach
+        self.max_reach = max_reach
+        self.log = log
+        self.warn = warn
+        self.cache = None
+        if cache_size > 0:
+            self.cache = GraspCache(cache_size)
+
+    def camera_points(self, depth, camera, pts, norm_z=None, bb=BB_SIZE):
+        """
+        Back-projects many pixels into the camera frame.
+
+        :param depth: Depth image in meters
+        :param camera: Model of the camera the depth image is aligned with
+        :param pts: (row, column) pixel coordinates, shape (N, 2)
+        :param norm_z: Normalization of the depth
+        :param bb: Half size of the window the depth is averaged over
+        :type depth: np.ndarray
+        :type camera: CameraModel
+        :type pts: np.ndarray
+        :type norm_z: float
+        :type bb: int
+
+        :returns: Points in the camera frame, shape (N, 3), and whether each
+                  pixel had a valid depth
+        :rtype: tuple
+        """
+        pts = np.asarray(pts).reshape(-1, 2)
+        zs = window_depth_means(depth, pts, bb)
+        valid = zs != 0.
+        if norm_z is not None:
+            zs = zs / norm_z
+        # Pixels without depth are back-projected at depth 1 and flagged
+        points = camera.back_project(pts, np.where(valid, zs, 1.))
+        return points, valid
+
+    def base_points(self, depth, camera, pts, norm_z=None):
+        """
+        Converts many pixels to points in the base frame with a single
+        transform lookup.
+
+        :returns: Points in the base frame, shape (N, 3), and whether each
+                  pixel had a valid depth
+        :rtype: tuple
+        """
+        points, valid = self.camera_points(depth, camera, pts, norm_z)
+        trans, rot = self.lookup_transform(BASE_FRAME, KINECT_FRAME)
+        base_pts = np.asarray(trans) + quaternion_rotate(rot, points)
+        return base_pts, valid
+
+    def compute(self, rgb, depth, camera, stamp, settled=None,
+                camera_settled=None, dims=DEFAULT_DIMS):
+        """
+        Computes grasp candidates on an RGB-D frame.
+
+        :param rgb: RGB image
+        :param depth: Depth image in meters aligned with `rgb`
+        :param camera: Model of the color camera
+        :param stamp: Time of the frame
+        :param settled: Time after which the arm is still, None if unknown.
+                        Frames taken before are neither cached nor matched
+        :param camera_settled: Time after which the camera is still; the
+                               cached grasps are dropped when it changes
+        :param dims: List of tuples of min and max indices of the image axis
+                     of the workspace. Scenes are compared on this crop, and
+                     it is used when no object is segmented on the table.
+        :type rgb: np.ndarray
+        :type depth: np.ndarray
+        :type camera: CameraModel
+        :type stamp: float
+        :type settled: float
+        :type camera_settled: float
+        :type dims: list
+
+        :returns: Grasp candidates [x, y, theta, score, color] in the base
+                  frame, best first, without the ones that have no depth or
+                  are out of reach. When none is within reach, the ones with
+                  a depth are kept and the motion node checks them
+        :rtype: list
+        """
+        cached = None
+        use_cache = self.cache is not None and settled is not None and \
+            stamp >= settled
+        if use_cache:
+            # Grasps are tied to the camera pose
+            self.cache.set_epoch(camera_settled)
+            signature = SceneSignature(
+                rgb[dims[0][0]:dims[0][1], dims[1][0]:dims[1][1]],
+                depth[dims[0][0]:dims[0][1], dims[1][0]:dims[1][1]])
+            cached = self.cache.lookup(signature)
+        if cached is None:
+            dims, sample_weights = self._object_crop(depth, camera, dims)
+            img = rgb[dims[0][0]:dims[0][1], dims[1][0]:dims[1][1]]
+            self.grasp_model.predict(img, sample_weights=sample_weights)
+            if use_cache:
+                self.cache.store(signature,
+                                 (dims, self.grasp_model.candidates))
+        else:
+            (dims, grasps), changed = cached
+            img = rgb[dims[0][0]:dims[0][1], dims[1][0]:dims[1][1]]
+            if changed == 0.:
+                self.log('Scene unchanged, reusing its grasps')
+                self.grasp_model.set_prediction(img, grasps)
+            else:
+                self.log('Scene changed by {:.1%}, re-scoring its '
+                         'grasps'.format(changed))
+                self.grasp_model.rescore(img, grasps)
+                self.cache.store(signature,
+                                 (dims, self.grasp_model.candidates))
+        pixel_grasps = np.array([grasp[:2] for grasp in
+                                 self.grasp_model.candidates], dtype=int)
+        self.log('Pixel grasps: {}'.format(self.grasp_model.candidates))
+        colors = [pixel_color(img, h, w) for h, w in pixel_grasps]
+
+        offset = np.array([dims[0][0], dims[1][0]])
+        with span('back_project'):
+            base_pts, valid = self.base_points(depth, camera,
+                                               pixel_grasps + offset)
+        reachable = within_reach(base_pts, self.min_reach, self.max_reach)
+        if valid.any() and not (valid & reachable).any():
+            # The reach limits are approximate, the inverse kinematics of
+            # the motion node has the last word
+            self.warn('No grasp within reach [{}, {}], keeping the '
+                      'unfiltered ones'.format(self.min_reach,
+                                               self.max_reach))
+            reachable[:] = True
+        candidates = []
+        for i, grasp in enumerate(self.grasp_model.candidates):
+            if not valid[i] or not reachable[i]:
+                self.log('Dropping grasp {} ({})'.format(
+                    grasp, 'no depth' if not valid[i] else 'out of reach'))
+                continue
+            candidates.append([base_pts[i, 0], base_pts[i, 1], grasp[2],
+                               grasp[3], colors[i]])
+        return candidates
+
+    def _object_crop(self, depth, camera, dims):
+        """
+        Crops around the objects segmented on the table.
+
+        :param depth: Depth image in meters
+        :param camera: Model of the camera the depth image is aligned with
+        :param dims: Crop used when no object is found
+        :type depth: np.ndarray
+        :type camera: CameraModel
+        :type dims: list
+
+        :returns: The crop and the sampling weights of its pixels, None to
+                  sample uniformly
+        :rtype: tuple
+        """
+        if not self.use_roi:
+            return dims, None
+        with span('roi'):
+            roi = segment_tabletop(depth, camera)
+        crop = roi.crop(2 * self.patch_size)
+        if crop is None:
+            self.log('No object segmented on the table, '
+                     'using the default crop')
+            return dims, None
+        self.log('{} objects on the table, crop {}'.format(
+            len(roi.boxes), crop))
+        sample_weights = roi.mask[crop[0][0]:crop[0][1],
+                                  crop[1][0]:crop[1][1]]
+        return crop, sample_weights.astype(np.float64)
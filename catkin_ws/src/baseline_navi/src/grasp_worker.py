@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+Background grasp prediction for the grasp node.
+
+Nothing in here imports ROS, the node passes in its own callables and clock.
+"""
+
+import threading
+import time
+
+MAX_GRASP_AGE = 5.0
+POLL_PERIOD = 0.05
+
+
+def print_log(message):
+    print(message)
+
+
+class GraspResult(object):
+    """
+    This class holds one speculatively computed grasp.
+    """
+
+    def __init__(self, version, key, stamp, computed_at, value):
+        """
+        The constructor for :class:`GraspResult` class.
+
+        :param version: Increases by one with every computed result
+        :param key: Readiness key the result was computed for
+        :param stamp: Time of the frame the grasp was computed on
+        :param computed_at: Time the computation finished
+        :param value: Whatever the compute function returned
+        :type version: int
+        :type key: float
+        :type stamp: float
+        :type computed_at: float
+        """
+        self.version = version
+        self.key = key
+        self.stamp = stamp
+        self.computed_at = computed_at
+        self.value = value
+
+
+class SpeculativeGraspWorker(object):
+    """
+    This class keeps a grasp computed ahead of requests in a background
+    thread.
+    """
+
+    def __init__(self, compute_fn, ready_fn, clock=time.time,
+                 poll_period=POLL_PERIOD, warn=print_log):
+        """
+        The constructor for :class:`SpeculativeGraspWorker` class.
+
+        :param compute_fn: Computes a grasp, returns (frame stamp, value)
+        :param ready_fn: Returns a key (e.g. the time the camera settled) when
+                         a grasp can be computed, None otherwise. A grasp is
+                         computed once per key, so nothing runs while the
+                         camera stays still; later requests are answered by
+                         the synchronous path and its scene cache
+        :param clock: Returns the current time, in the unit of the stamps
+        :param poll_period: Seconds between two readiness checks
+        :param warn: Logs a warning
+        :type compute_fn: function
+        :type ready_fn: function
+        :type clock: function
+        :type poll_period: float
+        :type warn: function
+        """
+        self.compute_fn = compute_fn
+        self.ready_fn = ready_fn
+        self.clock = clock
+        self.poll_period = poll_period
+        self.warn = warn
+        self.num_computed = 0
+        self.num_failed = 0
+        self._result = None
+        self._failed_key = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _needs_update(self, key):
+        if key == self._failed_key:
+            return False
+        return self._result is None or self._result.key != key
+
+    def _run(self):
+        while not self._stop.is_set():
+            key = self.ready_fn()
+            if key is None or not self._needs_update(key):
+                self._stop.wait(self.poll_period)
+                continue
+            try:
+                stamp, value = self.compute_fn()
+            except Exception as e:
+                # Retried on the next key, requests fall back to a
+                # synchronous call meanwhile
+                self.num_failed += 1
+                self._failed_key = key
+                self.warn('Speculative grasp failed: {}'.format(e))
+                continue
+            with self._lock:
+                version = 1 if self._result is None else \
+                    self._result.version + 1
+                self._result = GraspResult(version, key, stamp, self.clock(),
+                                           value)
+                self.num_computed += 1
+
+    def latest(self, min_stamp=None, max_age=MAX_GRASP_AGE):
+        """
+        Returns the last computed grasp if it is fresh enough.
+
+        :param min_stamp: Oldest acceptable frame time, None for any
+        :param max_age: Maximum age of the frame in seconds
+        :type min_stamp: float
+        :type max_age: float
+
+        :returns: The last result, None if there is none or it is stale
+        :rtype: GraspResult
+        """
+        with self._lock:
+            result = self._result
+        if result is None:
+            return None
+        if min_stamp is not None and result.stamp < min_stamp:
+            return None
+        if self.clock() - result.stamp > max_age:
+            return None
+        return result
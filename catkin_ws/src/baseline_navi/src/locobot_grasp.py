@@ -12,29 +12,37 @@ Follow the associated README for installation instructions.
 """
 
 import os
-import copy
 import sys
+import threading
 import time
 import numpy as np
+import message_filters
 import rospy
 from geometry_msgs.msg import Quaternion, PointStamped
 from tf import TransformListener
 from std_msgs.msg import Int32
 from motion_pkg.srv import Grasp_Point, Grasp_PointResponse
-from sensor_msgs.msg import Image, CameraInfo
-from cv_bridge import CvBridge, CvBridgeError
+from sensor_msgs.msg import Image, CameraInfo, JointState
+from grasp_cache import CACHE_SIZE
+from grasp_geometry import MAX_REACH, MIN_REACH, CameraModel
+from grasp_pipeline import BASE_FRAME, DEFAULT_DIMS, KINECT_FRAME, \
+    GraspPipeline
+from grasp_worker import MAX_GRASP_AGE, SpeculativeGraspWorker
+from rgbd_buffer import FRAME_BUFFER_SIZE, RGBDRingBuffer, StillnessMonitor
+from stage_stats import start_stage_stats
 sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
 from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.tracing import span
 
 MODEL_URL = 'https://www.dropbox.com/s/fta8zebyzfrt3fw/checkpoint.pth.20?dl=0'
-BB_SIZE = 5
-MAX_DEPTH = 3.0
-BASE_FRAME = 'base_link'
-KINECT_FRAME = 'camera_color_optical_frame'
 DEFAULT_PITCH = 1.57
-MIN_DEPTH = 0.1
 N_SAMPLES = 78
 PATCH_SIZE = 100
+N_CANDIDATES = 5
+SYNC_SLOP = 0.02
+# Joints that move the camera
+CAMERA_JOINTS = ('head_pan_joint', 'head_tilt_joint')
+FRAME_WAIT = 1.0
 
 
 class Grasp_pose(object):
@@ -47,6 +55,14 @@ class Grasp_pose(object):
                  model_name='model.pth',
                  n_samples=N_SAMPLES,
                  patch_size=PATCH_SIZE,
+                 speculate=True,
+                 display_grasp=True,
+                 server_address=None,
+                 n_candidates=N_CANDIDATES,
+                 use_roi=True,
+                 cache_size=CACHE_SIZE,
+                 min_reach=MIN_REACH,
+                 max_reach=MAX_REACH,
                  *kargs, **kwargs):
         """
         The constructor for :class:`Grasper` class. 
@@ -55,89 +71,137 @@ class Grasp_pose(object):
         :param model_name: Name of the path where the grasp model will be saved
         :param n_samples: Number of samples for the grasp sampler
         :param patch_size: Size of the patch for the grasp sampler
+        :param speculate: Keep predicting grasps in the background once the
+                          camera settled, and answer requests from the last
+                          prediction while it is fresh
+        :param display_grasp: Display the image of every served grasp
+        :param server_address: Unix socket of a shared grasp server to run
+                               the grasp model on, see
+                               grasp_samplers/grasp_server.py
+        :param n_candidates: Number of diverse grasps returned, best first,
+                             so that the motion node can fall back on them
+        :param use_roi: Crop the image around the objects segmented on the
+                        table in the depth image, and sample patches on
+                        them only
+        :param cache_size: Number of scenes whose grasps are reused or
+                           re-scored while the scene does not change, 0 to
+                           predict on every request
+        :param min_reach: Closest horizontal distance to the base of the
+                          grasps returned
+        :param max_reach: Farthest horizontal distance to the base of the
+                          grasps returned
         :type url: string
         :type model_name: string
         :type n_samples: int
         :type patch_size: int
+        :type speculate: bool
+        :type display_grasp: bool
+        :type server_address: string
+        :type n_candidates: int
+        :type use_roi: bool
+        :type cache_size: int
+        :type min_reach: float
+        :type max_reach: float
         """
 
         # TODO - use planning_mode=no_plan, its better
         self.grasp_model = GraspModel(model_name=model_name,
                                       url=url,
                                       nsamples=n_samples,
-                                      patchsize=patch_size)
+                                      patchsize=patch_size,
+                                      server_address=server_address,
+                                      n_candidates=n_candidates)
         self.color = ''
+        self.display_grasp = display_grasp
+        # Guards the grasp model and the selected frames
+        self._grasp_lock = threading.Lock()
         self._transform_listener = TransformListener()
-        self.bridge = CvBridge()
+        self.pipeline = GraspPipeline(self.grasp_model, patch_size,
+                                      self._lookup_transform,
+                                      use_roi=use_roi, cache_size=cache_size,
+                                      min_reach=min_reach,
+                                      max_reach=max_reach,
+                                      log=rospy.loginfo, warn=rospy.logwarn)
+        # Color and depth frames are only converted when a grasp is requested
+        self.frames = RGBDRingBuffer(FRAME_BUFFER_SIZE)
+        self.stillness = StillnessMonitor()
+        self.camera_stillness = StillnessMonitor()
         self.image_rgb = None
         self.image_depth = None
+        self.image_stamp = None
         self.camera_info = None
-        self.image_sub = rospy.Subscriber('camera/color/image_raw', Image, self.image_cb, queue_size=1)
+        self.camera = None
+        self.image_sub = message_filters.Subscriber('camera/color/image_raw', Image)
+        self.depth_sub = message_filters.Subscriber('/camera/aligned_depth_to_color/image_raw', Image)
+        self.rgbd_sync = message_filters.ApproximateTimeSynchronizer(
+            [self.image_sub, self.depth_sub], queue_size=5, slop=SYNC_SLOP)
+        self.rgbd_sync.registerCallback(self.rgbd_cb)
         self.camera_info_sub = rospy.Subscriber('camera/color/camera_info', CameraInfo, self.camera_info_cb, queue_size=1)
-        self.depth_sub = rospy.Subscriber('/camera/aligned_depth_to_color/image_raw', Image, self.depth_cb, queue_size=1)
+        self.joint_sub = rospy.Subscriber('/joint_states', JointState, self.joint_state_cb, queue_size=10)
+        self.worker = None
+        if speculate:
+            self.worker = SpeculativeGraspWorker(self._speculate,
+                                                 self._speculation_key,
+                                                 clock=rospy.get_time,
+                                                 warn=rospy.logwarn)
+            self.worker.start()
         self.grasppoint_srv = rospy.Service('locobot_grasppoint', Grasp_Point, self.handle_grasp)
 
-    def image_cb(self, image_msg):
-        try:
-            self.image_rgb = self.bridge.imgmsg_to_cv2(image_msg, "rgb8")
-        except CvBridgeError, e:
-            print(e)
+    def rgbd_cb(self, image_msg, depth_msg):
+        self.frames.push(image_msg.header.stamp.to_sec(), image_msg, depth_msg)
+
+    def joint_state_cb(self, joint_msg):
+        stamp = joint_msg.header.stamp.to_sec()
+        self.stillness.update(stamp, joint_msg.name, joint_msg.position)
+        camera_joints = [(name, position) for name, position in
+                         zip(joint_msg.name, joint_msg.position)
+                         if name in CAMERA_JOINTS]
+        if camera_joints:
+            self.camera_stillness.update(stamp, *zip(*camera_joints))
 
     def camera_info_cb(self, info_msg):
-        self.camera_info = np.array(info_msg.P).reshape(3, 4)
-
-    def depth_cb(self, depth_msg):
-        try:
-            self.image_depth = self.bridge.imgmsg_to_cv2(depth_msg, "passthrough").copy()
-            self.image_depth[np.isnan(self.image_depth)] = 0.
-        except CvBridgeError, e:
-            print(e)
-
-    def _process_depth(self, cur_depth=None):
-        if cur_depth is None:
-            cur_depth = self.image_depth
-        cur_depth[self.image_depth > MAX_DEPTH] = 0.
-        return cur_depth
-
-    def _get_z_mean(self, depth, pt, bb=BB_SIZE):
-        sum_z = 0.
-        nps = 0
-        for i in range(bb * 2):
-            for j in range(bb * 2):
-                new_pt = [pt[0] - bb + i, pt[1] - bb + j]
-                try:
-                    new_z = depth[int(new_pt[0]), int(new_pt[1])]
-                    if new_z > MIN_DEPTH:
-                        sum_z += new_z
-                        nps += 1
-                except:
-                    pass
-        if nps == 0.:
-            return 0.
-        else:
-            return sum_z / nps
+        if self.camera is None or tuple(info_msg.P) != self.camera_info:
+            self.camera_info = tuple(info_msg.P)
+            self.camera = CameraModel(info_msg.P)
+
+    def _select_frames(self, timeout=FRAME_WAIT):
+        """
+        Picks the RGB-D pair to grasp from: the sharpest pair taken after the
+        arm settled, or else the newest pair.
+
+        :param timeout: Seconds to wait for the arm to settle
+        :type timeout: float
+        """
+        snapshot = None
+        settled = self.stillness.settled_since()
+        if settled is not None:
+            snapshot = self.frames.sharpest(after=settled, timeout=timeout)
+        if snapshot is None:
+            rospy.logwarn('No frame after the arm settled, using the newest')
+            snapshot = self.frames.latest(timeout=timeout)
+        if snapshot is None:
+            raise RuntimeError('No synchronized RGB-D frame received')
+        # NaNs and far depths are masked per window, see _get_z_mean
+        self.image_rgb = snapshot.rgb
+        self.image_depth = snapshot.depth
+        self.image_stamp = snapshot.stamp
+
+    def _lookup_transform(self, target, source):
+        return self._transform_listener.lookupTransform(target, source,
+                                                        rospy.Time(0))
+
+    def _get_3D_camera_batch(self, pts, norm_z=None):
+        return self.pipeline.camera_points(self.image_depth, self.camera, pts,
+                                           norm_z)
 
     def _get_3D_camera(self, pt, norm_z=None):
         assert len(pt) == 2
-        cur_depth = self._process_depth()
-        z = self._get_z_mean(cur_depth, [pt[0], pt[1]])
+        points, valid = self._get_3D_camera_batch([pt[0], pt[1]], norm_z)
+        z = points[0, 2] if valid[0] else 0.
         rospy.loginfo('depth of point is : {}'.format(z))
         if z == 0.:
             raise RuntimeError
-        if norm_z is not None:
-            z = z / norm_z
-        u = pt[1]
-        v = pt[0]
-        P = copy.deepcopy(self.camera_info)
-        rospy.loginfo('P is: {}'.format(P))
-        P_n = np.zeros((3, 3))
-        P_n[:, :2] = P[:, :2]
-        P_n[:, 2] = P[:, 3] + P[:, 2] * z
-        P_n_inv = np.linalg.inv(P_n)
-        temp_p = np.dot(P_n_inv, np.array([u, v, 1]))
-        temp_p = temp_p / temp_p[-1]
-        temp_p[-1] = z
-        return temp_p
+        return points[0]
 
     def _convert_frames(self, pt):
         assert len(pt) == 3
@@ -158,50 +222,92 @@ class Grasp_pose(object):
         base_pt = self._convert_frames(temp_p)
         return base_pt
 
-    def compute_grasp(self, dims=[(240, 480), (100, 540)], display_grasp=True):
+    def get_3D_batch(self, pts, z_norm=None):
+        """
+        Converts many pixels to points in the base frame with a single
+        transform lookup.
+
+        :param pts: (row, column) pixel coordinates, shape (N, 2)
+        :param z_norm: Normalization of the depth
+        :type pts: np.ndarray
+        :type z_norm: float
+
+        :returns: Points in the base frame, shape (N, 3), and whether each
+                  pixel had a valid depth
+        :rtype: tuple
+        """
+        return self.pipeline.base_points(self.image_depth, self.camera, pts,
+                                         z_norm)
+
+    def compute_grasp(self, dims=DEFAULT_DIMS, display_grasp=True):
         """
         Runs the grasp model to generate the best predicted grasp.
 
-        :param dims: List of tuples of min and max indices of the image axis.
+        :param dims: List of tuples of min and max indices of the image axis
+                     of the workspace, see :meth:`GraspPipeline.compute`.
         :param display_grasp: Displays image of the grasp.
         :type dims: list
         :type display_grasp: bool
 
-        :returns: Grasp configuration
+        :returns: Grasp candidates [x, y, theta, score, color] in the base
+                  frame, best first, see :meth:`GraspPipeline.compute`
         :rtype: list
         """
         print("Compute grasp pose")
-        img = self.image_rgb
-        img = img[dims[0][0]:dims[0][1], dims[1][0]:dims[1][1]]
-        selected_grasp = list(self.grasp_model.predict(img))
-        rospy.loginfo('Pixel grasp: {}'.format(selected_grasp))
-        img_grasp = copy.deepcopy(selected_grasp)
-
-        x = selected_grasp[0]
-        y = selected_grasp[1]
-        r = img[x][y][0]
-        g = img[x][y][1]
-        b = img[x][y][2]
-        index = [r, g, b].index(max([r, g, b]))
-        if index == 0:
-            self.color = 'red'
-        elif index == 1:
-            self.color = 'green'
-        else:
-            self.color = 'blue'
-
-        selected_grasp[0] += dims[0][0]
-        selected_grasp[1] += dims[1][0]
-        selected_grasp[:2] = self.get_3D(selected_grasp[:2])[:2]
+        with span('select_frames'):
+            self._select_frames()
+        candidates = self.pipeline.compute(
+            self.image_rgb, self.image_depth, self.camera, self.image_stamp,
+            settled=self.stillness.settled_since(),
+            camera_settled=self.camera_stillness.settled_since(), dims=dims)
         if display_grasp:
             self.grasp_model.display_predicted_image()
+        if not candidates:
+            raise RuntimeError('No grasp with a valid depth')
+        self.color = candidates[0][4]
+
+        return candidates
 
-        return selected_grasp
+    def _speculation_key(self):
+        # The arm stopped moving and a frame was taken since
+        settled = self.stillness.settled_since()
+        if settled is None or self.camera is None:
+            return None
+        if self.frames.newest_stamp() < settled:
+            return None
+        return settled
+
+    def _speculate(self):
+        with self._grasp_lock, span('speculate'):
+            return self.image_stamp, self.compute_grasp(display_grasp=False)
 
     def handle_grasp(self, request):
-        pred_grasp = self.compute_grasp()
-        print("Pred grasp: {}".format(pred_grasp))
-        return Grasp_PointResponse(pred_grasp[0], pred_grasp[1], pred_grasp[2], self.color)
+        result = None
+        if self.worker is not None:
+            result = self.worker.latest(min_stamp=self.stillness.settled_since(),
+                                        max_age=MAX_GRASP_AGE)
+        if result is not None:
+            candidates = result.value
+            rospy.loginfo('Using speculative grasp v{} from {:.2f}s ago'.format(
+                result.version, rospy.get_time() - result.stamp))
+        else:
+            with self._grasp_lock, span('handle_grasp'):
+                candidates = self.compute_grasp(display_grasp=False)
+        if self.display_grasp:
+            with self._grasp_lock:
+                disp_I = self.grasp_model.predicted_image()
+                if disp_I is not None:
+                    disp_I = disp_I.copy()
+            # Waits for a key press, so the speculative worker and later
+            # requests must not wait on the lock meanwhile
+            if disp_I is not None:
+                self.grasp_model.display_predicted_image(disp_I)
+        print("Pred grasps: {}".format(candidates))
+        x, y, theta, _, color = candidates[0]
+        xs, ys, thetas, scores, colors = zip(*candidates)
+        return Grasp_PointResponse(x=x, y=y, theta=theta, color=color,
+                                   xs=xs, ys=ys, thetas=thetas,
+                                   scores=scores, colors=colors)
 
 
 def main():
@@ -211,7 +317,12 @@ def main():
 
     rospy.init_node('grasp_pose', anonymous=True)
     print("Init pose estimation node")
-    grasp_pose = Grasp_pose(n_samples=N_SAMPLES, patch_size=PATCH_SIZE)
+    grasp_pose = Grasp_pose(n_samples=N_SAMPLES, patch_size=PATCH_SIZE,
+                            server_address=rospy.get_param('~grasp_server',
+                                                           None),
+                            min_reach=rospy.get_param('~min_reach', MIN_REACH),
+                            max_reach=rospy.get_param('~max_reach', MAX_REACH))
+    start_stage_stats('locobot_grasp')
     rospy.spin()
 
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+On-disk recordings of the perception inputs, for offline replay.
+
+A recording is a directory with:
+
+- `rgb.bin` and `depth.bin`: the raw frames, appended one after another and
+  read back as memory-mapped arrays of shape (N, height, width[, 3]),
+- `records.jsonl`: one line per frame or tag detection array, in arrival
+  order, with its time, the camera intrinsics and the transforms looked up
+  when it was recorded,
+- `meta.json`: the shape and dtype of the frames.
+
+Nothing in here imports ROS.
+"""
+
+import json
+import os
+
+import numpy as np
+
+FORMAT_VERSION = 1
+STREAMS = ['rgb', 'depth']
+
+
+def transform_key(target, source):
+    return '{} {}'.format(target, source)
+
+
+class PerceptionLogWriter(object):
+    """
+    This class appends frames and tag detections to a recording.
+    """
+
+    def __init__(self, path):
+        """
+        The constructor for :class:`PerceptionLogWriter` class.
+
+        :param path: Directory of the recording, created if needed
+        :type path: string
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.num_frames = 0
+        self.meta = None
+        self._files = dict((stream, open(os.path.join(path, stream + '.bin'),
+                                         'wb'))
+                           for stream in STREAMS)
+        self._records = open(os.path.join(path, 'records.jsonl'), 'w')
+
+    def _write_meta(self, frames):
+        self.meta = {'version': FORMAT_VERSION}
+        for stream, frame in zip(STREAMS, frames):
+            self.meta[stream] = {'shape': list(frame.shape),
+                                 'dtype': frame.dtype.newbyteorder('=').str}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2, sort_keys=True)
+
+    def write_frame(self, stamp, rgb, depth, P, transforms):
+        """
+        Appends a synchronized RGB-D pair.
+
+        :param stamp: Time of the color frame in seconds
+        :param rgb: RGB image
+        :param depth: Depth image aligned to the color image
+        :param P: Projection matrix of the color camera
+        :param transforms: (translation, quaternion) per (target, source)
+                           frame pair, or None where the lookup failed
+        :type stamp: float
+        :type rgb: np.ndarray
+        :type depth: np.ndarray
+        :type P: list
+        :type transforms: dict
+        """
+        if self.meta is None:
+            self._write_meta([rgb, depth])
+        for stream, frame in zip(STREAMS, [rgb, depth]):
+            if list(frame.shape) != self.meta[stream]['shape']:
+                raise ValueError('{} frame of shape {} in a recording of '
+                                 'shape {}'.format(stream, frame.shape,
+                                                   self.meta[stream]['shape']))
+            frame = frame.astype(self.meta[stream]['dtype'], copy=False)
+            self._files[stream].write(np.ascontiguousarray(frame).tobytes())
+        self._write_record({'type': 'frame', 'index': self.num_frames,
+                            'stamp': stamp, 'P': list(P),
+                            'transforms': self._transforms(transforms)})
+        self.num_frames += 1
+
+    def write_tags(self, stamp, detections, transforms):
+        """
+        Appends the tag detections of one camera frame.
+
+        :param stamp: Time of the detections in seconds
+        :param detections: Tag detections
+        :param transforms: (translation, quaternion) per (target, source)
+                           frame pair at the time of the detections, or None
+                           where the lookup failed
+        :type stamp: float
+        :type detections: list
+        :type transforms: dict
+        """
+        self._write_record({
+            'type': 'tags', 'stamp': stamp,
+            'detections': [{'id': detection.tag_id, 'frame': detection.frame,
+                            'stamp': detection.stamp,
+                            'position': detection.position.tolist(),
+                            'orientation': detection.orientation.tolist()}
+                           for detection in detections],
+            'transforms': self._transforms(transforms)})
+
+    def _transforms(self, transforms):
+        records = {}
+        for (target, source), transform in transforms.items():
+            if transform is not None:
+                transform = [list(map(float, transform[0])),
+                             list(map(float, transform[1]))]
+            records[transform_key(target, source)] = transform
+        return records
+
+    def _write_record(self, record):
+        self._records.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def flush(self):
+        for f in list(self._files.values()) + [self._records]:
+            f.flush()
+
+    def close(self):
+        for f in list(self._files.values()) + [self._records]:
+            f.close()
+
+
+class PerceptionLog(object):
+    """
+    This class reads a recording, with the frames memory-mapped.
+    """
+
+    def __init__(self, path):
+        """
+        The constructor for :class:`PerceptionLog` class.
+
+        :param path: Directory of the recording
+        :type path: string
+        """
+        self.path = path
+        self.records = []
+        with open(os.path.join(path, 'records.jsonl')) as f:
+            for line in f:
+                try:
+                    self.records.append(json.loads(line))
+                except ValueError:
+                    # Cut off by an interrupted recording
+                    break
+        self.frames = {}
+        self.num_frames = 0
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return
+        with open(meta_path) as f:
+            meta = json.load(f)
+        assert meta['version'] == FORMAT_VERSION, \
+            'Unsupported recording version {}'.format(meta['version'])
+        specs = dict((stream, (os.path.join(path, stream + '.bin'),
+                               np.dtype(meta[stream]['dtype']),
+                               tuple(meta[stream]['shape'])))
+                     for stream in STREAMS)
+        num_frames = sum(1 for record in self.records
+                         if record['type'] == 'frame')
+        for stream_path, dtype, shape in specs.values():
+            frame_size = int(np.prod(shape)) * dtype.itemsize
+            num_frames = min(num_frames,
+                             os.path.getsize(stream_path) // frame_size)
+        for stream, (stream_path, dtype, shape) in specs.items():
+            if num_frames == 0:
+                # Empty files cannot be mapped
+                self.frames[stream] = np.zeros((0,) + shape, dtype=dtype)
+            else:
+                self.frames[stream] = np.memmap(stream_path, dtype=dtype,
+                                                mode='r',
+                                                shape=(num_frames,) + shape)
+        self.num_frames = num_frames
+        # Frames whose pixels were not completely written are dropped
+        self.records = [record for record in self.records
+                        if record['type'] != 'frame' or
+                        record['index'] < num_frames]
+
+    def __len__(self):
+        return len(self.records)
+
+    def frame(self, record):
+        """
+        :returns: Memory-mapped RGB and depth images of a frame record
+        :rtype: tuple
+        """
+        return (self.frames['rgb'][record['index']],
+                self.frames['depth'][record['index']])
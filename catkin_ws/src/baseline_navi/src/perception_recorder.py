@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Records the inputs of the perception nodes for offline replay, see
+perception_log.py and perception_replay.py.
+
+Synchronized color and depth frames are stored with the camera intrinsics
+and the camera pose in the base frame; tag detections with the camera pose
+in the odom frame at their time.
+
+Usage::
+
+    rosrun baseline_navi perception_recorder.py _output:=recording/ \\
+        _max_rate:=5
+"""
+
+import threading
+
+import message_filters
+import rospy
+import tf2_ros
+from apriltag_ros.msg import AprilTagDetectionArray
+from sensor_msgs.msg import CameraInfo, Image
+from apriltags_to_goalpoint import tag_detections
+from goal_filter import ODOM_FRAME
+from grasp_pipeline import BASE_FRAME, KINECT_FRAME
+from perception_log import PerceptionLogWriter
+from rgbd_buffer import image_msg_view
+
+MAX_RATE = 5.
+# Same pairing of color and depth frames as locobot_grasp
+SYNC_SLOP = 0.02
+TF_CACHE_TIME = 60.
+
+
+class PerceptionRecorder(object):
+    """
+    This class writes the camera, tag and transform messages to a recording.
+    """
+
+    def __init__(self, output, max_rate=MAX_RATE):
+        """
+        The constructor for :class:`PerceptionRecorder` class.
+
+        :param output: Directory of the recording
+        :param max_rate: Largest number of RGB-D frames recorded per second
+        :type output: string
+        :type max_rate: float
+        """
+        self.writer = PerceptionLogWriter(output)
+        self.min_period = 1. / max_rate
+        self.last_stamp = None
+        self.P = None
+        self._lock = threading.Lock()
+        self.tf_buffer = tf2_ros.Buffer(rospy.Duration(TF_CACHE_TIME))
+        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer)
+        self.image_sub = message_filters.Subscriber('camera/color/image_raw', Image)
+        self.depth_sub = message_filters.Subscriber('/camera/aligned_depth_to_color/image_raw', Image)
+        self.rgbd_sync = message_filters.ApproximateTimeSynchronizer(
+            [self.image_sub, self.depth_sub], queue_size=5, slop=SYNC_SLOP)
+        self.rgbd_sync.registerCallback(self.rgbd_cb)
+        self.camera_info_sub = rospy.Subscriber('camera/color/camera_info', CameraInfo, self.camera_info_cb, queue_size=1)
+        self.tag_sub = rospy.Subscriber('tag_detections', AprilTagDetectionArray, self.tag_cb)
+
+    def _lookup(self, target, source, stamp=None):
+        # The transform at the message time if the buffer has it, else the
+        # latest one, like the nodes
+        times = [rospy.Time(0)]
+        if stamp is not None:
+            times.insert(0, stamp)
+        for lookup_time in times:
+            try:
+                transform = self.tf_buffer.lookup_transform(target, source,
+                                                            lookup_time)
+            except (tf2_ros.LookupException, tf2_ros.ConnectivityException,
+                    tf2_ros.ExtrapolationException):
+                continue
+            t = transform.transform.translation
+            r = transform.transform.rotation
+            return [t.x, t.y, t.z], [r.x, r.y, r.z, r.w]
+        return None
+
+    def camera_info_cb(self, info_msg):
+        self.P = list(info_msg.P)
+
+    def rgbd_cb(self, image_msg, depth_msg):
+        stamp = image_msg.header.stamp.to_sec()
+        if self.P is None or (self.last_stamp is not None and
+                              stamp - self.last_stamp < self.min_period):
+            return
+        self.last_stamp = stamp
+        rgb = image_msg_view(image_msg)
+        if image_msg.encoding == 'bgr8':
+            rgb = rgb[:, :, ::-1]
+        transforms = {(BASE_FRAME, KINECT_FRAME):
+                      self._lookup(BASE_FRAME, KINECT_FRAME)}
+        with self._lock:
+            self.writer.write_frame(stamp, rgb, image_msg_view(depth_msg),
+                                    self.P, transforms)
+
+    def tag_cb(self, msg_tags):
+        detections = tag_detections(msg_tags)
+        transforms = {}
+        for detection in detections:
+            transforms[(ODOM_FRAME, detection.frame)] = self._lookup(
+                ODOM_FRAME, detection.frame,
+                rospy.Time.from_sec(detection.stamp))
+        with self._lock:
+            self.writer.write_tags(msg_tags.header.stamp.to_sec(), detections,
+                                   transforms)
+
+    def close(self):
+        with self._lock:
+            self.writer.close()
+        rospy.loginfo('Recorded {} frames to {}'.format(
+            self.writer.num_frames, self.writer.path))
+
+
+def main():
+    rospy.init_node('perception_recorder', anonymous=True)
+    recorder = PerceptionRecorder(rospy.get_param('~output', 'recording'),
+                                  rospy.get_param('~max_rate', MAX_RATE))
+    rospy.on_shutdown(recorder.close)
+    rospy.spin()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Replays a recording of perception_recorder.py through the grasp and tag
+goal computations of the perception nodes, without a ROS master, camera or
+robot, and reports their latency and throughput.
+
+Transforms come from the recording through :class:`RecordedTF`. Patch
+sampling is seeded per frame, so two replays of a recording with the same
+settings predict the same grasps.
+
+Usage::
+
+    python perception_replay.py recording/ --model_name model.pth \\
+        --results replay.jsonl --summary replay_stats.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from goal_filter import ODOM_FRAME, TagDetection, TagGoalTracker
+from grasp_cache import CACHE_SIZE
+from grasp_geometry import MAX_REACH, MIN_REACH, CameraModel
+from grasp_pipeline import GraspPipeline, print_log
+from perception_log import PerceptionLog, transform_key
+sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.tracing import get_tracer, span
+
+N_SAMPLES = 78
+PATCH_SIZE = 100
+N_CANDIDATES = 5
+
+
+class RecordedTF(object):
+    """
+    This class stands in for the TF listeners of the nodes, with the
+    transforms stored in the records replayed so far.
+    """
+
+    def __init__(self):
+        self.transforms = {}
+
+    def update(self, record):
+        """
+        Takes in the transforms of a record.
+
+        :param record: Frame or tags record
+        :type record: dict
+        """
+        for key, transform in record['transforms'].items():
+            if transform is not None:
+                self.transforms[key] = (np.array(transform[0]),
+                                        np.array(transform[1]))
+
+    def lookup_transform(self, target, source):
+        """
+        :returns: Latest (translation, quaternion) of `source` in `target`
+        :rtype: tuple
+        """
+        key = transform_key(target, source)
+        if key not in self.transforms:
+            raise LookupError('No recorded transform from {} to {}'.format(
+                source, target))
+        return self.transforms[key]
+
+    def lookup_odom(self, frame, stamp):
+        """
+        :returns: Latest pose of a camera frame in the odom frame, None if
+                  it was not recorded
+        :rtype: tuple
+        """
+        try:
+            return self.lookup_transform(ODOM_FRAME, frame)
+        except LookupError:
+            return None
+
+
+def quiet_log(message):
+    pass
+
+
+def replay(recording, pipeline, tracker, tf, grasp_every=1, seed=0):
+    """
+    Runs the perception computations on every record of a recording.
+
+    :param recording: Recording
+    :param pipeline: Grasp computation of the grasp node
+    :param tracker: Goal computation of the tag node
+    :param tf: Transforms of the recording, updated by the replay
+    :param grasp_every: Compute grasps on one frame out of `grasp_every`
+    :param seed: Seed of the patch sampling
+    :type recording: PerceptionLog
+    :type pipeline: GraspPipeline
+    :type tracker: TagGoalTracker
+    :type tf: RecordedTF
+    :type grasp_every: int
+    :type seed: int
+
+    :returns: One result per replayed record
+    :rtype: generator
+    """
+    camera = None
+    settled = None
+    for record in recording.records:
+        tf.update(record)
+        if record['type'] == 'tags':
+            detections = [TagDetection(d['id'], d['frame'], d['stamp'],
+                                       d['position'], d['orientation'])
+                          for d in record['detections']]
+            with span('replay_tags'):
+                goals = tracker.update(detections)
+            yield {'type': 'tags', 'stamp': record['stamp'],
+                   'goals': [[stamp, position.tolist(), orientation.tolist()]
+                             for stamp, position, orientation in goals]}
+            continue
+        if record['index'] % grasp_every != 0:
+            continue
+        if camera is None or camera.P.ravel().tolist() != record['P']:
+            camera = CameraModel(record['P'])
+        if settled is None:
+            # The arm and camera are taken to be still during the recording
+            settled = record['stamp']
+        np.random.seed((seed + record['index']) & 0xffffffff)
+        st_time = time.time()
+        with span('replay_grasp'):
+            with span('load_frame'):
+                # Copied out of the mapping, like the node copies the frames
+                # out of its ring buffer
+                rgb, depth = [np.array(frame)
+                              for frame in recording.frame(record)]
+            try:
+                candidates = pipeline.compute(rgb, depth, camera,
+                                              record['stamp'], settled=settled,
+                                              camera_settled=settled)
+                error = None
+            except LookupError as e:
+                candidates, error = [], str(e)
+        result = {'type': 'frame', 'index': record['index'],
+                  'stamp': record['stamp'],
+                  'candidates': [[float(x), float(y), float(theta),
+                                  float(score), color]
+                                 for x, y, theta, score, color in candidates],
+                  'latency_ms': (time.time() - st_time) * 1e3}
+        if error is not None:
+            result['error'] = error
+        yield result
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Replay a perception recording without ROS')
+    parser.add_argument('recording', help='Directory written by '
+                                          'perception_recorder.py')
+    parser.add_argument('--model_name', default='model.pth')
+    parser.add_argument('--url', default=None,
+                        help='URL of the model, only needed if it is missing')
+    parser.add_argument('--server', default=None,
+                        help='Unix socket of a grasp server to use instead '
+                             'of loading the model')
+    parser.add_argument('--nsamples', type=int, default=N_SAMPLES)
+    parser.add_argument('--patchsize', type=int, default=PATCH_SIZE)
+    parser.add_argument('--n_candidates', type=int, default=N_CANDIDATES)
+    parser.add_argument('--no_roi', action='store_true',
+                        help='Sample the fixed workspace crop')
+    parser.add_argument('--cache_size', type=int, default=CACHE_SIZE,
+                        help='0 to predict on every frame')
+    parser.add_argument('--min_reach', type=float, default=MIN_REACH)
+    parser.add_argument('--max_reach', type=float, default=MAX_REACH)
+    parser.add_argument('--grasp_every', type=int, default=1,
+                        help='Compute grasps on one frame out of this many')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=None,
+                        help='JSONL file of the grasps and goals')
+    parser.add_argument('--summary', default=None,
+                        help='JSON file of the latency statistics')
+    parser.add_argument('--verbose', action='store_true')
+
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    recording = PerceptionLog(args.recording)
+    print('{} records, {} frames'.format(len(recording),
+                                         recording.num_frames))
+    grasp_model = GraspModel(model_name=args.model_name, url=args.url,
+                             nsamples=args.nsamples,
+                             patchsize=args.patchsize,
+                             server_address=args.server,
+                             n_candidates=args.n_candidates)
+    tf = RecordedTF()
+    pipeline = GraspPipeline(grasp_model, args.patchsize,
+                             tf.lookup_transform, use_roi=not args.no_roi,
+                             cache_size=args.cache_size,
+                             min_reach=args.min_reach,
+                             max_reach=args.max_reach,
+                             log=print_log if args.verbose else quiet_log)
+    tracker = TagGoalTracker(tf.lookup_odom)
+    tracer = get_tracer()
+    tracer.reset()
+
+    results = open(args.results, 'w') if args.results else None
+    num_frames = 0
+    num_failed = 0
+    st_time = time.time()
+    for result in replay(recording, pipeline, tracker, tf, args.grasp_every,
+                         args.seed):
+        if result['type'] == 'frame':
+            num_frames += 1
+            num_failed += 'error' in result or not result['candidates']
+        if results is not None:
+            results.write(json.dumps(result, sort_keys=True) + '\n')
+    total = time.time() - st_time
+    if results is not None:
+        results.close()
+
+    summary = tracer.summary()
+    stats = {'frames': num_frames, 'failed': num_failed, 'time': total,
+             'frames_per_s': num_frames / total if total > 0 else 0.,
+             'spans': summary}
+    for name in sorted(summary):
+        print('{:<60} {count:>6} {p50_ms:>9.2f} {p90_ms:>9.2f} '
+              '{p99_ms:>9.2f} ms'.format(name, **summary[name]))
+    print('{frames} frames ({failed} without a grasp) in {time:.1f}s '
+          '({frames_per_s:.2f} frames/s)'.format(**stats))
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+Fixed-capacity buffer of time-synchronized RGB-D frames for the grasp node.
+
+Incoming sensor_msgs/Image pairs are copied into preallocated slots without
+cv_bridge, so that nothing is allocated at camera rate. Frames are only
+converted and scored when a grasp is requested. Nothing in here imports ROS.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+FRAME_BUFFER_SIZE = 8
+SETTLE_TIME = 0.3
+JOINT_VEL_TOL = 0.02
+
+# encoding: (dtype, channels)
+IMAGE_ENCODINGS = {'rgb8': (np.uint8, 3),
+                   'bgr8': (np.uint8, 3),
+                   '16UC1': (np.uint16, 1),
+                   'mono16': (np.uint16, 1),
+                   '32FC1': (np.float32, 1)}
+
+
+def image_msg_view(msg):
+    """
+    Views the pixels of a sensor_msgs/Image without copying them.
+
+    :param msg: Image message
+    :type msg: sensor_msgs.msg.Image
+
+    :returns: Image of shape (height, width) or (height, width, channels)
+    :rtype: np.ndarray
+    """
+    assert msg.encoding in IMAGE_ENCODINGS, \
+        'Unsupported image encoding {}'.format(msg.encoding)
+    dtype, channels = IMAGE_ENCODINGS[msg.encoding]
+    dtype = np.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
+    row = msg.width * channels
+    # Rows can be padded up to msg.step bytes
+    data = np.frombuffer(msg.data, dtype=dtype,
+                         count=msg.height * msg.step // dtype.itemsize)
+    data = data.reshape(msg.height, -1)[:, :row]
+    if channels == 1:
+        return data
+    return data.reshape(msg.height, msg.width, channels)
+
+
+def sharpness(rgb):
+    """
+    Variance of the Laplacian of the green channel, on every other pixel.
+
+    :param rgb: RGB image
+    :type rgb: np.ndarray
+
+    :returns: Focus measure, larger for sharper images
+    :rtype: float
+    """
+    g = rgb[::2, ::2, 1].astype(np.float32)
+    lap = (4 * g[1:-1, 1:-1] - g[:-2, 1:-1] - g[2:, 1:-1] -
+           g[1:-1, :-2] - g[1:-1, 2:])
+    return float(lap.var())
+
+
+class RGBDSnapshot(object):
+    """
+    This class holds a consistent RGB-D pair copied out of the buffer.
+    """
+
+    def __init__(self, stamp, rgb, depth):
+        """
+        The constructor for :class:`RGBDSnapshot` class.
+
+        :param stamp: Time of the color frame in seconds
+        :param rgb: RGB image
+        :param depth: Depth image in the encoding it was published in
+        :type stamp: float
+        :type rgb: np.ndarray
+        :type depth: np.ndarray
+        """
+        self.stamp = stamp
+        self.rgb = rgb
+        self.depth = depth
+
+
+class RGBDRingBuffer(object):
+    """
+    This class keeps the last few synchronized RGB-D pairs in preallocated
+    slots.
+    """
+
+    def __init__(self, capacity=FRAME_BUFFER_SIZE):
+        """
+        The constructor for :class:`RGBDRingBuffer` class.
+
+        :param capacity: Number of frame pairs kept
+        :type capacity: int
+        """
+        self.capacity = capacity
+        self._rgb = None
+        self._depth = None
+        self._stamps = np.full(capacity, -np.inf)
+        self._bgr = False
+        self._next = 0
+        self._cond = threading.Condition()
+
+    def _allocate(self, rgb, depth):
+        self._rgb = np.empty((self.capacity,) + rgb.shape, dtype=np.uint8)
+        self._depth = np.empty((self.capacity,) + depth.shape,
+                               dtype=depth.dtype.newbyteorder('='))
+        self._stamps[:] = -np.inf
+
+    def push(self, stamp, image_msg, depth_msg):
+        """
+        Copies a synchronized pair of image messages into the oldest slot.
+
+        :param stamp: Time of the color frame in seconds
+        :param image_msg: rgb8 or bgr8 color image
+        :param depth_msg: Depth image aligned to the color image
+        :type stamp: float
+        :type image_msg: sensor_msgs.msg.Image
+        :type depth_msg: sensor_msgs.msg.Image
+        """
+        rgb = image_msg_view(image_msg)
+        depth = image_msg_view(depth_msg)
+        with self._cond:
+            if (self._rgb is None or self._rgb.shape[1:] != rgb.shape or
+                    self._depth.shape[1:] != depth.shape or
+                    self._depth.dtype != depth.dtype.newbyteorder('=')):
+                # Only on the first frame or when the camera is reconfigured
+                self._allocate(rgb, depth)
+            self._bgr = image_msg.encoding == 'bgr8'
+            i = self._next
+            self._rgb[i] = rgb
+            self._depth[i] = depth
+            self._stamps[i] = stamp
+            self._next = (i + 1) % self.capacity
+            self._cond.notify_all()
+
+    def newest_stamp(self):
+        """
+        :returns: Time of the newest pair, -inf if there is none
+        :rtype: float
+        """
+        with self._cond:
+            return self._stamps.max()
+
+    def _wait_for(self, after, timeout):
+        # Returns the slots stamped at or after `after`, newest first. Empty
+        # slots are stamped -inf
+        deadline = time.time() + timeout
+        while True:
+            slots = np.nonzero((self._stamps >= after) &
+                               (self._stamps > -np.inf))[0]
+            remaining = deadline - time.time()
+            if len(slots) > 0 or remaining <= 0:
+                return slots[np.argsort(-self._stamps[slots])]
+            self._cond.wait(remaining)
+
+    def _snapshot(self, i):
+        rgb = self._rgb[i][:, :, ::-1] if self._bgr else self._rgb[i]
+        return RGBDSnapshot(self._stamps[i], rgb.copy(), self._depth[i].copy())
+
+    def latest(self, after=-np.inf, timeout=0.):
+        """
+        Returns the newest pair.
+
+        :param after: Only consider pairs stamped at or after this time
+        :param timeout: Seconds to wait for such a pair to arrive
+        :type after: float
+        :type timeout: float
+
+        :returns: The newest pair, None if there is none
+        :rtype: RGBDSnapshot
+        """
+        with self._cond:
+            slots = self._wait_for(after, timeout)
+            if len(slots) == 0:
+                return None
+            return self._snapshot(slots[0])
+
+    def sharpest(self, after=-np.inf, timeout=0.):
+        """
+        Returns the pair whose color image is the least blurred.
+
+        :param after: Only consider pairs stamped at or after this time
+        :param timeout: Seconds to wait for such a pair to arrive
+        :type after: float
+        :type timeout: float
+
+        :returns: The sharpest pair, None if there is none
+        :rtype: RGBDSnapshot
+        """
+        with self._cond:
+            slots = self._wait_for(after, timeout)
+            if len(slots) == 0:
+                return None
+            scores = [sharpness(self._rgb[i]) for i in slots]
+            return self._snapshot(slots[int(np.argmax(scores))])
+
+
+class StillnessMonitor(object):
+    """
+    This class tracks since when the arm joints have stopped moving.
+    """
+
+    def __init__(self, vel_tol=JOINT_VEL_TOL, settle_time=SETTLE_TIME):
+        """
+        The constructor for :class:`StillnessMonitor` class.
+
+        :param vel_tol: Joint speed in rad/s below which a joint is still
+        :param settle_time: Seconds the joints have to stay still
+        :type vel_tol: float
+        :type settle_time: float
+        """
+        self.vel_tol = vel_tol
+        self.settle_time = settle_time
+        self._positions = {}
+        self._last_motion = None
+        self._lock = threading.Lock()
+
+    def update(self, stamp, names, positions):
+        """
+        Adds a joint state.
+
+        :param stamp: Time of the joint state in seconds
+        :param names: Joint names
+        :param positions: Joint positions
+        :type stamp: float
+        :type names: list
+        :type positions: list
+        """
+        with self._lock:
+            if self._last_motion is None:
+                self._last_motion = stamp
+            for name, position in zip(names, positions):
+                if name in self._positions:
+                    last_stamp, last_position = self._positions[name]
+                    dt = max(stamp - last_stamp, 1e-3)
+                    if abs(position - last_position) / dt > self.vel_tol:
+                        self._last_motion = max(self._last_motion, stamp)
+                self._positions[name] = (stamp, position)
+
+    def settled_since(self):
+        """
+        Returns the time after which the joints have been (or will be, if
+        they stay still) still for `settle_time`.
+
+        :returns: Time in seconds, None if no joint state was received
+        :rtype: float
+        """
+        with self._lock:
+            if self._last_motion is None:
+                return None
+            return self._last_motion + self.settle_time
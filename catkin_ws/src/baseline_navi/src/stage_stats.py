@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+Publishes the stage timings of a ROS node, see tracing.py.
+"""
+import os
+import sys
+
+import rospy
+from baseline_navi.msg import StageStats
+sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
+from grasp_samplers.tracing import PeriodicReporter, get_tracer, \
+    summary_columns
+
+STATS_TOPIC = 'pipeline_stats'
+STATS_PERIOD = 10.
+
+
+def start_stage_stats(node_name, topic=STATS_TOPIC, period=STATS_PERIOD):
+    """
+    Publishes the tracer summary of this node every `period` seconds. If the
+    private parameter `~trace_file` is set, the Chrome trace of the node is
+    written there on shutdown.
+
+    :param node_name: Name of the node in the summaries and the trace
+    :param topic: StageStats topic
+    :param period: Seconds between two summaries
+    :type node_name: string
+    :type topic: string
+    :type period: float
+
+    :returns: The reporter thread
+    :rtype: PeriodicReporter
+    """
+    tracer = get_tracer()
+    tracer.name = node_name
+    publisher = rospy.Publisher(topic, StageStats, queue_size=1)
+
+    def publish(summary):
+        if summary:
+            publisher.publish(StageStats(node=node_name,
+                                         **summary_columns(summary)))
+
+    trace_file = rospy.get_param('~trace_file', '')
+    if trace_file:
+        rospy.on_shutdown(lambda: tracer.dump_chrome_trace(trace_file))
+    return PeriodicReporter(tracer, publish, period)
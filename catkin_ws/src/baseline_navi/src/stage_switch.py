@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+import os
+import sys
 import rospy
 import actionlib
 from baseline_navi.srv import Stage_Grasp, Stage_GraspResponse
@@ -10,6 +12,9 @@ from tf import transformations
 import tf2_ros
 import tf2_geometry_msgs
 from std_msgs.msg import Int32
+from stage_stats import start_stage_stats
+sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
+from grasp_samplers.tracing import span
 
 
 class StageSwitch(object):
@@ -30,17 +35,22 @@ class StageSwitch(object):
 
     def start_cb(self, start_msg):
         if start_msg.data == 1:
+            with span('cycle'):
+                self.run_cycle()
+
+    def run_cycle(self):
+        with span('stage_grasp_0'):
             self.grasp_service(0)  # reset for arm and camera
+        with span('stage_grasp_1'):
             self.grasp_service(1)  # grasp object
-            self.set_goal_euler([0, 0, 0], [0, 0, 1.57])  # turn back
-            coordinate = self.totag_service(True)  # get apriltag's coordinate
-            self.set_goal_quaternion(coordinate, 0.5)
-            coordinate = self.totag_service(True)  # get apriltag's coordinate
-            self.set_goal_quaternion(coordinate, 0.75)
-            coordinate = self.totag_service(True)  # get apriltag's coordinate
-            self.set_goal_quaternion(coordinate)
+        self.set_goal_euler([0, 0, 0], [0, 0, 1.57])  # turn back
+        for weight in [0.5, 0.75, 1]:
+            with span('stage_totag'):
+                coordinate = self.totag_service(True)  # get apriltag's coordinate
+            self.set_goal_quaternion(coordinate, weight)
+        with span('stage_grasp_3'):
             self.grasp_service(3)  # get back to original place
-            self.set_goal_euler([0, 0, 0], [0, 0, 0])
+        self.set_goal_euler([0, 0, 0], [0, 0, 0])
 
     def set_goal_euler(self, translation, rotation, weight=1):
         self.goal.target_pose.pose.position.x = translation[0] * weight
@@ -51,8 +61,9 @@ class StageSwitch(object):
         self.goal.target_pose.pose.orientation.y = y
         self.goal.target_pose.pose.orientation.z = z
         self.goal.target_pose.pose.orientation.w = w
-        self.client.send_goal(self.goal)
-        self.client.wait_for_result()
+        with span('nav_goal'):
+            self.client.send_goal(self.goal)
+            self.client.wait_for_result()
 
     def set_goal_quaternion(self, coordinate, weight=1):
         self.goal.target_pose.pose.position.x = coordinate.x * weight
@@ -62,11 +73,13 @@ class StageSwitch(object):
         self.goal.target_pose.pose.orientation.y = coordinate.ry
         self.goal.target_pose.pose.orientation.z = coordinate.rz
         self.goal.target_pose.pose.orientation.w = coordinate.rw
-        self.client.send_goal(self.goal)
-        self.client.wait_for_result()
+        with span('nav_goal'):
+            self.client.send_goal(self.goal)
+            self.client.wait_for_result()
 
 
 if __name__ == "__main__":
     rospy.init_node('stage_switch')
     stage_switch = StageSwitch()
+    start_stage_stats('stage_switch')
     rospy.spin()
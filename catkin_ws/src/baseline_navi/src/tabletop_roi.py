@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Segmentation of the objects standing on a table from an aligned depth image,
+used to restrict where the grasp model samples patches.
+
+The dominant plane of the depth points is fitted with RANSAC, pixels standing
+between `MIN_HEIGHT` and `MAX_HEIGHT` above it are kept, and connected
+components smaller than `MIN_AREA` pixels are dropped as noise.
+
+Kept free of ROS imports so that it can be used on recorded frames.
+"""
+
+import cv2
+import numpy as np
+from grasp_geometry import MAX_DEPTH, MIN_DEPTH
+
+PLANE_STRIDE = 4
+RANSAC_ITERATIONS = 100
+PLANE_TOLERANCE = 0.01
+# Heights above the table of the graspable objects, in meters
+MIN_HEIGHT = 0.015
+MAX_HEIGHT = 0.25
+MIN_AREA = 150
+ROI_MARGIN = 20
+
+
+def depth_points(depth, camera, stride=1,
+                 min_depth=MIN_DEPTH, max_depth=MAX_DEPTH):
+    """
+    Back-projects a regular grid of depth pixels into the camera frame.
+
+    :param depth: Depth image in meters
+    :param camera: Model of the camera the depth image is aligned with
+    :param stride: Distance in pixels between grid points
+    :param min_depth: Depths up to this value are invalid
+    :param max_depth: Depths above this value are invalid
+    :type depth: np.ndarray
+    :type camera: CameraModel
+    :type stride: int
+    :type min_depth: float
+    :type max_depth: float
+
+    :returns: Points of shape (H', W', 3) and whether each is valid
+    :rtype: tuple
+    """
+    z = depth[::stride, ::stride].astype(np.float64)
+    rows, cols = np.mgrid[0:depth.shape[0]:stride, 0:depth.shape[1]:stride]
+    # NaNs fail both comparisons
+    valid = (z > min_depth) & (z <= max_depth)
+    pts = np.stack([rows.ravel(), cols.ravel()], axis=1)
+    points = camera.back_project(pts, np.where(valid, z, 1.).ravel())
+    return points.reshape(z.shape + (3,)), valid
+
+
+def fit_plane(points, iterations=RANSAC_ITERATIONS,
+              tolerance=PLANE_TOLERANCE, rng=None):
+    """
+    Fits the dominant plane of a point cloud with RANSAC, then refines it by
+    least squares on its inliers.
+
+    :param points: Points of shape (N, 3)
+    :param iterations: Number of RANSAC hypotheses
+    :param tolerance: Distance under which a point is an inlier
+    :param rng: Random state of the hypotheses, seeded by default so that
+                the segmentation of a frame is reproducible
+    :type points: np.ndarray
+    :type iterations: int
+    :type tolerance: float
+    :type rng: np.random.RandomState
+
+    :returns: Unit normal `n` and offset `d` of the plane n.p + d = 0,
+              oriented towards the camera (d > 0), or None
+    :rtype: tuple
+    """
+    if len(points) < 3:
+        return None
+    if rng is None:
+        rng = np.random.RandomState(0)
+    best_inliers = None
+    for _ in range(iterations):
+        p0, p1, p2 = points[rng.choice(len(points), 3, replace=False)]
+        normal = np.cross(p1 - p0, p2 - p0)
+        norm = np.linalg.norm(normal)
+        if norm < 1e-9:
+            continue
+        normal /= norm
+        inliers = np.abs(points.dot(normal) - normal.dot(p0)) < tolerance
+        if best_inliers is None or inliers.sum() > best_inliers.sum():
+            best_inliers = inliers
+    if best_inliers is None or best_inliers.sum() < 3:
+        return None
+    inlier_points = points[best_inliers]
+    centroid = inlier_points.mean(0)
+    centered = inlier_points - centroid
+    # Direction of least variance of the inliers
+    normal = np.linalg.eigh(centered.T.dot(centered))[1][:, 0]
+    d = -normal.dot(centroid)
+    if d < 0:
+        normal, d = -normal, -d
+    return normal, d
+
+
+class TabletopROI(object):
+    """
+    This class holds the objects segmented on a table.
+    """
+
+    def __init__(self, mask, boxes, plane):
+        """
+        The constructor for :class:`TabletopROI` class.
+
+        :param mask: Pixels of the objects
+        :param boxes: Bounding box (x, y, width, height) of every object
+        :param plane: Normal and offset of the table plane, or None
+        :type mask: np.ndarray
+        :type boxes: list
+        :type plane: tuple
+        """
+        self.mask = mask
+        self.boxes = boxes
+        self.plane = plane
+
+    def crop(self, min_size, margin=ROI_MARGIN):
+        """
+        Computes a crop around every object, grown to at least `min_size`
+        pixels on both sides and clipped to the image.
+
+        :param min_size: Smallest crop side, in pixels
+        :param margin: Pixels added around the objects
+        :type min_size: int
+        :type margin: int
+
+        :returns: Crop as [[row_min, row_max], [col_min, col_max]], or None
+                  if no object was found
+        :rtype: list
+        """
+        if not self.boxes:
+            return None
+        boxes = np.array(self.boxes)
+        crop = []
+        for start, end, size in [
+                (boxes[:, 1].min(), (boxes[:, 1] + boxes[:, 3]).max(),
+                 self.mask.shape[0]),
+                (boxes[:, 0].min(), (boxes[:, 0] + boxes[:, 2]).max(),
+                 self.mask.shape[1])]:
+            start, end = start - margin, end + margin
+            grow = max(min_size - (end - start), 0)
+            start, end = start - grow // 2, end + grow - grow // 2
+            # Shifted back inside the image before clipping
+            shift = max(-start, 0) - max(end - size, 0)
+            crop.append([int(max(start + shift, 0)),
+                         int(min(end + shift, size))])
+        return crop
+
+
+def segment_tabletop(depth, camera, min_height=MIN_HEIGHT,
+                     max_height=MAX_HEIGHT, min_area=MIN_AREA,
+                     stride=PLANE_STRIDE, rng=None):
+    """
+    Segments the objects standing on the dominant plane of a depth image.
+
+    :param depth: Depth image in meters
+    :param camera: Model of the camera the depth image is aligned with
+    :param min_height: Smallest height above the table of an object pixel
+    :param max_height: Largest height above the table of an object pixel
+    :param min_area: Smallest number of pixels of an object
+    :param stride: Distance in pixels between the points the plane is
+                   fitted on
+    :param rng: Random state of the plane fit
+    :type depth: np.ndarray
+    :type camera: CameraModel
+    :type min_height: float
+    :type max_height: float
+    :type min_area: int
+    :type stride: int
+    :type rng: np.random.RandomState
+
+    :returns: The segmented objects, with an empty mask if no plane is found
+    :rtype: TabletopROI
+    """
+    points, valid = depth_points(depth, camera, stride)
+    plane = fit_plane(points[valid], rng=rng)
+    if plane is None:
+        return TabletopROI(np.zeros(depth.shape[:2], dtype=bool), [], None)
+    normal, d = plane
+    points, valid = depth_points(depth, camera)
+    heights = points.dot(normal) + d
+    candidates = (valid & (heights > min_height) &
+                  (heights < max_height)).astype(np.uint8)
+    # Removes the speckles of the depth noise at the table height
+    candidates = cv2.morphologyEx(candidates, cv2.MORPH_OPEN,
+                                  np.ones((3, 3), np.uint8))
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(candidates,
+                                                           connectivity=8)
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    # Label 0 is the background
+    keep[0] = False
+    boxes = [tuple(int(v) for v in box) for box in stats[keep, :4]]
+    return TabletopROI(keep[labels], boxes, plane)
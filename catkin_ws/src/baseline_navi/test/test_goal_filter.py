@@ -0,0 +1,121 @@
+import os
+import sys
+
+import numpy as np
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+from goal_filter import GoalEstimator, TagDetection, TagGoalTracker, \
+    compose, quaternion_multiply, quaternion_rotate
+
+# 90 degrees around z
+QUARTER_Z = np.array([0., 0., np.sqrt(.5), np.sqrt(.5)])
+IDENTITY = np.array([0., 0., 0., 1.])
+
+
+def rotation_matrix(q):
+    x, y, z, w = q
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+
+
+def test_quaternion_rotate():
+    assert np.allclose(quaternion_rotate(QUARTER_Z, [1., 0., 0.]),
+                       [0., 1., 0.])
+    assert np.allclose(quaternion_rotate(QUARTER_Z, [0., 1., 2.]),
+                       [-1., 0., 2.])
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        q = rng.normal(size=4)
+        q /= np.linalg.norm(q)
+        v = rng.normal(size=3)
+        assert np.allclose(quaternion_rotate(q, v), rotation_matrix(q).dot(v))
+        # Many vectors at once
+        vs = rng.normal(size=(5, 3))
+        assert np.allclose(quaternion_rotate(q, vs),
+                           vs.dot(rotation_matrix(q).T))
+
+
+def test_compose():
+    p, q = compose([1., 2., 3.], QUARTER_Z, [1., 0., 0.], QUARTER_Z)
+    assert np.allclose(p, [1., 3., 3.])
+    # 180 degrees around z
+    assert np.allclose(rotation_matrix(q), np.diag([-1., -1., 1.]))
+    rng = np.random.RandomState(0)
+    q1, q2 = [q / np.linalg.norm(q) for q in rng.normal(size=(2, 4))]
+    p1, p2 = rng.normal(size=(2, 3))
+    p, q = compose(p1, q1, p2, q2)
+    assert np.allclose(p, p1 + rotation_matrix(q1).dot(p2))
+    assert np.allclose(rotation_matrix(q),
+                       rotation_matrix(q1).dot(rotation_matrix(q2)))
+    assert np.allclose(quaternion_multiply(q1, IDENTITY), q1)
+
+
+def test_goal_estimator_gating():
+    estimator = GoalEstimator(gate=0.15, smoothing=0.5, max_rejections=3)
+    assert not estimator.is_fresh(0., 1.)
+    assert estimator.update(0., [1., 0., 0.], 2 * IDENTITY)
+    assert np.allclose(estimator.position, [1., 0., 0.])
+    # Orientations are normalized
+    assert np.allclose(estimator.orientation, IDENTITY)
+    assert estimator.update(1., [1.1, 0., 0.], -IDENTITY)
+    assert np.allclose(estimator.position, [1.05, 0., 0.])
+    # -q is the same rotation as q and is not averaged to zero
+    assert np.allclose(estimator.orientation, IDENTITY)
+    assert estimator.version == 2
+    assert estimator.is_fresh(1.5, 1.) and not estimator.is_fresh(2.5, 1.)
+
+    # Jumps are rejected and leave the estimate unchanged
+    assert not estimator.update(2., [2., 0., 0.], IDENTITY)
+    assert estimator.rejections == 1
+    assert np.allclose(estimator.position, [1.05, 0., 0.])
+    assert estimator.stamp == 1. and estimator.version == 2
+    # An accepted detection resets the rejection count
+    assert estimator.update(3., [1.05, 0.1, 0.], IDENTITY)
+    assert estimator.rejections == 0
+
+
+def test_goal_estimator_restarts_after_rejections():
+    estimator = GoalEstimator(gate=0.15, smoothing=0.5, max_rejections=3)
+    estimator.update(0., [0., 0., 0.], IDENTITY)
+    for i in range(3):
+        assert not estimator.update(1. + i, [1., 0., 0.], QUARTER_Z)
+    # The goal did move: the estimate restarts from the next detection
+    assert estimator.update(4., [1., 0., 0.], QUARTER_Z)
+    assert np.allclose(estimator.position, [1., 0., 0.])
+    assert np.allclose(estimator.orientation, QUARTER_Z)
+    assert estimator.rejections == 0 and estimator.stamp == 4.
+
+
+def test_tag_goal_tracker():
+    # Camera 1m above the odom origin, turned 90 degrees around z
+    odom_camera = (np.array([0., 0., 1.]), QUARTER_Z)
+
+    def lookup_odom(frame, stamp):
+        return odom_camera if frame == 'camera' else None
+
+    tracker = TagGoalTracker(lookup_odom, tag_id=1,
+                             offset=(np.array([0., 0., 0.5]), IDENTITY))
+    detections = [TagDetection(2, 'camera', 1., [1., 0., 0.], IDENTITY),
+                  TagDetection(1, 'unknown', 1., [1., 0., 0.], IDENTITY),
+                  TagDetection(1, 'camera', 1., [1., 0., 0.], IDENTITY)]
+    goals = tracker.update(detections)
+    assert len(goals) == 1
+    stamp, position, orientation = goals[0]
+    assert stamp == 1.
+    assert np.allclose(position, [0., 1., 1.5])
+    assert np.allclose(orientation, QUARTER_Z)
+    # Rejected by the gate
+    assert tracker.update([TagDetection(1, 'camera', 2., [3., 0., 0.],
+                                        IDENTITY)]) == []
+
+
+if __name__ == "__main__":
+    test_quaternion_rotate()
+    test_compose()
+    test_goal_estimator_gating()
+    test_goal_estimator_restarts_after_rejections()
+    test_tag_goal_tracker()
+    print("Goal filter tests passed")
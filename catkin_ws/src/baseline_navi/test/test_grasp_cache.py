@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+from grasp_cache import GraspCache, SceneSignature
+
+
+def random_scene(rng, shape=(240, 320)):
+    # Smooth enough that a few changed pixels stay local after resizing
+    rgb = np.kron(rng.randint(0, 255, (shape[0] // 8, shape[1] // 8, 3)),
+                  np.ones((8, 8, 1))).astype(np.uint8)
+    depth = np.full(shape, 0.6, dtype=np.float32)
+    depth[60:120, 100:160] = 0.5
+    return rgb, depth
+
+
+def test_signature_changes():
+    rng = np.random.RandomState(0)
+    rgb, depth = random_scene(rng)
+    signature = SceneSignature(rgb, depth)
+    assert signature.changed_fraction(SceneSignature(rgb, depth)) == 0.
+    assert signature.key == SceneSignature(rgb, depth).key
+
+    # Sensor noise and missing depths are not a scene change
+    noisy = np.clip(rgb + rng.randint(-3, 4, rgb.shape), 0,
+                    255).astype(np.uint8)
+    holes = depth.copy()
+    holes[0, :5] = np.nan
+    assert signature.changed_fraction(SceneSignature(noisy, holes)) <= 0.02
+
+    # A displaced object is
+    moved = depth.copy()
+    moved[60:120, 100:160] = 0.6
+    moved[150:210, 200:260] = 0.5
+    assert signature.changed_fraction(SceneSignature(rgb, moved)) > 0.02
+
+    # Crops of different sizes never match
+    assert signature.changed_fraction(
+        SceneSignature(rgb[:200], depth[:200])) == 1.
+
+
+def test_grasp_cache():
+    rng = np.random.RandomState(1)
+    cache = GraspCache(capacity=2)
+    cache.set_epoch(0.)
+    scenes = [SceneSignature(*random_scene(rng)) for _ in range(3)]
+    assert cache.lookup(scenes[0]) is None
+    cache.store(scenes[0], 'a')
+    cache.store(scenes[1], 'b')
+    assert cache.lookup(scenes[0]) == ('a', 0.)
+    # The least recently used scene is evicted
+    cache.store(scenes[2], 'c')
+    assert len(cache) == 2
+    assert cache.lookup(scenes[1]) is None
+    assert cache.lookup(scenes[2]) == ('c', 0.)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # The grasps are tied to the camera pose
+    cache.set_epoch(0.)
+    assert len(cache) == 2
+    cache.set_epoch(1.)
+    assert len(cache) == 0
+
+
+if __name__ == "__main__":
+    test_signature_changes()
+    test_grasp_cache()
+    print("Grasp cache tests passed")
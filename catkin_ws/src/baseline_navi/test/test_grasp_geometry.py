@@ -0,0 +1,122 @@
+import os
+import sys
+
+import numpy as np
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+from grasp_geometry import BB_SIZE, MAX_DEPTH, MIN_DEPTH, CameraModel, \
+    window_depth_means, within_reach
+
+P = [615., 0., 321., 0.01, 0., 614., 243., 0.02, 0., 0., 1., 0.001]
+
+
+def loop_z_mean(depth, pt, bb=BB_SIZE):
+    # Per-point loop of the grasp node before window_depth_means, with the
+    # depths above MAX_DEPTH zeroed beforehand like it did
+    depth = depth.copy()
+    depth[depth > MAX_DEPTH] = 0.
+    sum_z = 0.
+    nps = 0
+    for i in range(bb * 2):
+        for j in range(bb * 2):
+            new_pt = [pt[0] - bb + i, pt[1] - bb + j]
+            try:
+                new_z = depth[int(new_pt[0]), int(new_pt[1])]
+                if new_z > MIN_DEPTH:
+                    sum_z += new_z
+                    nps += 1
+            except IndexError:
+                pass
+    if nps == 0.:
+        return 0.
+    else:
+        return sum_z / nps
+
+
+def loop_back_project(P, pt, z):
+    # Per-point back-projection of the grasp node before CameraModel
+    P = np.array(P).reshape(3, 4)
+    u = pt[1]
+    v = pt[0]
+    P_n = np.zeros((3, 3))
+    P_n[:, :2] = P[:, :2]
+    P_n[:, 2] = P[:, 3] + P[:, 2] * z
+    P_n_inv = np.linalg.inv(P_n)
+    temp_p = np.dot(P_n_inv, np.array([u, v, 1]))
+    temp_p = temp_p / temp_p[-1]
+    temp_p[-1] = z
+    return temp_p
+
+
+def random_depth(rng, shape=(120, 160)):
+    depth = rng.uniform(0.3, 1.5, shape).astype(np.float32)
+    # Missing, too close, too far and NaN pixels
+    for value in [0., 0.05, MAX_DEPTH + 1., np.nan]:
+        depth[rng.rand(*shape) < 0.1] = value
+    # A window without any valid pixel
+    depth[50:70, 50:70] = 0.
+    return depth
+
+
+def test_window_depth_means_matches_loop():
+    rng = np.random.RandomState(0)
+    depth = random_depth(rng)
+    original = depth.copy()
+    pts = np.stack([rng.randint(BB_SIZE, depth.shape[0] - BB_SIZE, 200),
+                    rng.randint(BB_SIZE, depth.shape[1] - BB_SIZE, 200)],
+                   axis=1)
+    pts = np.concatenate([pts, [[60, 60]]])
+    zs = window_depth_means(depth, pts)
+    expected = [loop_z_mean(depth, pt) for pt in pts]
+    assert np.allclose(zs, expected, rtol=1e-6)
+    assert zs[-1] == 0.
+    # The depth image is not modified
+    assert np.array_equal(depth, original, equal_nan=True)
+
+
+def test_window_depth_means_at_the_edges():
+    rng = np.random.RandomState(1)
+    depth = random_depth(rng)
+    h, w = depth.shape
+    pts = np.array([[0, 0], [2, w - 1], [h - 1, 3], [h - 3, w - 2]])
+    zs = window_depth_means(depth, pts)
+    for pt, z in zip(pts, zs):
+        # The loop wrapped negative indices around the image, the windows
+        # are now cut at the edges
+        rows = np.arange(pt[0] - BB_SIZE, pt[0] + BB_SIZE)
+        cols = np.arange(pt[1] - BB_SIZE, pt[1] + BB_SIZE)
+        window = depth[rows[(rows >= 0) & (rows < h)]][
+            :, cols[(cols >= 0) & (cols < w)]]
+        valid = (window > MIN_DEPTH) & (window <= MAX_DEPTH)
+        assert np.isclose(z, window[valid].mean(), rtol=1e-6)
+
+
+def test_back_project_matches_loop():
+    rng = np.random.RandomState(0)
+    pts = np.stack([rng.randint(0, 480, 50), rng.randint(0, 640, 50)],
+                   axis=1)
+    zs = rng.uniform(0.2, 2., 50)
+    points = CameraModel(P).back_project(pts, zs)
+    assert points.shape == (50, 3)
+    for pt, z, point in zip(pts, zs, points):
+        assert np.allclose(point, loop_back_project(P, pt, z))
+    # Projecting the points back gives the pixels
+    projected = np.hstack([points, np.ones((50, 1))]).dot(
+        np.array(P).reshape(3, 4).T)
+    assert np.allclose(projected[:, 1] / projected[:, 2], pts[:, 0],
+                       atol=0.05)
+
+
+def test_within_reach():
+    points = np.array([[0.3, 0., 0.], [0.05, 0., 0.], [0.5, 0., 0.],
+                       [0.2, 0.3, 0.1], [-0.3, 0., 0.]])
+    assert within_reach(points).tolist() == [True, False, False, True, False]
+
+
+if __name__ == "__main__":
+    test_window_depth_means_matches_loop()
+    test_window_depth_means_at_the_edges()
+    test_back_project_matches_loop()
+    test_within_reach()
+    print("Grasp geometry tests passed")
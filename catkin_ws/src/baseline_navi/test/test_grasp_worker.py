@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+from grasp_worker import SpeculativeGraspWorker
+
+POLL_PERIOD = 0.001
+TIMEOUT = 2.
+
+
+def wait_until(condition):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(POLL_PERIOD)
+
+
+class FakeNode(object):
+    def __init__(self):
+        self.now = 10.
+        self.key = None
+        self.fail = False
+        self.calls = 0
+        self.warnings = []
+
+    def clock(self):
+        return self.now
+
+    def ready(self):
+        return self.key
+
+    def compute(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError('No grasp')
+        return self.now, 'grasp {}'.format(self.calls)
+
+
+def test_computes_once_per_key():
+    node = FakeNode()
+    worker = SpeculativeGraspWorker(node.compute, node.ready,
+                                    clock=node.clock,
+                                    poll_period=POLL_PERIOD,
+                                    warn=node.warnings.append)
+    worker.start()
+    try:
+        time.sleep(20 * POLL_PERIOD)
+        assert node.calls == 0 and worker.latest() is None
+
+        node.key = 9.
+        wait_until(lambda: worker.num_computed == 1)
+        # Nothing runs while the camera stays still
+        node.now = 30.
+        time.sleep(20 * POLL_PERIOD)
+        assert node.calls == 1
+        result = worker.latest(max_age=100.)
+        assert (result.version, result.key, result.value) == \
+            (1, 9., 'grasp 1')
+        assert result.stamp == 10.
+        assert worker.latest(max_age=5.) is None
+        assert worker.latest(min_stamp=11., max_age=100.) is None
+
+        node.key = 29.
+        wait_until(lambda: worker.num_computed == 2)
+        assert worker.latest().version == 2
+
+        # A failure is logged and not retried until the next key
+        node.fail = True
+        node.key = 31.
+        wait_until(lambda: worker.num_failed == 1)
+        time.sleep(20 * POLL_PERIOD)
+        assert node.calls == 3
+        assert node.warnings == ['Speculative grasp failed: No grasp']
+        assert worker.latest().version == 2
+        node.fail = False
+        node.key = 32.
+        wait_until(lambda: worker.num_computed == 3)
+    finally:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    test_computes_once_per_key()
+    print("Grasp worker tests passed")
@@ -0,0 +1,153 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.join(test_dir, '..', '..', '..', '..')
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+sys.path.append(os.path.join(repo_dir, 'third_party'))
+# grasp_object imports deeper_models as a top-level module
+sys.path.append(os.path.join(repo_dir, 'third_party', 'grasp_samplers'))
+sys.path.append(os.path.join(repo_dir, 'third_party', 'grasp_samplers', 'test'))
+from goal_filter import ODOM_FRAME, TagDetection, TagGoalTracker
+from grasp_geometry import CameraModel
+from grasp_pipeline import BASE_FRAME, KINECT_FRAME, GraspPipeline
+from perception_log import PerceptionLog, PerceptionLogWriter
+from perception_replay import RecordedTF, quiet_log, replay
+from grasp_samplers.grasp_model import GraspModel
+from model_fixtures import random_model
+
+HEIGHT = 480
+WIDTH = 640
+TABLE_DEPTH = 0.6
+P = [500., 0., WIDTH / 2., 0., 0., 500., HEIGHT / 2., 0., 0., 0., 1., 0.]
+# Camera looking down at the table in front of the base
+BASE_CAMERA = ([0.3, 0., TABLE_DEPTH],
+               [np.sqrt(.5), -np.sqrt(.5), 0., 0.])
+TAG_FRAME = 'camera_link'
+ODOM_CAMERA = ([1., 0., 0.5], [0., 0., 0., 1.])
+NUM_FRAMES = 3
+
+
+def tabletop_frame(rng):
+    depth = np.full((HEIGHT, WIDTH), TABLE_DEPTH, dtype=np.float32)
+    depth[300:360, 280:360] = TABLE_DEPTH - 0.05
+    rgb = rng.randint(0, 255, (HEIGHT, WIDTH, 3)).astype(np.uint8)
+    rgb[300:360, 280:360] = [200, 30, 30]
+    return rgb, depth
+
+
+def write_recording(path):
+    """
+    Writes frames and tag detections, and then a frame cut off while it was
+    being written, like an interrupted recording.
+    """
+    rng = np.random.RandomState(0)
+    writer = PerceptionLogWriter(path)
+    for i in range(NUM_FRAMES):
+        stamp = 10. + i
+        rgb, depth = tabletop_frame(rng)
+        writer.write_frame(stamp, rgb, depth, P,
+                           {(BASE_FRAME, KINECT_FRAME): BASE_CAMERA})
+        tag = TagDetection(1, TAG_FRAME, stamp + 0.5,
+                           [0., 0., 1. + 0.01 * i], [0., 0., 0., 1.])
+        writer.write_tags(stamp + 0.5, [tag],
+                          {(ODOM_FRAME, TAG_FRAME): ODOM_CAMERA})
+    rgb, depth = tabletop_frame(rng)
+    writer.write_frame(20., rgb, depth, P,
+                       {(BASE_FRAME, KINECT_FRAME): BASE_CAMERA})
+    writer.close()
+    rgb_path = os.path.join(path, 'rgb.bin')
+    with open(rgb_path, 'r+b') as f:
+        f.truncate(os.path.getsize(rgb_path) - 100)
+    with open(os.path.join(path, 'records.jsonl'), 'a') as f:
+        f.write('{"type": "tags", "sta')
+
+
+def run_replay(recording, model_path):
+    grasp_model = GraspModel(model_name=model_path, nsamples=20,
+                             patchsize=100, warmup=False, n_candidates=3)
+    tf = RecordedTF()
+    pipeline = GraspPipeline(grasp_model, 100, tf.lookup_transform,
+                             log=quiet_log)
+    tracker = TagGoalTracker(tf.lookup_odom)
+    return list(replay(recording, pipeline, tracker, tf))
+
+
+def test_record_and_replay():
+    path = tempfile.mkdtemp()
+    try:
+        write_recording(path)
+        recording = PerceptionLog(path)
+        assert recording.num_frames == NUM_FRAMES
+        frames = [record for record in recording.records
+                  if record['type'] == 'frame']
+        assert [record['index'] for record in frames] == \
+            list(range(NUM_FRAMES))
+        assert len(recording) == 2 * NUM_FRAMES
+        rgb, depth = tabletop_frame(np.random.RandomState(0))
+        assert np.array_equal(recording.frame(frames[0])[0], rgb)
+        assert np.array_equal(recording.frame(frames[0])[1], depth)
+
+        with random_model() as (_, model_path):
+            results = run_replay(recording, model_path)
+            # Patch sampling is seeded per frame
+            again = run_replay(recording, model_path)
+        frame_results = [result for result in results
+                         if result['type'] == 'frame']
+        assert len(frame_results) == NUM_FRAMES
+        for result, other in zip(frame_results,
+                                 [r for r in again if r['type'] == 'frame']):
+            assert 'error' not in result
+            assert result['candidates']
+            assert result['candidates'] == other['candidates']
+            for x, y, theta, score, color in result['candidates']:
+                assert 0.12 <= np.hypot(x, y) <= 0.45
+                assert color in ['red', 'green', 'blue']
+
+        goals = [result['goals'] for result in results
+                 if result['type'] == 'tags']
+        assert len(goals) == NUM_FRAMES
+        for goal in goals:
+            assert len(goal) == 1
+        # Goal 0.5m in front of the tag, 1m in front of the camera
+        assert np.allclose(goals[0][0][1], [1., 0., 2.])
+        # The later detections are smoothed into the estimate
+        assert 2. < goals[-1][0][1][2] < 2.02
+    finally:
+        shutil.rmtree(path)
+
+
+def test_reach_limits():
+    rgb, depth = tabletop_frame(np.random.RandomState(0))
+    with random_model() as (_, model_path):
+        grasp_model = GraspModel(model_name=model_path, nsamples=20,
+                                 patchsize=100, warmup=False, n_candidates=3)
+
+        def compute(min_reach, max_reach, warnings):
+            pipeline = GraspPipeline(grasp_model, 100,
+                                     lambda target, source: BASE_CAMERA,
+                                     cache_size=0, min_reach=min_reach,
+                                     max_reach=max_reach, log=quiet_log,
+                                     warn=warnings.append)
+            np.random.seed(0)
+            candidates = pipeline.compute(rgb, depth, CameraModel(P), 10.)
+            return [np.hypot(x, y) for x, y, _, _, _ in candidates]
+
+        warnings = []
+        reaches = compute(0.12, 0.45, warnings)
+        assert reaches and not warnings
+        assert all(0.12 <= reach <= 0.45 for reach in reaches)
+        # Nothing is that far: the grasps are kept with a warning
+        reaches = compute(0.6, 0.8, warnings)
+        assert len(reaches) == grasp_model.n_candidates
+        assert all(reach < 0.6 for reach in reaches)
+        assert len(warnings) == 1
+
+if __name__ == "__main__":
+    test_record_and_replay()
+    test_reach_limits()
+    print("Perception replay tests passed")
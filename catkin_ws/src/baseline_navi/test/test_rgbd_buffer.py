@@ -0,0 +1,158 @@
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+from rgbd_buffer import RGBDRingBuffer, StillnessMonitor, image_msg_view
+
+HEIGHT = 12
+WIDTH = 10
+
+
+class FakeImage(object):
+    """
+    Stands in for sensor_msgs/Image, with rows padded to `step` bytes.
+    """
+
+    def __init__(self, image, encoding, padding=0, is_bigendian=False):
+        self.height, self.width = image.shape[:2]
+        self.encoding = encoding
+        self.is_bigendian = is_bigendian
+        image = image.astype(image.dtype.newbyteorder(
+            '>' if is_bigendian else '<'))
+        rows = image.reshape(self.height, -1).view(np.uint8)
+        self.step = rows.shape[1] + padding
+        padded = np.full((self.height, self.step), 0xff, dtype=np.uint8)
+        padded[:, :rows.shape[1]] = rows
+        self.data = padded.tobytes()
+
+
+def random_rgbd(rng):
+    rgb = rng.randint(0, 255, (HEIGHT, WIDTH, 3)).astype(np.uint8)
+    depth = rng.randint(0, 4000, (HEIGHT, WIDTH)).astype(np.uint16)
+    return rgb, depth
+
+
+def test_image_msg_view():
+    rng = np.random.RandomState(0)
+    rgb, depth = random_rgbd(rng)
+    depth_m = depth.astype(np.float32) / 1000.
+    for image, encoding, padding, is_bigendian in [
+            (rgb, 'rgb8', 0, False),
+            (rgb, 'bgr8', 2, False),
+            (depth, '16UC1', 4, False),
+            (depth, '16UC1', 6, True),
+            (depth, 'mono16', 0, True),
+            (depth_m, '32FC1', 8, False)]:
+        msg = FakeImage(image, encoding, padding, is_bigendian)
+        view = image_msg_view(msg)
+        assert view.shape == image.shape
+        assert np.array_equal(view, image)
+        # Not copied out of the message
+        assert not view.flags.owndata
+
+
+def test_ring_buffer():
+    rng = np.random.RandomState(0)
+    buffer = RGBDRingBuffer(capacity=3)
+    assert buffer.latest() is None
+    assert buffer.newest_stamp() == -np.inf
+    frames = [random_rgbd(rng) for _ in range(5)]
+    for i, (rgb, depth) in enumerate(frames):
+        buffer.push(float(i), FakeImage(rgb, 'rgb8', 2),
+                    FakeImage(depth, '16UC1', 4))
+    assert buffer.newest_stamp() == 4.
+    snapshot = buffer.latest()
+    assert snapshot.stamp == 4.
+    assert np.array_equal(snapshot.rgb, frames[4][0])
+    assert np.array_equal(snapshot.depth, frames[4][1])
+    # Snapshots are copies, not views of the slots
+    buffer.push(5., FakeImage(frames[0][0], 'rgb8'),
+                FakeImage(frames[0][1], '16UC1'))
+    assert np.array_equal(snapshot.rgb, frames[4][0])
+    assert buffer.latest(after=6.) is None
+
+    # Color frames are returned as RGB
+    buffer.push(6., FakeImage(frames[1][0][:, :, ::-1], 'bgr8'),
+                FakeImage(frames[1][1], '16UC1'))
+    assert np.array_equal(buffer.latest().rgb, frames[1][0])
+
+    # The slots are reallocated when the camera is reconfigured
+    rgb = np.zeros((HEIGHT // 2, WIDTH // 2, 3), np.uint8)
+    depth = np.zeros((HEIGHT // 2, WIDTH // 2), np.float32)
+    buffer.push(7., FakeImage(rgb, 'rgb8'), FakeImage(depth, '32FC1'))
+    snapshot = buffer.latest(after=4.)
+    assert snapshot.stamp == 7.
+    assert snapshot.depth.dtype == np.float32
+    assert buffer.latest(after=7.5) is None
+
+
+def test_ring_buffer_waits_for_frames():
+    rng = np.random.RandomState(0)
+    buffer = RGBDRingBuffer(capacity=3)
+    rgb, depth = random_rgbd(rng)
+    buffer.push(1., FakeImage(rgb, 'rgb8'), FakeImage(depth, '16UC1'))
+
+    def push_later():
+        time.sleep(0.05)
+        buffer.push(2., FakeImage(rgb, 'rgb8'), FakeImage(depth, '16UC1'))
+
+    pusher = threading.Thread(target=push_later)
+    pusher.start()
+    snapshot = buffer.latest(after=2., timeout=5.)
+    pusher.join()
+    assert snapshot.stamp == 2.
+    st_time = time.time()
+    assert buffer.sharpest(after=3., timeout=0.05) is None
+    assert time.time() - st_time >= 0.04
+
+
+def test_sharpest():
+    rng = np.random.RandomState(0)
+    buffer = RGBDRingBuffer(capacity=4)
+    sharp, depth = random_rgbd(rng)
+    # Blurred by averaging the neighbouring pixels
+    blurred = ((sharp[:, :-2].astype(int) + sharp[:, 1:-1] +
+                sharp[:, 2:]) // 3).astype(np.uint8)
+    blurred = np.concatenate([blurred, blurred[:, -2:]], axis=1)
+    flat = np.full_like(sharp, 128)
+    for stamp, rgb in [(1., blurred), (2., sharp), (3., flat)]:
+        buffer.push(stamp, FakeImage(rgb, 'rgb8'), FakeImage(depth, '16UC1'))
+    snapshot = buffer.sharpest()
+    assert snapshot.stamp == 2.
+    assert np.array_equal(snapshot.rgb, sharp)
+    # Only the frames taken after a time are considered
+    assert buffer.sharpest(after=2.5).stamp == 3.
+
+
+def test_stillness_monitor():
+    monitor = StillnessMonitor(vel_tol=0.02, settle_time=0.3)
+    assert monitor.settled_since() is None
+    names = ['joint_1', 'joint_2']
+    monitor.update(0., names, [0., 0.])
+    assert np.isclose(monitor.settled_since(), 0.3)
+    # joint_2 moves at 0.1 rad/s
+    monitor.update(1., names, [0., 0.1])
+    assert np.isclose(monitor.settled_since(), 1.3)
+    # Below the speed tolerance
+    monitor.update(2., names, [0.01, 0.1])
+    monitor.update(3., names, [0.01, 0.11])
+    assert np.isclose(monitor.settled_since(), 1.3)
+    # Joints reported separately
+    monitor.update(4., ['joint_1'], [0.5])
+    assert np.isclose(monitor.settled_since(), 4.3)
+    monitor.update(5., ['joint_2'], [0.11])
+    assert np.isclose(monitor.settled_since(), 4.3)
+
+
+if __name__ == "__main__":
+    test_image_msg_view()
+    test_ring_buffer()
+    test_ring_buffer_waits_for_frames()
+    test_sharpest()
+    test_stillness_monitor()
+    print("RGB-D buffer tests passed")
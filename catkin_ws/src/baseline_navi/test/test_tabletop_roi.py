@@ -0,0 +1,102 @@
+import os
+import sys
+
+import numpy as np
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+from grasp_geometry import CameraModel
+from tabletop_roi import MIN_AREA, TabletopROI, fit_plane, segment_tabletop
+
+HEIGHT = 480
+WIDTH = 640
+P = [500., 0., WIDTH / 2., 0., 0., 500., HEIGHT / 2., 0., 0., 0., 1., 0.]
+# Table seen from above and in front, in the camera frame
+TABLE_NORMAL = np.array([0., -0.8, -0.6])
+TABLE_OFFSET = 0.5
+
+
+def rays():
+    rows, cols = np.mgrid[0:HEIGHT, 0:WIDTH].astype(np.float64)
+    return np.stack([(cols - P[2]) / P[0], (rows - P[6]) / P[5],
+                     np.ones((HEIGHT, WIDTH))], axis=-1)
+
+
+def tabletop_depth(objects):
+    """
+    Renders the depth of the table with boxes standing on it.
+
+    :param objects: (x, y, width, height) pixel box and height above the
+                    table of the top of every object
+    """
+    n_r = rays().dot(TABLE_NORMAL)
+    heights = np.zeros((HEIGHT, WIDTH))
+    for (x, y, w, h), height in objects:
+        heights[y:y + h, x:x + w] = height
+    # Top of the objects parallel to the table
+    return ((heights - TABLE_OFFSET) / n_r).astype(np.float32)
+
+
+def test_fit_plane():
+    rng = np.random.RandomState(1)
+    n_r = rays()[::8, ::8].reshape(-1, 3)
+    points = n_r * (-TABLE_OFFSET / n_r.dot(TABLE_NORMAL))[:, np.newaxis]
+    points += rng.normal(0., 0.002, points.shape)
+    # A third of the points are clutter off the plane
+    outliers = rng.rand(len(points)) < 0.3
+    points[outliers] *= rng.uniform(0.5, 0.9, (outliers.sum(), 1))
+    normal, d = fit_plane(points)
+    assert d > 0
+    assert np.abs(normal.dot(TABLE_NORMAL)) > 0.999
+    assert np.isclose(normal.dot(TABLE_NORMAL) * d, TABLE_OFFSET, atol=0.005)
+    assert fit_plane(points[:2]) is None
+
+
+def test_segment_tabletop():
+    objects = [((280, 300, 60, 40), 0.05),
+               ((100, 250, 30, 80), 0.1),
+               # Smaller than MIN_AREA
+               ((500, 400, 10, 10), 0.05),
+               # Lower than MIN_HEIGHT
+               ((400, 300, 40, 40), 0.005),
+               # Higher than MAX_HEIGHT
+               ((450, 100, 40, 40), 0.4)]
+    assert 10 * 10 < MIN_AREA
+    depth = tabletop_depth(objects)
+    # Holes in the depth image
+    depth[10:20, 10:20] = np.nan
+    depth[20:30, 600:610] = 0.
+    roi = segment_tabletop(depth, CameraModel(P))
+    normal, d = roi.plane
+    assert np.abs(normal.dot(TABLE_NORMAL)) > 0.999
+    assert sorted(roi.boxes) == [(100, 250, 30, 80), (280, 300, 60, 40)]
+    assert roi.mask.sum() == 60 * 40 + 30 * 80
+    assert roi.mask[300:340, 280:340].all()
+    # The crop covers both objects with the margin
+    crop = roi.crop(200, margin=10)
+    assert crop == [[195, 395], [90, 350]]
+
+    roi = segment_tabletop(np.zeros((HEIGHT, WIDTH), np.float32),
+                           CameraModel(P))
+    assert roi.plane is None and roi.boxes == [] and not roi.mask.any()
+    assert roi.crop(200) is None
+
+
+def test_crop_is_clipped_to_the_image():
+    mask = np.zeros((HEIGHT, WIDTH), dtype=bool)
+    # Grown crops are shifted back inside the image
+    for box, expected in [((0, 0, 10, 10), [[0, 200], [0, 200]]),
+                          ((630, 470, 10, 10), [[280, 480], [440, 640]]),
+                          ((0, 200, 640, 10), [[105, 305], [0, 640]])]:
+        roi = TabletopROI(mask, [box], None)
+        assert roi.crop(200) == expected
+    # Crops larger than the image are clipped
+    roi = TabletopROI(mask, [(300, 200, 20, 20)], None)
+    assert roi.crop(1000) == [[0, HEIGHT], [0, WIDTH]]
+
+
+if __name__ == "__main__":
+    test_fit_plane()
+    test_segment_tabletop()
+    test_crop_is_clipped_to_the_image()
+    print("Tabletop ROI tests passed")
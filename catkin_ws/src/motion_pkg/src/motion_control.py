@@ -12,6 +12,7 @@ Follow the associated README for installation instructions.
 
 import argparse
 import copy
+import os
 import signal
 import sys
 import time
@@ -21,6 +22,13 @@ from pyrobot import Robot
 from tf import TransformListener
 from motion_pkg.srv import Grasp_Point, Grasp_PointResponse
 from baseline_navi.srv import Stage_Grasp, Stage_GraspResponse
+sys.path.append(os.path.expanduser("~") + "/ICT-example/third_party")
+# The stage timings are published with the StageStats message of baseline_navi
+sys.path.append(os.path.expanduser("~") +
+                "/ICT-example/catkin_ws/src/baseline_navi/src")
+from grasp_samplers.tracing import span
+from stage_stats import start_stage_stats
+from motion_executor import MotionExecutor
 
 BB_SIZE = 5
 MAX_DEPTH = 3.0
@@ -30,6 +38,10 @@ DEFAULT_PITCH = 1.57
 MIN_DEPTH = 0.1
 N_SAMPLES = 100
 PATCH_SIZE = 100
+PLACING_POSITIONS = {'red': [0.234, -0.235, 0.3],
+                     'green': [0.174, -0.235, 0.3],
+                     'blue': [0.114, -0.235, 0.3]}
+PLACING_ABOVE_POSITION = [0.15, 0.0, 0.3]
 
 
 class Motion_(object):
@@ -49,7 +61,8 @@ class Motion_(object):
         self.reset_pan = 0.0
         self.reset_tilt = 0.8
         self.n_tries = 5
-        self._sleep_time = 2
+        self.executor = MotionExecutor(self.robot, n_tries=self.n_tries,
+                                       log=rospy.loginfo, warn=rospy.logwarn)
         self._transform_listener = TransformListener()
         rospy.wait_for_service('locobot_grasppoint')
         self.grasppoint_service = rospy.ServiceProxy('locobot_grasppoint', Grasp_Point)
@@ -64,68 +77,52 @@ class Motion_(object):
         """
         success = False
         for _ in range(self.n_tries):
-            success = self.robot.arm.set_joint_positions(self.retract_position)
+            success = self.executor.move_joints(self.retract_position, plan=True,
+                                                name='retract')
             if success:
                 break
-        self.robot.gripper.open()
-        self.robot.camera.set_pan(self.reset_pan)
-        self.robot.camera.set_tilt(self.reset_tilt)
+        self.executor.open_gripper()
+        with self.executor.step('reset camera'):
+            self.robot.camera.set_pan(self.reset_pan)
+            self.robot.camera.set_tilt(self.reset_tilt)
         return success
 
-    def grasp(self, grasp_pose):
+    def grasp(self, grasp_poses):
         """
-        Performs manipulation operations to grasp at the desired pose.
-
-        :param grasp_pose: Desired grasp pose for grasping.
-        :type grasp_pose: list
-        :returns: Success of grasping procedure.
-        :rtype: bool
+        Performs manipulation operations to grasp at the first of the desired
+        poses that works. A pose is skipped when the arm cannot reach it or
+        when the gripper closes on nothing, without predicting new grasps.
+
+        :param grasp_poses: Desired grasp poses [x, y, theta], best first.
+        :type grasp_poses: list
+        :returns: Index of the grasped pose, None if every pose failed.
+        :rtype: int
         """
 
-        pregrasp_position = [grasp_pose[0], grasp_pose[1], self.pregrasp_height]
-        grasp_angle = self.get_grasp_angle(grasp_pose)
-        grasp_position = [grasp_pose[0], grasp_pose[1], self.grasp_height]
-
-        rospy.loginfo("Going to pre-grasp pose:\n\n {} \n".format(pregrasp_position))
-        result = self.set_pose(pregrasp_position, roll=grasp_angle)
-        time.sleep(self._sleep_time)
-
-        rospy.loginfo("Going to grasp pose:\n\n {} \n".format(grasp_position))
-        result = self.set_pose(grasp_position, roll=grasp_angle)
-        time.sleep(self._sleep_time)
+        return self.executor.grasp_first(grasp_poses, self.pregrasp_height,
+                                         self.grasp_height,
+                                         self.get_grasp_angle)
 
-        rospy.loginfo("Closing gripper")
-        self.robot.gripper.close()
-        time.sleep(1)
-
-        rospy.loginfo("Going to pre-grasp pose")
-        result = self.set_pose(pregrasp_position, roll=grasp_angle)
-        time.sleep(1)
-        return result
-
-    def set_pose(self, position, pitch=DEFAULT_PITCH, roll=0.0):
+    def set_pose(self, position, pitch=DEFAULT_PITCH, roll=0.0, cache=False):
         """
         Sets desired end-effector pose.
 
         :param position: End-effector position to reach.
         :param pitch: Pitch angle of the end-effector.
         :param roll: Roll angle of the end-effector
+        :param cache: Reuse the joint positions of earlier moves to this pose
         :type position: list
         :type pitch: float
         :type roll: float
+        :type cache: bool
         :returns: Success of pose setting process.
         :rtype: bool
         """
 
-        success = 0
-        for _ in range(self.n_tries):
-            position = np.array(position)
-            success = self.robot.arm.set_ee_pose_pitch_roll(
-                position=position, pitch=pitch, roll=roll, plan=False, numerical=False
-            )
-            if success == 1:
-                print("set_pose success")
-                break
+        success = self.executor.move_pose(position, pitch=pitch, roll=roll,
+                                          cache=cache)
+        if success:
+            print("set_pose success")
         return success
 
     def get_grasp_angle(self, grasp_pose):
@@ -164,46 +161,59 @@ class Motion_(object):
 
     def handle_grasp(self, req):
         rospy.loginfo("Grasp attempt x={:.4f},y={:.4f},theta={:.4f}".format(req.x,req.y,req.theta))
-        self.color = req.color
+        grasp_poses = [[req.x, req.y, req.theta]]
+        colors = [req.color]
+        if len(req.xs) > 0:
+            # Ranked candidates, the first one being (x, y, theta)
+            grasp_poses = [list(pose) for pose in zip(req.xs, req.ys, req.thetas)]
+            colors = list(req.colors)
         try:
             success = self.reset()
             assert  success
         except:
             rospy.logerr("Arm reset failed")
-        grasp_pose = [req.x, req.y, req.theta]
-        print("\n Grasp Pose: \n\n {} \n\n".format(grasp_pose))
-        self.robot.camera.set_tilt(0.0)
-        self.grasp(grasp_pose)
+        print("\n Grasp Poses: \n\n {} \n\n".format(grasp_poses))
+        with self.executor.step('tilt camera'):
+            self.robot.camera.set_tilt(0.0)
+        grasped = self.grasp(grasp_poses)
+        if grasped is None:
+            rospy.logerr("Every grasp candidate failed")
+            rospy.loginfo('Grasp timing:\n{}'.format(self.executor.report()))
+            return False
+        self.color = colors[grasped]
 
         # robotics arm placing
         rospy.loginfo('Going to placing pose')
         print(self.color)
-        if self.color == 'red':
-            result = self.set_pose([0.234, -0.235, 0.3], roll=0.0)
-            print("red")
-        elif self.color == 'green':
-            result = self.set_pose([0.174, -0.235, 0.3], roll=0.0)
-            print("green")
-        elif self.color == 'blue':
-            result = self.set_pose([0.114, -0.235, 0.3], roll=0.0)
-            print("blue")
-        time.sleep(self._sleep_time)
+        result = False
+        if self.color in PLACING_POSITIONS:
+            result = self.executor.move_pose(PLACING_POSITIONS[self.color],
+                                             roll=0.0, cache=True,
+                                             name='place')
+            print(self.color)
+        rospy.loginfo('Grasp timing:\n{}'.format(self.executor.report()))
         return result
 
     def grasp_stage_service_cb(self, grasp_request):
+        with span('stage_grasp_{}'.format(grasp_request.request)):
+            return self._run_stage(grasp_request)
+
+    def _run_stage(self, grasp_request):
         if grasp_request.request == 0:
             self.reset()
-            time.sleep(1)
         elif grasp_request.request == 1:
             print("call grasp.py")
-            response = self.grasppoint_service(True)
+            with span('grasppoint'):
+                response = self.grasppoint_service(True)
             self.handle_grasp(response)
         elif grasp_request.request == 3:
             rospy.loginfo('Opening gripper')
-            self.robot.gripper.open()
+            self.executor.open_gripper()
             rospy.loginfo('Going to placing above pose')
-            self.set_pose([0.15, 0.0, 0.3], roll=0.0)
+            self.executor.move_pose(PLACING_ABOVE_POSITION, roll=0.0,
+                                    cache=True, name='place above')
             rospy.loginfo('back to original point')
+            rospy.loginfo('Place timing:\n{}'.format(self.executor.report()))
         return Stage_GraspResponse(True)
 
 
@@ -219,4 +229,5 @@ if __name__ == "__main__":
     args, unknown = parser.parse_known_args()
     rospy.init_node('locobot_motion_server')
     motion = Motion_()
+    start_stage_stats('locobot_motion')
     rospy.spin()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+Feedback-driven arm and gripper motions for Motion_.
+
+Instead of sleeping for a fixed time after every command, motions wait for
+the joints to stop moving or for the gripper to report its new state, with
+timeouts. Only uses the PyRobot robot object that is passed in.
+"""
+
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from grasp_samplers.tracing import span
+
+DEFAULT_PITCH = 1.57
+JOINT_VEL_TOL = 0.05
+SETTLE_WINDOW = 0.15
+MOVE_TIMEOUT = 5.0
+GRIPPER_TIMEOUT = 3.0
+POLL_PERIOD = 0.02
+# Pitch offsets tried with numerical IK when the analytical IK fails
+PITCH_OFFSETS = [0., -0.1, 0.1, -0.2, 0.2]
+# LoCoBotGripper.get_gripper_state: 0 open, 1 moving, 2 closed on an
+# object, 3 fully closed, -1 unknown
+GRIPPER_OPEN_STATES = (0,)
+GRIPPER_CLOSED_STATES = (2, 3)
+# Fully closed, with nothing between the fingers
+GRIPPER_EMPTY_STATES = (3,)
+
+
+def print_log(message):
+    print(message)
+
+
+class MotionExecutor(object):
+    """
+    This class runs arm and gripper motions of a PyRobot robot and times them.
+    """
+
+    def __init__(self, robot, n_tries=5, move_timeout=MOVE_TIMEOUT,
+                 gripper_timeout=GRIPPER_TIMEOUT, log=print_log,
+                 warn=print_log):
+        """
+        The constructor for :class:`MotionExecutor` class.
+
+        :param robot: PyRobot robot with an arm and a gripper
+        :param n_tries: Number of IK attempts per pose
+        :param move_timeout: Seconds to wait for the arm to settle
+        :param gripper_timeout: Seconds to wait for the gripper
+        :param log: Logs a message
+        :param warn: Logs a warning
+        :type robot: pyrobot.Robot
+        :type n_tries: int
+        :type move_timeout: float
+        :type gripper_timeout: float
+        :type log: function
+        :type warn: function
+        """
+        self.robot = robot
+        self.n_tries = n_tries
+        self.move_timeout = move_timeout
+        self.gripper_timeout = gripper_timeout
+        self.log = log
+        self.warn = warn
+        self.timings = []
+        # (position, pitch, roll) -> joint positions reached for that pose
+        self._joint_cache = {}
+
+    @contextmanager
+    def step(self, name):
+        """
+        Times the enclosed motion step, see :meth:`report`. The step is also
+        traced as a span.
+
+        :param name: Name of the step
+        :type name: string
+        """
+        st_time = time.time()
+        try:
+            with span(name):
+                yield
+        finally:
+            self.timings.append((name, time.time() - st_time))
+
+    def report(self, clear=True):
+        """
+        Formats the recorded step timings.
+
+        :param clear: Forget the timings once reported
+        :type clear: bool
+
+        :returns: One line per step and the total
+        :rtype: string
+        """
+        lines = ['{:<24s} {:6.3f}s'.format(name, duration)
+                 for name, duration in self.timings]
+        lines.append('{:<24s} {:6.3f}s'.format(
+            'total', sum(duration for _, duration in self.timings)))
+        if clear:
+            self.timings = []
+        return '\n'.join(lines)
+
+    def wait_for_settle(self, timeout=None):
+        """
+        Waits until no joint moved faster than JOINT_VEL_TOL for
+        SETTLE_WINDOW seconds.
+
+        :param timeout: Seconds to wait, defaults to `move_timeout`
+        :type timeout: float
+
+        :returns: Whether the arm settled before the timeout
+        :rtype: bool
+        """
+        if timeout is None:
+            timeout = self.move_timeout
+        st_time = time.time()
+        still_since = st_time
+        last_time = st_time
+        last_q = np.array(self.robot.arm.get_joint_angles())
+        while True:
+            time.sleep(POLL_PERIOD)
+            now = time.time()
+            q = np.array(self.robot.arm.get_joint_angles())
+            if np.max(np.abs(q - last_q)) / (now - last_time) > JOINT_VEL_TOL:
+                still_since = now
+            last_q, last_time = q, now
+            if now - still_since >= SETTLE_WINDOW:
+                return True
+            if now - st_time >= timeout:
+                return False
+
+    def wait_for_gripper(self, states, timeout=None):
+        """
+        Waits until the gripper reports one of `states`.
+
+        :param states: Gripper states to wait for
+        :param timeout: Seconds to wait, defaults to `gripper_timeout`
+        :type states: tuple
+        :type timeout: float
+
+        :returns: Whether the gripper reached one of the states in time
+        :rtype: bool
+        """
+        if timeout is None:
+            timeout = self.gripper_timeout
+        st_time = time.time()
+        while self.robot.gripper.get_gripper_state() not in states:
+            if time.time() - st_time >= timeout:
+                return False
+            time.sleep(POLL_PERIOD)
+        return True
+
+    def open_gripper(self):
+        with self.step('open gripper'):
+            self.robot.gripper.open(wait=False)
+            return self.wait_for_gripper(GRIPPER_OPEN_STATES)
+
+    def close_gripper(self):
+        with self.step('close gripper'):
+            self.robot.gripper.close(wait=False)
+            return self.wait_for_gripper(GRIPPER_CLOSED_STATES)
+
+    def holding_object(self):
+        """
+        :returns: Whether the closed gripper did not close on nothing. An
+                  unknown gripper state counts as holding, so that a failed
+                  state read never discards a grasp
+        :rtype: bool
+        """
+        return self.robot.gripper.get_gripper_state() not in \
+            GRIPPER_EMPTY_STATES
+
+    def grasp_first(self, grasp_poses, pregrasp_height, grasp_height,
+                    grasp_angle):
+        """
+        Grasps at the first of the poses that works. A pose is skipped when
+        the arm cannot reach it or when the gripper closes on nothing.
+
+        :param grasp_poses: Grasp poses [x, y, theta], best first
+        :param pregrasp_height: Height of the end-effector above a grasp
+        :param grasp_height: Height of the end-effector at a grasp
+        :param grasp_angle: Returns the end-effector roll of a grasp pose
+        :type grasp_poses: list
+        :type pregrasp_height: float
+        :type grasp_height: float
+        :type grasp_angle: function
+
+        :returns: Index of the grasped pose, None if every pose failed
+        :rtype: int
+        """
+        for i, grasp_pose in enumerate(grasp_poses):
+            pregrasp_position = [grasp_pose[0], grasp_pose[1], pregrasp_height]
+            roll = grasp_angle(grasp_pose)
+            grasp_position = [grasp_pose[0], grasp_pose[1], grasp_height]
+
+            self.log("Going to pre-grasp pose {}:\n\n {} \n".format(
+                i, pregrasp_position))
+            if not self.move_pose(pregrasp_position, roll=roll,
+                                  name='pre-grasp'):
+                self.warn("Pre-grasp pose {} is out of reach".format(i))
+                continue
+
+            self.log("Going to grasp pose:\n\n {} \n".format(grasp_position))
+            if not self.move_pose(grasp_position, roll=roll, name='grasp'):
+                self.warn("Grasp pose {} is out of reach".format(i))
+                continue
+
+            self.log("Closing gripper")
+            self.close_gripper()
+            holding = self.holding_object()
+
+            self.log("Going to pre-grasp pose")
+            self.move_pose(pregrasp_position, roll=roll, name='lift')
+            if holding:
+                return i
+            self.warn("Gripper closed on nothing at grasp {}".format(i))
+            self.open_gripper()
+        return None
+
+    def move_joints(self, joints, plan=False, name='move joints'):
+        """
+        Moves the arm to joint positions.
+
+        :param joints: Joint positions
+        :param plan: Plan the motion with MoveIt
+        :param name: Name of the step
+        :type joints: list
+        :type plan: bool
+        :type name: string
+
+        :returns: Success of the motion
+        :rtype: bool
+        """
+        with self.step(name):
+            success = self.robot.arm.set_joint_positions(joints, plan=plan)
+            if success:
+                self.wait_for_settle()
+            return success
+
+    def move_pose(self, position, pitch=DEFAULT_PITCH, roll=0.0,
+                  cache=False, name='move pose'):
+        """
+        Moves the end-effector to a pose.
+
+        The analytical IK is tried first. As it is deterministic, later
+        attempts use the numerical IK with slightly different pitches.
+
+        :param position: End-effector position to reach
+        :param pitch: Pitch angle of the end-effector
+        :param roll: Roll angle of the end-effector
+        :param cache: Remember the joint positions reached for this pose and
+                      move there directly next time, for fixed poses
+        :param name: Name of the step
+        :type position: list
+        :type pitch: float
+        :type roll: float
+        :type cache: bool
+        :type name: string
+
+        :returns: Success of the motion
+        :rtype: bool
+        """
+        key = (tuple(position), pitch, roll)
+        if cache and key in self._joint_cache:
+            return self.move_joints(self._joint_cache[key], name=name)
+        with self.step(name):
+            position = np.array(position)
+            success = False
+            for i in range(self.n_tries):
+                offset = 0. if i == 0 else \
+                    PITCH_OFFSETS[(i - 1) % len(PITCH_OFFSETS)]
+                success = self.robot.arm.set_ee_pose_pitch_roll(
+                    position=position, pitch=pitch + offset, roll=roll,
+                    plan=False, numerical=i > 0)
+                if success:
+                    break
+            if success:
+                self.wait_for_settle()
+                if cache:
+                    self._joint_cache[key] = list(
+                        self.robot.arm.get_joint_angles())
+            return success
@@ -0,0 +1,107 @@
+import os
+import sys
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(test_dir, '..', 'src'))
+sys.path.append(os.path.join(test_dir, '..', '..', '..', '..', 'third_party'))
+from motion_executor import MotionExecutor
+
+
+class FakeArm(object):
+    """
+    Arm that reaches every pose instantly, except the unreachable ones.
+    """
+
+    def __init__(self, unreachable=()):
+        self.unreachable = unreachable
+        self.joints = [0.] * 5
+        self.poses = []
+
+    def get_joint_angles(self):
+        return self.joints
+
+    def set_ee_pose_pitch_roll(self, position, pitch, roll, plan, numerical):
+        self.poses.append(list(position))
+        return tuple(position[:2]) not in self.unreachable
+
+    def set_joint_positions(self, joints, plan=False):
+        self.joints = list(joints)
+        return True
+
+
+class FakeGripper(object):
+    """
+    Gripper that closes on an object at the given (x, y) only.
+    """
+
+    def __init__(self, arm, objects=()):
+        self.arm = arm
+        self.objects = objects
+        self.state = 0
+        self.closes = 0
+
+    def get_gripper_state(self):
+        return self.state
+
+    def open(self, wait=True):
+        self.state = 0
+
+    def close(self, wait=True):
+        self.closes += 1
+        # LoCoBotGripper: 2 closed on an object, 3 fully closed
+        self.state = 2 if tuple(self.arm.poses[-1][:2]) in self.objects else 3
+
+
+class FakeRobot(object):
+    def __init__(self, unreachable=(), objects=()):
+        self.arm = FakeArm(unreachable)
+        self.gripper = FakeGripper(self.arm, objects)
+
+
+def quiet_log(message):
+    pass
+
+
+def executor(robot):
+    return MotionExecutor(robot, n_tries=2, gripper_timeout=0.5,
+                          log=quiet_log, warn=quiet_log)
+
+
+def test_holding_object():
+    robot = FakeRobot()
+    motion = executor(robot)
+    for state, holding in [(2, True), (3, False), (-1, True)]:
+        robot.gripper.state = state
+        assert motion.holding_object() == holding
+
+
+def test_grasp_first_falls_back():
+    poses = [[0.3, 0.0, 0.], [0.35, 0.1, 0.], [0.4, -0.1, 0.5],
+             [0.3, 0.2, 0.]]
+    # Out of reach, then closed on nothing, then grasped
+    robot = FakeRobot(unreachable=[(0.3, 0.0)], objects=[(0.4, -0.1)])
+    motion = executor(robot)
+    assert motion.grasp_first(poses, 0.2, 0.13, lambda pose: pose[2]) == 2
+    assert robot.gripper.closes == 2
+    assert robot.gripper.state == 2
+    # The last pose is never tried
+    assert [0.3, 0.2, 0.2] not in robot.arm.poses
+
+    # A grasp on an object is kept at once
+    robot = FakeRobot(objects=[(0.3, 0.0)])
+    assert executor(robot).grasp_first(poses, 0.2, 0.13,
+                                       lambda pose: pose[2]) == 0
+    assert robot.gripper.closes == 1
+
+    robot = FakeRobot()
+    motion = executor(robot)
+    assert motion.grasp_first(poses, 0.2, 0.13, lambda pose: pose[2]) is None
+    assert robot.gripper.closes == len(poses)
+    # The gripper is reopened after closing on nothing
+    assert robot.gripper.state == 0
+
+
+if __name__ == "__main__":
+    test_holding_object()
+    test_grasp_first_falls_back()
+    print("Motion executor tests passed")
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+
+"""
+Offline grasp prediction over a directory or an archive of scene images.
+
+Images flow through a bounded pipeline: a reader thread lists the directory
+(or streams the tar archive), a pool of decode threads decodes them, and
+inference worker processes run :class:`GraspModel` on them and optionally
+render the predicted grasps. The workers are forked from a process that
+already loaded the model, so they share its weights; with `--server` they
+are clients of a grasp server instead (see grasp_server.py), which batches
+patches across workers.
+
+Results are appended to a JSONL file, one line per image, as soon as they
+are known. Running again with the same output resumes the run: images with a
+result are skipped, images that failed are retried and their new line is
+appended, so the last line of a key holds its result.
+
+Usage::
+
+    python -m grasp_samplers.batch_eval scenes/ grasps.jsonl --workers 4
+    python -m grasp_samplers.batch_eval scenes.tar.gz grasps.jsonl \\
+        --render_dir rendered/
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tarfile
+import threading
+import time
+import zlib
+
+import cv2
+import numpy as np
+import torch
+from grasp_samplers.grasp_model import GraspModel
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+QUEUE_SIZE = 8
+PROGRESS_PERIOD = 100
+# Settings that must not change when a run is resumed
+MODEL_KEYS = ['model_name', 'nsamples', 'patchsize', 'n_importance', 'n_sen',
+              'n_sen_samples', 'sen_pixels', 'sen_metric', 'sampler',
+              'search']
+
+
+def iterate_source(source):
+    """
+    Lists the images of a directory (recursively, in sorted order) or of a
+    tar archive (in archive order).
+
+    :param source: Directory or tar archive, possibly compressed
+    :type source: string
+
+    :returns: (key, data, path) per image, where `key` is the path relative
+              to the source, and either the encoded `data` or the file
+              `path` is set
+    :rtype: generator
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    key = os.path.relpath(path, source).replace(os.sep, '/')
+                    yield key, None, path
+        return
+    # Streaming mode reads the archive once, front to back
+    with tarfile.open(source, 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and \
+                    member.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield member.name, archive.extractfile(member).read(), None
+
+
+def decode_image(data=None, path=None):
+    """
+    :returns: The RGB image, or None if it cannot be decoded
+    :rtype: np.ndarray
+    """
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    return img[:, :, [2, 1, 0]]
+
+
+def load_results(output):
+    """
+    Reads the results of a previous run. A line cut off by an interrupted
+    run is removed from the file.
+
+    :param output: JSONL result file
+    :type output: string
+
+    :returns: Keys of the images with a result
+    :rtype: set
+    """
+    done = set()
+    if not os.path.isfile(output):
+        return done
+    valid_size = 0
+    with open(output, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            valid_size += len(line)
+            if 'error' not in record:
+                done.add(record['key'])
+    if valid_size < os.path.getsize(output):
+        with open(output, 'r+b') as f:
+            f.truncate(valid_size)
+    return done
+
+
+def check_meta(output, meta):
+    """
+    Stores the settings of a run next to its results, and refuses to resume
+    a run made with other settings.
+    """
+    meta_path = output + '.meta.json'
+    if os.path.isfile(meta_path) and os.path.isfile(output):
+        with open(meta_path) as f:
+            previous = json.load(f)
+        if previous != meta:
+            raise ValueError('{} was produced with {}, not {}; use another '
+                             'output file'.format(output, previous, meta))
+        return
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+
+def render_path(render_dir, key):
+    return os.path.join(render_dir,
+                        os.path.splitext(key.replace('/', '__'))[0] + '.jpg')
+
+
+def _inference_worker(worker_id, grasp_model, model_kwargs, tasks, results,
+                      render_dir, seed, threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if grasp_model is None:
+        grasp_model = GraspModel(**model_kwargs)
+    elif model_kwargs.get('warmup', True):
+        grasp_model.grasp_obj.warmup()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key, img = task
+        record = {'key': key, 'worker': worker_id}
+        if img is None:
+            record['error'] = 'Could not decode the image'
+            results.put(record)
+            continue
+        # Seeded per image, so results do not depend on the scheduling
+        np.random.seed((zlib.crc32(key.encode('utf-8')) ^ seed) & 0xffffffff)
+        try:
+            st_time = time.time()
+            h, w, angle, score = grasp_model.predict(img)
+            record.update({'h': int(h), 'w': int(w), 'angle': float(angle),
+                           'score': float(score),
+                           'height': img.shape[0], 'width': img.shape[1],
+                           'predict_ms': (time.time() - st_time) * 1e3})
+            if render_dir is not None:
+                cv2.imwrite(render_path(render_dir, key),
+                            grasp_model.predicted_image()[:, :, [2, 1, 0]])
+        except Exception as e:
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+        results.put(record)
+    results.put(None)
+
+
+def _multiprocessing_context():
+    # Workers inherit the loaded model, which requires fork
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def run_batch_eval(source, output, model_kwargs, workers=1,
+                   decode_threads=2, render_dir=None, seed=0,
+                   queue_size=QUEUE_SIZE, threads=None):
+    """
+    Predicts a grasp for every image of a source and appends the results to
+    a JSONL file.
+
+    :param source: Directory or tar archive of images
+    :param output: JSONL result file, resumed if it exists
+    :param model_kwargs: Arguments of :class:`GraspModel`; with
+                         `server_address` every worker connects to the grasp
+                         server, otherwise the model is loaded once and
+                         shared by the forked workers
+    :param workers: Number of inference processes
+    :param decode_threads: Number of image decoding threads
+    :param render_dir: Directory to save the images with their grasp to
+    :param seed: Seed of the patch sampling
+    :param queue_size: Number of decoded images waiting for a worker
+    :param threads: Torch threads per worker, defaults to an equal share of
+                    the cores
+    :type source: string
+    :type output: string
+    :type model_kwargs: dict
+    :type workers: int
+    :type decode_threads: int
+    :type render_dir: string
+    :type seed: int
+    :type queue_size: int
+    :type threads: int
+
+    :returns: Numbers of predicted, failed and skipped images, and the
+              throughput
+    :rtype: dict
+    """
+    st_time = time.time()
+    meta = dict((key, model_kwargs.get(key)) for key in MODEL_KEYS)
+    meta['seed'] = seed
+    check_meta(output, meta)
+    done = load_results(output)
+    if render_dir is not None and not os.path.isdir(render_dir):
+        os.makedirs(render_dir)
+    if threads is None:
+        threads = max(1, multiprocessing.cpu_count() // workers)
+
+    grasp_model = None
+    if model_kwargs.get('server_address') is None:
+        # Warmed up by the workers: threads started before a fork may not
+        # survive it
+        grasp_model = GraspModel(**dict(model_kwargs, warmup=False))
+    context = _multiprocessing_context()
+    tasks = context.Queue(queue_size)
+    results = context.Queue()
+    processes = [context.Process(target=_inference_worker,
+                                 args=(i, grasp_model, model_kwargs, tasks,
+                                       results, render_dir, seed, threads))
+                 for i in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    stats = {'predicted': 0, 'failed': 0, 'skipped': 0}
+    encoded = queue.Queue(queue_size)
+
+    def read():
+        for key, data, path in iterate_source(source):
+            if key in done:
+                stats['skipped'] += 1
+                continue
+            encoded.put((key, data, path))
+        for _ in range(decode_threads):
+            encoded.put(None)
+
+    def decode():
+        while True:
+            item = encoded.get()
+            if item is None:
+                return
+            key, data, path = item
+            tasks.put((key, decode_image(data, path)))
+
+    decoders = [threading.Thread(target=decode)
+                for _ in range(decode_threads)]
+    pipeline = [threading.Thread(target=read)] + decoders
+    for thread in pipeline:
+        thread.daemon = True
+        thread.start()
+
+    def finish_tasks():
+        for thread in pipeline:
+            thread.join()
+        for _ in processes:
+            tasks.put(None)
+
+    finisher = threading.Thread(target=finish_tasks)
+    finisher.daemon = True
+    finisher.start()
+
+    finished = 0
+    with open(output, 'a') as f:
+        while finished < len(processes):
+            try:
+                record = results.get(timeout=1.)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    print('Every inference worker exited early')
+                    break
+                continue
+            if record is None:
+                finished += 1
+                continue
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            if 'error' in record:
+                stats['failed'] += 1
+                print('{}: {}'.format(record['key'], record['error']))
+            else:
+                stats['predicted'] += 1
+            count = stats['predicted'] + stats['failed']
+            if count % PROGRESS_PERIOD == 0:
+                print('{} images in {:.1f}s'.format(count,
+                                                    time.time() - st_time))
+    for process in processes:
+        process.join()
+
+    stats['time'] = time.time() - st_time
+    stats['images_per_s'] = (stats['predicted'] + stats['failed']) / \
+        stats['time']
+    return stats
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Predict grasps over a directory or archive of images')
+    parser.add_argument('source', help='Image directory or tar archive')
+    parser.add_argument('output', help='JSONL result file, resumed if it '
+                                       'exists')
+    parser.add_argument('--model_name', default='model.pth')
+    parser.add_argument('--url', default=None,
+                        help='URL of the model, only needed if it is missing')
+    parser.add_argument('--server', default=None,
+                        help='Unix socket of a grasp server to use instead '
+                             'of loading the model')
+    parser.add_argument('--nsamples', type=int, default=78)
+    parser.add_argument('--patchsize', type=int, default=100)
+    parser.add_argument('--n_sen', type=int, default=0)
+    parser.add_argument('--n_sen_samples', type=int, default=0)
+    parser.add_argument('--sen_pixels', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--decode_threads', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Torch threads per worker')
+    parser.add_argument('--render_dir', default=None,
+                        help='Directory to save the images with their grasp')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    model_kwargs = {'model_name': args.model_name, 'url': args.url,
+                    'nsamples': args.nsamples, 'patchsize': args.patchsize,
+                    'n_sen': args.n_sen, 'n_sen_samples': args.n_sen_samples,
+                    'sen_pixels': args.sen_pixels,
+                    'server_address': args.server}
+    stats = run_batch_eval(args.source, args.output, model_kwargs,
+                           workers=args.workers,
+                           decode_threads=args.decode_threads,
+                           render_dir=args.render_dir, seed=args.seed,
+                           threads=args.threads)
+    print('{predicted} predicted, {failed} failed, {skipped} skipped in '
+          '{time:.1f}s ({images_per_s:.2f} images/s)'.format(**stats))
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
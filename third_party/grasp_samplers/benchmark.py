@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""
+Offline benchmark of the grasp inference engine.
+
+Runs :class:`GraspModel` with a seeded, randomly initialized IfullRobHWNet
+over a matrix of image sizes, sample counts, patch sizes, batch sizes and
+thread counts, and reports per-stage latency percentiles taken from the
+tracer (see tracing.py). Results can be written as JSON/CSV and compared
+against a stored baseline JSON, in which case regressions exit non-zero.
+
+Usage::
+
+    python -m grasp_samplers.benchmark --json bench.json
+    python -m grasp_samplers.benchmark --baseline bench.json --tolerance 0.2
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+from grasp_samplers.deeper_models import IfullRobHWNet
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.tracing import get_tracer
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+DEMO_DIR = os.path.join(dir_path, 'demo_images')
+# Stage name: span names (the last path component) it sums over
+STAGES = [('sample', ['sample']),
+          ('preprocess', ['preprocess']),
+          ('backbone', ['backbone']),
+          ('heads', ['heads']),
+          ('smooth', ['smooth']),
+          ('sensitivity', ['sensitivity'])]
+PERCENTILES = [50, 90, 99]
+CONFIG_KEYS = ['image_size', 'nsamples', 'patchsize', 'batch_size',
+               'threads', 'n_sen']
+FIELDS = CONFIG_KEYS + ['stage', 'repeats', 'mean_ms', 'min_ms'] + \
+    ['p{}_ms'.format(q) for q in PERCENTILES]
+
+
+def build_random_model(model_dir, seed, random_bn=False):
+    """
+    Saves a randomly initialized grasp model.
+
+    :param model_dir: Directory of the checkpoint
+    :param seed: Seed of the weights
+    :param random_bn: Also randomize the BatchNorm running statistics, which
+                      are the identity otherwise
+    :type model_dir: string
+    :type seed: int
+    :type random_bn: bool
+
+    :returns: Path of the checkpoint
+    :rtype: string
+    """
+    torch.manual_seed(seed)
+    model = IfullRobHWNet(pretrained_resnet18=False)
+    if random_bn:
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 1.5)
+    model.eval()
+    model_path = os.path.join(model_dir, 'random_model.pth')
+    torch.save(model, model_path)
+    return model_path
+
+
+def load_images(image_size, image_dir=DEMO_DIR):
+    """
+    Loads the demo images resized to squares of `image_size`.
+    """
+    names = sorted(os.listdir(image_dir))
+    return [cv2.resize(cv2.imread(os.path.join(image_dir, name))[:, :, [2, 1, 0]],
+                       (image_size, image_size)) for name in names]
+
+
+def stage_times(summary):
+    """
+    Sums the traced time of every stage.
+
+    :param summary: Tracer summary of a single prediction
+    :type summary: dict
+
+    :returns: Stage name to milliseconds
+    :rtype: dict
+    """
+    times = dict((stage, 0.) for stage, _ in STAGES)
+    for path, stats in summary.items():
+        leaf = path.rsplit('/', 1)[-1]
+        for stage, names in STAGES:
+            if leaf in names:
+                times[stage] += stats['mean_ms'] * stats['count']
+    return times
+
+
+def run_config(model_path, config, repeats, seed, warmup=1):
+    """
+    Benchmarks one configuration.
+
+    :returns: One row per stage plus the 'total' row
+    :rtype: list
+    """
+    torch.set_num_threads(config['threads'])
+    grasp_model = GraspModel(model_name=model_path,
+                             nsamples=config['nsamples'],
+                             patchsize=config['patchsize'],
+                             batch_size=config['batch_size'],
+                             n_sen=config['n_sen'],
+                             n_sen_samples=min(config['n_sen'] and 10,
+                                               config['batch_size']),
+                             sen_pixels=config['n_sen'] and 20)
+    images = load_images(config['image_size'])
+    tracer = get_tracer()
+    samples = dict((stage, []) for stage, _ in STAGES + [('total', None)])
+    np.random.seed(seed)
+    for i in range(warmup + repeats):
+        img = images[i % len(images)]
+        tracer.reset()
+        st_time = time.time()
+        grasp_model.predict(img.copy())
+        total = (time.time() - st_time) * 1e3
+        if i < warmup:
+            continue
+        for stage, ms in stage_times(tracer.summary()).items():
+            samples[stage].append(ms)
+        samples['total'].append(total)
+
+    rows = []
+    for stage in [stage for stage, _ in STAGES] + ['total']:
+        values = samples[stage]
+        row = dict(config)
+        row['stage'] = stage
+        row['repeats'] = repeats
+        row['mean_ms'] = float(np.mean(values))
+        row['min_ms'] = float(np.min(values))
+        for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+            row['p{}_ms'.format(q)] = float(value)
+        rows.append(row)
+    return rows
+
+
+def run_benchmark(model_path, matrix, repeats, seed):
+    """
+    Benchmarks every combination of the matrix.
+
+    :param model_path: Grasp checkpoint
+    :param matrix: Config key to list of values
+    :param repeats: Timed predictions per configuration
+    :param seed: Seed of the patch sampling
+    :type model_path: string
+    :type matrix: dict
+    :type repeats: int
+    :type seed: int
+
+    :returns: Result rows
+    :rtype: list
+    """
+    rows = []
+    for values in itertools.product(*[matrix[key] for key in CONFIG_KEYS]):
+        config = dict(zip(CONFIG_KEYS, values))
+        if config['patchsize'] >= config['image_size']:
+            continue
+        rows.extend(run_config(model_path, config, repeats, seed))
+    return rows
+
+
+def row_key(row):
+    return tuple(row[key] for key in CONFIG_KEYS + ['stage'])
+
+
+def compare_to_baseline(rows, baseline_rows, tolerance, metric='p50_ms',
+                        min_delta_ms=1.):
+    """
+    Finds the stages that got slower than the baseline.
+
+    :param rows: Current result rows
+    :param baseline_rows: Baseline result rows
+    :param tolerance: Allowed relative slowdown, e.g. 0.2 for 20%
+    :param metric: Column to compare
+    :param min_delta_ms: Slowdowns below this many milliseconds are noise
+    :type rows: list
+    :type baseline_rows: list
+    :type tolerance: float
+    :type metric: string
+    :type min_delta_ms: float
+
+    :returns: (row, baseline value) of every regression
+    :rtype: list
+    """
+    baseline = dict((row_key(row), row[metric]) for row in baseline_rows)
+    regressions = []
+    for row in rows:
+        reference = baseline.get(row_key(row))
+        if reference is None:
+            continue
+        delta = row[metric] - reference
+        if delta > min_delta_ms and delta > tolerance * reference:
+            regressions.append((row, reference))
+    return regressions
+
+
+def write_json(path, rows, meta):
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': rows}, f, indent=2,
+                  sort_keys=True)
+
+
+def write_csv(path, rows):
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the grasp inference engine')
+    parser.add_argument('--image_sizes', type=int_list, default=[224])
+    parser.add_argument('--nsamples', type=int_list, default=[78])
+    parser.add_argument('--patchsizes', type=int_list, default=[100])
+    parser.add_argument('--batch_sizes', type=int_list, default=[20])
+    parser.add_argument('--threads', type=int_list,
+                        default=[torch.get_num_threads()])
+    parser.add_argument('--n_sen', type=int_list, default=[0],
+                        help='Number of patches sensitivity runs on')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='Output JSON file')
+    parser.add_argument('--csv', default=None, help='Output CSV file')
+    parser.add_argument('--baseline', default=None,
+                        help='Baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown over the baseline')
+    parser.add_argument('--metric', default='p50_ms',
+                        help='Column compared against the baseline')
+
+    return parser
+
+
+def main(argv=None):
+    args = create_parser().parse_args(argv)
+    matrix = {'image_size': args.image_sizes, 'nsamples': args.nsamples,
+              'patchsize': args.patchsizes, 'batch_size': args.batch_sizes,
+              'threads': args.threads, 'n_sen': args.n_sen}
+    model_dir = tempfile.mkdtemp()
+    try:
+        model_path = build_random_model(model_dir, args.seed)
+        rows = run_benchmark(model_path, matrix, args.repeats, args.seed)
+    finally:
+        shutil.rmtree(model_dir)
+    meta = {'seed': args.seed, 'repeats': args.repeats,
+            'torch': torch.__version__, 'python': platform.python_version(),
+            'machine': platform.machine(), 'processor': platform.processor()}
+
+    print('{:>5} {:>5} {:>5} {:>5} {:>3} {:>3} {:<12} {:>9} {:>9} {:>9}'
+          ''.format('image', 'n', 'patch', 'batch', 'thr', 'sen', 'stage',
+                    'p50(ms)', 'p90(ms)', 'p99(ms)'))
+    for row in rows:
+        print('{image_size:5d} {nsamples:5d} {patchsize:5d} {batch_size:5d} '
+              '{threads:3d} {n_sen:3d} {stage:<12} {p50_ms:9.2f} '
+              '{p90_ms:9.2f} {p99_ms:9.2f}'.format(**row))
+    if args.json:
+        write_json(args.json, rows, meta)
+    if args.csv:
+        write_csv(args.csv, rows)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_rows = json.load(f)['results']
+        regressions = compare_to_baseline(rows, baseline_rows,
+                                          args.tolerance, args.metric)
+        for row, reference in regressions:
+            print('REGRESSION {}: {} {:.2f}ms -> {:.2f}ms (+{:.0f}%)'.format(
+                dict((key, row[key]) for key in CONFIG_KEYS), row['stage'],
+                reference, row[args.metric],
+                100. * (row[args.metric] / reference - 1.)))
+        if regressions:
+            return 1
+        print('No regression over {} beyond {:.0f}%'.format(
+            args.baseline, 100 * args.tolerance))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
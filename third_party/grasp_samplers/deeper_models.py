@@ -5,12 +5,16 @@
 
 import torch
 import torch.utils.model_zoo as model_zoo
+import torch.nn.functional as F
 from torch import nn
+from torchvision.models.quantization.resnet import QuantizableBasicBlock, \
+    QuantizableResNet
 from torchvision.models.resnet import ResNet, BasicBlock, model_urls
 
 n_class = 18
 n_images = 9
 n_robots = 5
+feature_stride = 32
 
 
 class IfullRobHWNet(ResNet):
@@ -39,10 +43,19 @@ class IfullRobHWNet(ResNet):
         self.fc_angle_0 = nn.Linear(num_ftrs, h_size)
         self.fc_angle_1 = nn.Linear(h_size, out_size)
 
-    def forward(self, x, robot_one_hot_labels, h, w, full_x, **kwargs):
-        one_hot_labels = robot_one_hot_labels
-        full_pool_out = self._one_forward(full_x)
+    def forward(self, x, robot_one_hot_labels, h, w, full_x=None,
+                full_pool_out=None, **kwargs):
+        if full_pool_out is None:
+            full_pool_out = self._one_forward(full_x)
         pool_out = self._one_forward(x)
+        return self.heads(pool_out, full_pool_out, robot_one_hot_labels, h, w)
+
+    def heads(self, pool_out, full_pool_out, one_hot_labels, h, w):
+        # Angle and noise heads on the pooled features of the patches and
+        # of their scenes, see encode_scene
+        if full_pool_out.size(0) != pool_out.size(0):
+            # A single scene embedding is shared by every patch in the batch
+            full_pool_out = full_pool_out.expand(pool_out.size(0), -1)
         fc_noise_0_out = self.relu(self.fc_noise_0(full_pool_out))
         label_info = one_hot_labels.float()
         label_info_mult = torch.cat([label_info] * self.num_targets, 1)
@@ -63,7 +76,28 @@ class IfullRobHWNet(ResNet):
         fc_angle_1_out = self.fc_angle_1(fc_angle_0_out)
         return fc_angle_1_out, fc_noise_soft
 
-    def _one_forward(self, x):
+    def encode_scene(self, full_x):
+        return self._one_forward(full_x)
+
+    def feature_map(self, x):
+        return self._features(x)
+
+    def dense_forward(self, x, window, stride=1):
+        # Angle scores of every window x window region of the feature map.
+        # This approximates running the angle head on overlapping patches:
+        # the features of a region also see the pixels around the patch and
+        # the noise head is skipped. See test/benchmark_dense.py for how
+        # close the two are
+        return self.dense_heads(self._features(x), window, stride)
+
+    def dense_heads(self, x, window, stride=1):
+        # Angle head on every window of a feature map, see dense_forward
+        x = F.avg_pool2d(x, window, stride)
+        x = x.permute(0, 2, 3, 1)
+        x = self.relu(self.fc_angle_0(x))
+        return self.fc_angle_1(x)
+
+    def _features(self, x):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -72,6 +106,10 @@ class IfullRobHWNet(ResNet):
         x = self.layer2(x)
         x = self.layer3(x)
         x = self.layer4(x)
+        return x
+
+    def _one_forward(self, x):
+        x = self._features(x)
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
         return x
@@ -79,3 +117,34 @@ class IfullRobHWNet(ResNet):
     def load_from_pretrained_resnet18(self):
         print('Loading pretrained resnet18')
         self.load_state_dict(model_zoo.load_url(model_urls['resnet18']))
+
+
+class QuantIfullRobHWNet(IfullRobHWNet):
+    # IfullRobHWNet whose ResNet trunk is replaced by a quantizable copy, see
+    # grasp_samplers/quantization.py for the conversion
+    trunk_modules = ['conv1', 'bn1', 'layer1', 'layer2', 'layer3', 'layer4',
+                     'fc']
+
+    def __init__(self, h_size=128, out_size=n_class,
+                 noise_size=n_images, **kwargs):
+        super(QuantIfullRobHWNet, self).__init__(
+            h_size=h_size, out_size=out_size, noise_size=noise_size,
+            pretrained_resnet18=False)
+        self.trunk = QuantizableResNet(QuantizableBasicBlock, [2, 2, 2, 2])
+        # The trunk is only used up to layer4
+        self.trunk.fc = nn.Identity()
+        for name in self.trunk_modules:
+            delattr(self, name)
+
+    def _features(self, x):
+        trunk = self.trunk
+        x = trunk.quant(x)
+        x = trunk.conv1(x)
+        x = trunk.bn1(x)
+        x = trunk.relu(x)
+        x = trunk.maxpool(x)
+        x = trunk.layer1(x)
+        x = trunk.layer2(x)
+        x = trunk.layer3(x)
+        x = trunk.layer4(x)
+        return trunk.dequant(x)
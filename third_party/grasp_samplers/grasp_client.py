@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""
+Client side of the grasp inference server, see grasp_server.py.
+
+Requests are small pickled messages sent over a Unix socket. Images, patches
+and embeddings are not part of the messages: the client writes them into a
+shared-memory file (under /dev/shm) that the server maps, and the messages
+only carry their offsets, shapes and dtypes.
+"""
+import atexit
+import mmap
+import os
+import pickle
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+from grasp_samplers.tracing import span
+
+SERVER_ADDRESS = '/tmp/grasp_server.sock'
+SHM_DIR = '/dev/shm'
+CONNECT_TIMEOUT = 10.
+# Arrays are placed at multiples of this many bytes in the arena
+ALIGNMENT = 64
+MIN_ARENA_SIZE = 1 << 22
+PICKLE_PROTOCOL = 2
+HEADER = struct.Struct('!I')
+
+
+def send_message(sock, message):
+    """
+    Sends a length-prefixed pickled message.
+
+    :param sock: Connected socket
+    :param message: Picklable message
+    :type sock: socket.socket
+    :type message: dict
+    """
+    data = pickle.dumps(message, PICKLE_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    """
+    Receives a message sent with :func:`send_message`.
+
+    :param sock: Connected socket
+    :type sock: socket.socket
+
+    :returns: The message, or None once the peer closed the connection
+    :rtype: dict
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def map_file(path, size):
+    """
+    Maps a shared-memory file.
+
+    :param path: Path of the file
+    :param size: Number of bytes to map
+    :type path: string
+    :type size: int
+
+    :returns: The shared mapping
+    :rtype: mmap.mmap
+    """
+    with open(path, 'r+b') as f:
+        return mmap.mmap(f.fileno(), size)
+
+
+def arena_arrays(buf, descriptors):
+    """
+    Views the arrays described by :meth:`SharedArena.put` in a mapping,
+    without copying them.
+
+    :param buf: Mapping of the arena
+    :param descriptors: Name to (offset, shape, dtype)
+    :type buf: mmap.mmap
+    :type descriptors: dict
+
+    :returns: Name to array
+    :rtype: dict
+    """
+    return dict((name, np.ndarray(shape, np.dtype(dtype), buffer=buf,
+                                  offset=offset))
+                for name, (offset, shape, dtype) in descriptors.items())
+
+
+class SharedArena(object):
+    """
+    This class is a growable shared-memory file that a client writes the
+    arrays of one request into.
+    """
+
+    def __init__(self, directory=None):
+        """
+        The constructor for :class:`SharedArena` class.
+
+        :param directory: Directory of the file, defaults to /dev/shm when
+                          it exists
+        :type directory: string
+        """
+        if directory is None:
+            directory = SHM_DIR if os.path.isdir(SHM_DIR) \
+                else tempfile.gettempdir()
+        fd, self.path = tempfile.mkstemp(prefix='grasp_arena_', dir=directory)
+        os.close(fd)
+        self.size = 0
+        self._buf = None
+
+    def _grow(self, size):
+        if self._buf is not None:
+            self._buf.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(size)
+        self.size = size
+        self._buf = map_file(self.path, size)
+
+    def put(self, arrays):
+        """
+        Copies arrays into the arena, overwriting the previous request.
+
+        :param arrays: Name to array
+        :type arrays: dict
+
+        :returns: Message field locating the arrays for :func:`arena_arrays`
+        :rtype: dict
+        """
+        layout = []
+        offset = 0
+        for name, array in arrays.items():
+            layout.append((name, array, offset))
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        if offset > self.size:
+            self._grow(max(offset, 2 * self.size, MIN_ARENA_SIZE))
+        descriptors = {}
+        for name, array, offset in layout:
+            view = np.ndarray(array.shape, array.dtype, buffer=self._buf,
+                              offset=offset)
+            view[...] = array
+            descriptors[name] = (offset, array.shape, array.dtype.str)
+        return {'path': self.path, 'size': self.size,
+                'arrays': descriptors}
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RemoteGraspObj(object):
+    """
+    This class runs grasp model operations on a grasp server. It has the
+    interface of :class:`GraspTorchObj` that :class:`GraspModel` and
+    :class:`Predictors` use, so it can replace a local model.
+    """
+
+    def __init__(self, address=SERVER_ADDRESS, timeout=CONNECT_TIMEOUT):
+        """
+        The constructor for :class:`RemoteGraspObj` class.
+
+        :param address: Path of the Unix socket of the server
+        :param timeout: Seconds to wait for the server to come up
+        :type address: string
+        :type timeout: float
+        """
+        st_time = time.time()
+        self.address = address
+        while True:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self._sock.connect(address)
+                break
+            except socket.error:
+                self._sock.close()
+                if time.time() - st_time >= timeout:
+                    raise
+                time.sleep(0.1)
+        self._lock = threading.Lock()
+        self._arena = SharedArena()
+        atexit.register(self.close)
+        info = self._call({'op': 'info'})
+        self.image_size = info['image_size']
+        self.profile = info['profile']
+        # The server resizes and normalizes the raw patches itself
+        self.batched_preprocess = True
+        # Embeddings are handed back on the CPU
+        self.use_gpu = False
+        self.load_time = time.time() - st_time
+        self.warmup_time = 0.
+
+    def _call(self, message, arrays=None):
+        with self._lock:
+            if self._sock is None:
+                raise IOError('Grasp server connection is closed')
+            if arrays:
+                message['shm'] = self._arena.put(arrays)
+            send_message(self._sock, message)
+            reply = recv_message(self._sock)
+        if reply is None:
+            raise IOError('Grasp server at {} closed the connection'
+                          ''.format(self.address))
+        if 'error' in reply:
+            raise RuntimeError('Grasp server error: {}'.format(
+                reply['error']))
+        return reply
+
+    def warmup(self):
+        blank = np.zeros((1, self.image_size, self.image_size, 3),
+                         dtype=np.uint8)
+        self.test_one_batch(blank, [0], [0], [0], [0],
+                            scene_embedding=self.encode_scene(blank[0]))
+
+    def encode_scene(self, img):
+        """
+        See :meth:`GraspTorchObj.encode_scene`.
+        """
+        if len(img.shape) == 3:
+            img = img[np.newaxis]
+        with span('encode_scene'):
+            reply = self._call({'op': 'encode_scene'}, {'img': img})
+        return torch.from_numpy(reply['embedding'])
+
+    def test_one_batch(self, x, h, w,
+                       angle_labels, robot_labels,
+                       full_x=None, scene_embedding=None):
+        """
+        See :meth:`GraspTorchObj.test_one_batch`. The server may run the
+        patches in one forward pass with patches of other clients.
+        """
+        assert full_x is not None or scene_embedding is not None
+        if scene_embedding is None:
+            scene_embedding = self.encode_scene(np.asarray(full_x))
+        with span('forward'):
+            reply = self._call(
+                {'op': 'predict', 'h': np.asarray(h, dtype=np.float32),
+                 'w': np.asarray(w, dtype=np.float32),
+                 'angle_labels': list(angle_labels),
+                 'robot_labels': list(robot_labels)},
+                {'x': x, 'embedding': scene_embedding.cpu().numpy()})
+        return reply['vals']
+
+    def dense_predict(self, img, patch_size, stride=None):
+        """
+        See :meth:`GraspTorchObj.dense_predict`.
+        """
+        with span('forward'):
+            reply = self._call({'op': 'dense_predict',
+                                'patch_size': patch_size, 'stride': stride},
+                               {'img': img})
+        return reply['heatmap'], reply['hs'], reply['ws']
+
+    def server_stats(self):
+        """
+        :returns: Queue and batching metrics of the server, see
+                  :meth:`grasp_samplers.grasp_server.MicroBatcher.stats`
+        :rtype: dict
+        """
+        return self._call({'op': 'stats'})['stats']
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+            self._arena.close()
@@ -16,14 +16,31 @@ from copy import deepcopy as copy
 
 import cv2
 import numpy as np
-import rospy
-from grasp_samplers.grasp_object import GraspTorchObj
-from grasp_samplers.grasp_predictor import Predictors
+import torch
+from grasp_samplers.grasp_client import RemoteGraspObj
+from grasp_samplers.grasp_object import EXPORT_SUFFIX, GraspTorchObj, \
+    is_fused_export
+from grasp_samplers.grasp_predictor import Predictors, RunningTopK, \
+    diverse_grasps, run_grasp_model, smooth_angles
+from grasp_samplers.grasp_search import AdaptiveGraspSearch
+from grasp_samplers.quantization import CALIBRATION_DIR, calibration_inputs, \
+    load_calibration_images
+from grasp_samplers.tracing import span
+
+try:
+    from rospy import loginfo
+except ImportError:
+    # Outside of ROS, e.g. in the offline replay and the batch evaluation
+    def loginfo(message):
+        print(message)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 SAVE_DIR = os.path.join(dir_path, 'models')
 GPU_ID = -1
 MAX_BATCHSIZE = 20
+# Streamed patches kept per diverse candidate, since the near-duplicates of
+# the best grasps that the NMS drops also fill the pool
+NMS_POOL_MARGIN = 8
 
 
 def download_if_not_present(model_path, url):
@@ -46,6 +63,33 @@ def download_if_not_present(model_path, url):
         os.system('wget {} -O {}'.format(url, model_path))
 
 
+def resolve_model_path(model_name, url=None, quantize=False):
+    """
+    Finds the grasp model to load, downloading it if needed. An exported
+    artifact with the same name and the `EXPORT_SUFFIX` extension is preferred
+    (see model_export.py), unless the model is quantized and the artifact
+    has its BatchNorm layers folded.
+
+    :param model_name: Name of the downloaded model in `SAVE_DIR`
+    :param url: URL for the model, only needed if the model is missing
+    :param quantize: The model will be quantized
+    :type model_name: string
+    :type url: string
+    :type quantize: bool
+
+    :returns: Path of the model
+    :rtype: string
+    """
+    model_path = os.path.join(SAVE_DIR, model_name)
+    exported_path = os.path.splitext(model_path)[0] + EXPORT_SUFFIX
+    if os.path.isfile(exported_path) and \
+            not (quantize and is_fused_export(exported_path)):
+        return exported_path
+    assert url is not None or os.path.isfile(model_path)
+    download_if_not_present(model_path, url)
+    return model_path
+
+
 def drawRectangle(I, h, w, t, gsize=300):
     """
     Function to draw a grasp rectangle on an image.
@@ -105,7 +149,12 @@ class GraspModel(object):
                  n_importance=1, n_sen=0,
                  n_sen_samples=0, sen_pixels=0,
                  sen_metric='mean', model_name=None,
-                 url=None):
+                 url=None, cache_scene=True, sampler='integral',
+                 profile=None, search='uniform', search_budget_ms=None,
+                 legacy_smoothing=True, warmup=True,
+                 calibration_dir=CALIBRATION_DIR, batch_size=MAX_BATCHSIZE,
+                 server_address=None, streaming=False, n_candidates=1,
+                 nms_distance=None, nms_angle=np.pi / 6):
         """
             The constructor for :class:`GraspModel` class.
 
@@ -116,8 +165,45 @@ class GraspModel(object):
             :param n_sen_samples: Number of samples for each patch
             :param sen_pixels: Number of pixels to compute sensitivity over
         :param sen_metric: Metric for sensitivity aggregation
-            :param model_name: Name of the downloaded model
-        :param url: URL for the model
+            :param model_name: Name of the downloaded model. If an exported
+                               artifact with the same name and the
+                               `EXPORT_SUFFIX` extension exists it is loaded
+                               instead (see model_export.py)
+        :param url: URL for the model, only needed if the model is missing
+            :param cache_scene: Encode each scene image once instead of once
+                                per sampled patch
+            :param sampler: Patch sampler used by :class:`Predictors`
+            :param profile: Execution settings of the grasp model
+            :param search: 'uniform' scores `nsamples` uniformly sampled
+                           patches, 'cem' refines the sampling distribution
+                           round by round and stops once the best score
+                           converges, using at most `nsamples` patches
+            :param search_budget_ms: Latency budget of the 'cem' search
+            :param legacy_smoothing: Smooth angles with the original in-place
+                                     semantics that existing score thresholds
+                                     were tuned on. False smooths with the
+                                     symmetric circular kernel, which shifts
+                                     the scores
+            :param warmup: Run a warm-up forward pass at load time
+            :param calibration_dir: Scene images the int8 model is calibrated
+                                    on when `profile.quantize` is set
+            :param batch_size: Maximum number of patches per forward pass
+            :param server_address: Unix socket of a grasp server (see
+                                   grasp_server.py) to run the grasp model
+                                   on instead of loading it; the server
+                                   settings replace `model_name`, `url`,
+                                   `profile` and `calibration_dir`
+            :param streaming: Evaluate the uniform samples batch by batch in
+                              reused buffers, keeping only the candidates
+                              that sensitivity and importance sampling use,
+                              so memory does not grow with `nsamples`
+            :param n_candidates: Number of diverse grasps ranked in
+                                 `candidates` after every prediction, as
+                                 fallbacks for the selected grasp
+            :param nms_distance: Pixel distance under which candidates are
+                                 duplicates, defaults to half a patch
+            :param nms_angle: Angle difference under which candidates are
+                              duplicates
 
             :type nsamples: int
             :type patchsize: int
@@ -128,92 +214,146 @@ class GraspModel(object):
             :type sen_metric: string
             :type model_name: string
             :type url: string
+            :type cache_scene: bool
+            :type sampler: string
+            :type profile: ExecutionProfile
+            :type search: string
+            :type search_budget_ms: float
+            :type legacy_smoothing: bool
+            :type warmup: bool
+            :type calibration_dir: string
+            :type batch_size: int
+            :type server_address: string
+            :type streaming: bool
+            :type n_candidates: int
+            :type nms_distance: float
+            :type nms_angle: float
             """
-        assert model_name is not None
-        assert url is not None
-        model_path = os.path.join(SAVE_DIR, model_name)
-        download_if_not_present(model_path, url)
-        if nsamples > MAX_BATCHSIZE:
-            self._batch_size = MAX_BATCHSIZE
-            self._nbatches = int(nsamples / MAX_BATCHSIZE) + 1
+        self.nsamples = nsamples
+        self.batch_size = batch_size
+        self._batch_size = min(nsamples, batch_size)
+        if server_address is not None:
+            print('Using the grasp server at {}'.format(server_address))
+            self.grasp_obj = RemoteGraspObj(server_address)
         else:
-            self._batch_size = nsamples
-            self._nbatches = 1
-        print('Loading grasp model')
-        st_time = time.time()
-        self.grasp_obj = GraspTorchObj(model_path)
-        print('Time taken to load model: {}s'.format(time.time() - st_time))
+            assert model_name is not None
+            model_path = resolve_model_path(
+                model_name, url, profile is not None and profile.quantize)
+            print('Loading grasp model from {}'.format(model_path))
+            self.grasp_obj = GraspTorchObj(model_path, profile=profile)
+        if server_address is None and self.grasp_obj.profile.quantize:
+            st_time = time.time()
+            images = load_calibration_images(calibration_dir)
+            self.grasp_obj.quantize(calibration_inputs(self.grasp_obj, images,
+                                                       patchsize))
+            self.grasp_obj.load_time += time.time() - st_time
+        if warmup:
+            st_time = time.time()
+            self.grasp_obj.warmup()
+            self.grasp_obj.warmup_time = time.time() - st_time
+        print('Time taken to load model: {}s (warm-up {}s)'.format(
+            self.grasp_obj.load_time, self.grasp_obj.warmup_time))
+        print('Execution profile: {}'.format(self.grasp_obj.profile))
         self.patchsize = patchsize
         self.n_importance = n_importance
         self.n_sen = n_sen
         self.n_sen_samples = n_sen_samples
         self.sen_pixels = sen_pixels
         self.sen_metric = sen_metric
+        self.cache_scene = cache_scene
+        self.sampler = sampler
+        self.search = search
+        self.search_budget_ms = search_budget_ms
+        self.legacy_smoothing = legacy_smoothing
+        self.streaming = streaming
+        self.n_candidates = n_candidates
+        self.nms_distance = nms_distance
+        if nms_distance is None:
+            self.nms_distance = patchsize / 2.
+        self.nms_angle = nms_angle
+        self.candidates = []
+        self._display = None
+        self._disp_I = None
+        self._patch_buffer = None
+        self.num_forwards = 0
         self.sen_metrics = ['mean', 'min']
+        self.modes = ['sampled', 'dense']
+        self.searches = ['uniform', 'cem']
+        assert self.search in self.searches
         assert self.sen_metric in self.sen_metrics
         assert self.n_sen_samples <= MAX_BATCHSIZE
 
-    def predict(self, I):
+    def predict(self, I, mode='sampled', stride=None, sample_weights=None):
         """
         Runs prediction on a given image.
 
         :param I: An image
+        :param mode: 'sampled' scores `nsamples` random patches, 'dense'
+                     scores a regular grid of patches in one shared pass
+        :param stride: Distance in pixels between patch centers in 'dense'
+                       mode, defaults to one feature cell
+        :param sample_weights: Map of the image size that patch centers are
+                               sampled proportionally to in 'sampled' mode,
+                               e.g. a mask of the objects (see
+                               :class:`Predictors`)
         :type I: np.ndarray
+        :type mode: string
+        :type stride: int
+        :type sample_weights: np.ndarray
 
-        :returns: selected grasp configuration (height, width, angle, confidence)
+        :returns: selected grasp configuration (height, width, angle,
+                  confidence); in 'dense' mode a tuple of the selected grasp
+                  and the (H', W', 18) smoothed angle-score heatmap. The
+                  selected grasp and up to `n_candidates` - 1 diverse
+                  fallbacks are kept in `candidates`, best first
         :rtype: tuple
         """
+        assert mode in self.modes
+        with span('predict'):
+            return self._predict(I, mode, stride, sample_weights)
+
+    def _predict(self, I, mode, stride, sample_weights=None):
         start_time = time.time()
-        rospy.loginfo('Running TORCH-GRASPING!')
+        loginfo('Running TORCH-GRASPING!')
 
         # First round of forward pass
-        result = self._predict_image(I, self._nbatches, self._batch_size)
-        init_predictions, init_patch_Hs, init_patch_Ws = result
+        if mode == 'dense':
+            P = self._predictors(I)
+            P.graspNet_dense(patch_size=int(self.patchsize), stride=stride)
+            init_predictions = P.norm_vals
+            init_patch_Hs, init_patch_Ws = P.patch_hs, P.patch_ws
+            self.num_forwards = len(init_predictions)
+        elif self.search == 'cem':
+            result = self._search_image(I, sample_weights)
+            init_predictions, init_patch_Hs, init_patch_Ws = result
+        elif self.streaming:
+            for result in self._stream_image(I, sample_weights):
+                pass
+            init_predictions, init_patch_Hs, init_patch_Ws, \
+                self.num_forwards = result
+        else:
+            result = self._predict_image(I, self.nsamples, self._batch_size,
+                                         sample_weights)
+            init_predictions, init_patch_Hs, init_patch_Ws = result
+            self.num_forwards = len(init_predictions)
 
         # Predicting for second round of sensitivity
-        sen_study = []
-        sen_options = []
         if self.n_sen <= 0:
             predictions, patch_Hs, patch_Ws = init_predictions, \
                                               init_patch_Hs, init_patch_Ws
         else:
-            im_shape = I.shape
             r = np.argsort(np.max(init_predictions, 1))
             r_best = r[-self.n_sen:][::-1]
-            for r_ind in r_best:
-                patch_h = init_patch_Hs[r_ind]
-                patch_w = init_patch_Ws[r_ind]
-                scan_size = self.patchsize + self.sen_pixels
-                scan_halfsize = int(scan_size / 2)
-                scan_region = [patch_h - scan_halfsize,
-                               patch_h + scan_halfsize,
-                               patch_w - scan_halfsize,
-                               patch_w + scan_halfsize]
-                if scan_region[0] < 0 or scan_region[1] >= im_shape[0] \
-                        or scan_region[2] < 0 or scan_region[3] >= \
-                        im_shape[1]:
-                    continue
-                else:
-                    I_hw = I[scan_region[0]:scan_region[1],
-                           scan_region[2]:scan_region[3]]
-                    result = self._predict_image(I_hw, 1, self.n_sen_samples)
-                    hw_predictions, hw_patch_Hs, hw_patch_Ws = result
-                    sen_study.append(copy([hw_predictions,
-                                           hw_patch_Hs, hw_patch_Ws]))
-                    sen_options.append(r_ind)
+            with span('sensitivity'):
+                stability, sen_options = self._predict_sensitivity(
+                    I, init_patch_Hs[r_best], init_patch_Ws[r_best])
             if len(sen_options) == 0:
                 predictions = init_predictions
                 patch_Hs = init_patch_Hs
                 patch_Ws = init_patch_Ws
             else:
-                stability = []
-                for option in sen_study:
-                    if self.sen_metric == 'mean':
-                        stability.append(option[0].mean(0))
-                    elif self.sen_metric == 'min':
-                        stability.append(option[0].min(0))
-                stability = np.array(stability)
-                predictions = copy(stability)
+                sen_options = r_best[sen_options]
+                predictions = stability
                 patch_Hs = init_patch_Hs[sen_options]
                 patch_Ws = init_patch_Ws[sen_options]
 
@@ -237,25 +377,30 @@ class GraspModel(object):
             patch_Ws[patch_ind],
             grasp_angle,
             predictions[patch_ind, theta_choice_ind])
-        self._disp_I = drawRectangle(I,
-                                     selected_grasp[0],
-                                     selected_grasp[1],
-                                     theta_choice_ind,
-                                     int(self.patchsize))
-        rospy.loginfo('Grasp prediction took: {} (s)'
-                      ''.format(time.time() - start_time))
+        candidates = [selected_grasp]
+        if self.n_candidates > 1:
+            candidates = diverse_grasps(predictions, patch_Hs, patch_Ws,
+                                        self.n_candidates, self.nms_distance,
+                                        self.nms_angle, selected_grasp)
+        self.set_prediction(I, candidates)
+        loginfo('Grasp prediction took: {} (s)'
+                ''.format(time.time() - start_time))
+        if mode == 'dense':
+            return selected_grasp, P.heatmap
         return selected_grasp
 
-    def _predict_image(self, I, nbs, bs):
+    def _predict_image(self, I, nsamples, bs, sample_weights=None):
         """
         Compute raw network predictions
 
         :param I: Scene image
-        :param nbs: Number of batches
+        :param nsamples: Number of samples
         :param bs: Batch size
+        :param sample_weights: Sampling weights of the patch centers
         :type I: np.ndarray
-        :type nbs: int
+        :type nsamples: int
         :type bs: int
+        :type sample_weights: np.ndarray
 
         :returns: Grasp predictions
         :rtype: tuple
@@ -264,13 +409,14 @@ class GraspModel(object):
         assert self.patchsize < min_imsize, \
             'Input image dimensions are too small'
         gsize = int(self.patchsize)
-        P = Predictors(I, self.grasp_obj)
+        P = self._predictors(I, sample_weights)
         predictions = []
         patch_Hs = []
         patch_Ws = []
-        rospy.loginfo('Torch grasp_model: Predicting on samples')
-        for _ in range(nbs):
-            P.graspNet_grasp(patch_size=gsize, num_samples=bs)
+        loginfo('Torch grasp_model: Predicting on samples')
+        for st in range(0, nsamples, bs):
+            P.graspNet_grasp(patch_size=gsize,
+                             num_samples=min(bs, nsamples - st))
             predictions.append(P.norm_vals)
             patch_Hs.append(P.patch_hs)
             patch_Ws.append(P.patch_ws)
@@ -280,14 +426,277 @@ class GraspModel(object):
         patch_Ws = np.concatenate(patch_Ws)
         return predictions, patch_Hs, patch_Ws
 
-    def display_predicted_image(self):
+    def predict_stream(self, I, sample_weights=None):
+        """
+        Runs the uniform sampling of :meth:`predict` on a given image batch
+        by batch, in the streaming mode.
+
+        :param I: An image
+        :param sample_weights: Sampling weights of the patch centers
+        :type I: np.ndarray
+        :type sample_weights: np.ndarray
+
+        :returns: After every batch, the best grasp (height, width, angle,
+                  confidence) among the patches evaluated so far, before
+                  sensitivity and importance sampling, and the number of
+                  evaluated patches
+        :rtype: generator
+        """
+        for predictions, patch_Hs, patch_Ws, n in \
+                self._stream_image(I, sample_weights):
+            theta_choice_ind = np.argmax(predictions[0])
+            grasp_angle = theta_choice_ind * (np.pi / 18) - np.pi / 2
+            yield (patch_Hs[0], patch_Ws[0], grasp_angle,
+                   predictions[0, theta_choice_ind]), n
+
+    def _stream_image(self, I, sample_weights=None):
+        """
+        Compute raw network predictions batch by batch, keeping the best
+        `max(n_sen, n_importance)` candidates, or `NMS_POOL_MARGIN` per
+        diverse grasp for the NMS when there are more. Patches are sampled
+        into one buffer that is reused across batches and images.
+
+        :param I: Scene image
+        :param sample_weights: Sampling weights of the patch centers
+        :type I: np.ndarray
+        :type sample_weights: np.ndarray
+
+        :returns: After every batch, the predictions, heights and widths of
+                  the best candidates so far, best first, and the number of
+                  evaluated patches
+        :rtype: generator
+        """
+        min_imsize = min(I.shape[:2])
+        assert self.patchsize < min_imsize, \
+            'Input image dimensions are too small'
+        assert self.nsamples > 0, 'Streaming needs at least one sample'
+        gsize = int(self.patchsize)
+        bs = self._batch_size
+        shape = (bs, gsize, gsize, I.shape[2])
+        if self._patch_buffer is None or self._patch_buffer.shape != shape \
+                or self._patch_buffer.dtype != I.dtype:
+            self._patch_buffer = np.empty(shape, dtype=I.dtype)
+        P = self._predictors(I, sample_weights)
+        pool_size = max(self.n_sen, self.n_importance)
+        if self.n_candidates > 1:
+            pool_size = max(pool_size, self.n_candidates * NMS_POOL_MARGIN)
+        top = RunningTopK(pool_size, bs)
+        loginfo('Torch grasp_model: Streaming predictions on samples')
+        for st in range(0, self.nsamples, bs):
+            n = min(bs, self.nsamples - st)
+            P.graspNet_grasp(patch_size=gsize, num_samples=n,
+                             out=self._patch_buffer[:n])
+            top.push(P.norm_vals, P.patch_hs, P.patch_ws)
+            predictions, patch_Hs, patch_Ws = top.result()
+            yield predictions, patch_Hs, patch_Ws, st + n
+
+    def _predictors(self, I, sample_weights=None):
+        """
+        Creates a :class:`Predictors` object configured like this model
+
+        :param I: Scene image
+        :param sample_weights: Sampling weights of the patch centers
+        :type I: np.ndarray
+        :type sample_weights: np.ndarray
+
+        :returns: Patch sampler of the scene image
+        :rtype: Predictors
+        """
+        return Predictors(I, self.grasp_obj, cache_scene=self.cache_scene,
+                          sampler=self.sampler,
+                          legacy_smoothing=self.legacy_smoothing,
+                          sample_weights=sample_weights)
+
+    def _search_image(self, I, sample_weights=None):
+        """
+        Compute raw network predictions with the adaptive 'cem' search
+
+        :param I: Scene image
+        :param sample_weights: Sampling weights of the uniform patches
+        :type I: np.ndarray
+        :type sample_weights: np.ndarray
+
+        :returns: Grasp predictions
+        :rtype: tuple
+        """
+        min_imsize = min(I.shape[:2])
+        assert self.patchsize < min_imsize, \
+            'Input image dimensions are too small'
+        P = self._predictors(I, sample_weights)
+        search = AdaptiveGraspSearch(P, int(self.patchsize),
+                                     self._batch_size, self.nsamples,
+                                     budget_ms=self.search_budget_ms)
+        result = search.run()
+        self.num_forwards = search.num_forwards
+        loginfo('Torch grasp_model: searched {} samples in {} rounds '
+                '({})'.format(search.num_forwards, search.num_rounds,
+                              search.stop_reason))
+        return result
+
+    def _predict_sensitivity(self, I, patch_Hs, patch_Ws):
+        """
+        Computes the stability of candidate grasps by re-sampling patches
+        around each of them. The patches of every candidate are evaluated
+        together in full batches and the scores are scattered back.
+
+        :param I: Scene image
+        :param patch_Hs: Heights of the candidate patch centers
+        :param patch_Ws: Widths of the candidate patch centers
+        :type I: np.ndarray
+        :type patch_Hs: np.ndarray
+        :type patch_Ws: np.ndarray
+
+        :returns: Stability scores of shape (n_options, n_class) and the
+                  indices of the candidates that could be scanned
+        :rtype: tuple
+        """
+        im_shape = I.shape
+        gsize = int(self.patchsize)
+        scan_size = self.patchsize + self.sen_pixels
+        scan_halfsize = int(scan_size / 2)
+        sen_options = []
+        crops = []
+        for ind, (patch_h, patch_w) in enumerate(zip(patch_Hs, patch_Ws)):
+            scan_region = [patch_h - scan_halfsize,
+                           patch_h + scan_halfsize,
+                           patch_w - scan_halfsize,
+                           patch_w + scan_halfsize]
+            if scan_region[0] < 0 or scan_region[1] >= im_shape[0] \
+                    or scan_region[2] < 0 or scan_region[3] >= \
+                    im_shape[1]:
+                continue
+            crops.append(I[scan_region[0]:scan_region[1],
+                           scan_region[2]:scan_region[3]])
+            sen_options.append(ind)
+        if len(sen_options) == 0:
+            return None, sen_options
+
+        # Sample every candidate's patches up front
+        samples = [self._predictors(I_hw).sample_patches(
+            gsize, self.n_sen_samples) for I_hw in crops]
+        hw_patch_Hs = np.concatenate([sample[0] for sample in samples])
+        hw_patch_Ws = np.concatenate([sample[1] for sample in samples])
+        hw_patch_Is = np.concatenate([sample[2] for sample in samples])
+        crop_inds = np.repeat(np.arange(len(crops)), self.n_sen_samples)
+        crops = np.array(crops)
+        if self.cache_scene:
+            crop_embeddings = self.grasp_obj.encode_scene(crops)
+
+        predictions = []
+        for st in range(0, len(hw_patch_Is), self.batch_size):
+            batch = slice(st, st + self.batch_size)
+            model_inputs = {}
+            if self.cache_scene:
+                batch_inds = torch.from_numpy(crop_inds[batch])
+                model_inputs['scene_embedding'] = crop_embeddings[
+                    batch_inds.to(crop_embeddings.device)]
+            else:
+                model_inputs['full_x'] = crops[crop_inds[batch]]
+            vals, _ = run_grasp_model(self.grasp_obj, hw_patch_Is[batch],
+                                      hw_patch_Hs[batch], hw_patch_Ws[batch],
+                                      **model_inputs)
+            predictions.append(smooth_angles(vals, self.legacy_smoothing))
+        predictions = np.concatenate(predictions).reshape(
+            len(crops), self.n_sen_samples, -1)
+        if self.sen_metric == 'mean':
+            stability = predictions.mean(1)
+        elif self.sen_metric == 'min':
+            stability = predictions.min(1)
+        return stability, np.array(sen_options)
+
+    def rescore(self, I, grasps):
+        """
+        Re-evaluates grasps predicted on an earlier image of the same scene,
+        with one forward pass on their patches instead of a new prediction.
+
+        :param I: New image of the scene
+        :param grasps: Grasps (height, width, angle, confidence)
+        :type I: np.ndarray
+        :type grasps: list
+
+        :returns: As many diverse grasps (height, width, angle, confidence)
+                  at the points of `grasps`, ranked on the new image, best
+                  first. A point may keep several angles. They also replace
+                  `candidates`. Points whose patch does not fit in the new
+                  image are dropped, and the image is predicted on anew when
+                  none is left
+        :rtype: list
+        """
+        with span('rescore'):
+            # Each point is evaluated once, whatever its number of angles
+            points = []
+            for grasp in grasps:
+                point = (int(grasp[0]), int(grasp[1]))
+                if point not in points:
+                    points.append(point)
+            patch_Hs = np.array([h for h, _ in points], dtype=int)
+            patch_Ws = np.array([w for _, w in points], dtype=int)
+            P = self._predictors(I)
+            valid = P.valid_centers(int(self.patchsize), patch_Hs, patch_Ws)
+            patch_Hs = patch_Hs[valid]
+            patch_Ws = patch_Ws[valid]
+            predictions = []
+            for st in range(0, len(patch_Hs), self._batch_size):
+                batch = slice(st, st + self._batch_size)
+                P.graspNet_points(int(self.patchsize), patch_Hs[batch],
+                                  patch_Ws[batch])
+                predictions.append(P.norm_vals)
+        if not predictions:
+            print('No grasp fits in the new image, predicting again')
+            self.predict(I)
+            return self.candidates
+        predictions = np.concatenate(predictions)
+        self.num_forwards = len(predictions)
+        rescored = diverse_grasps(predictions, patch_Hs, patch_Ws,
+                                  len(grasps), self.nms_distance,
+                                  self.nms_angle)
+        self.set_prediction(I, rescored)
+        return rescored
+
+    def set_prediction(self, I, candidates):
+        """
+        Makes grasps predicted on an image the current prediction, e.g.
+        when they are reused from a cache. The image with the best grasp is
+        only drawn if it is displayed or saved.
+
+        :param I: Scene image
+        :param candidates: Grasps (height, width, angle, confidence), best
+                           first
+        :type I: np.ndarray
+        :type candidates: list
+        """
+        self.candidates = list(candidates)
+        self._display = (I, self.candidates[0])
+        self._disp_I = None
+
+    def predicted_image(self):
+        """
+        Draws the predicted grasp on a copy of the scene image.
+
+        :returns: Scene image with the grasp, None before any prediction
+        :rtype: np.ndarray
+        """
+        if self._disp_I is None and self._display is not None:
+            I, (h, w, angle, _) = self._display
+            theta_ind = int(round((angle + np.pi / 2) / (np.pi / 18)))
+            self._disp_I = drawRectangle(I.copy(), h, w, theta_ind,
+                                         int(self.patchsize))
+        return self._disp_I
+
+    def display_predicted_image(self, disp_I=None):
         """
         Display the scene image with the predicted grasp
+
+        :param disp_I: Image to display instead of :meth:`predicted_image`,
+                       e.g. a copy taken while the model was locked
+        :type disp_I: np.ndarray
         """
-        if self._disp_I is None:
+        if disp_I is None:
+            disp_I = self.predicted_image()
+        if disp_I is None:
             return False
         print('Visualizing grasp; hit "space" to continue')
-        cv2.imshow('image', cv2.cvtColor(self._disp_I, cv2.COLOR_BGR2RGB))
+        cv2.imshow('image', cv2.cvtColor(disp_I, cv2.COLOR_BGR2RGB))
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
@@ -298,6 +707,7 @@ class GraspModel(object):
         :param img_fname: Path of image file where the grasp should be saved
         :type img_fname: string
         """
-        if self._disp_I is None:
+        disp_I = self.predicted_image()
+        if disp_I is None:
             return
-        cv2.imwrite(img_fname, self._disp_I)
+        cv2.imwrite(img_fname, disp_I)
@@ -10,11 +10,16 @@ Class definition for GraspTorchObj.
 """
 
 import sys
+import time
+from collections import OrderedDict
 
 import numpy as np
 import torch
+import torch.nn.functional as F
+from grasp_samplers.quantization import quantize_grasp_model
+from grasp_samplers.tracing import span
 from PIL import Image
-from torch.autograd import Variable
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision import transforms
 
 import deeper_models
@@ -24,6 +29,250 @@ sys.modules['patch_learner.deeper_models'] = deeper_models
 is_gpu = torch.cuda.is_available()
 n_class = 18
 n_rob = 5
+IMAGE_MEAN = torch.FloatTensor([0.485, 0.456, 0.406])
+IMAGE_STD = torch.FloatTensor([0.229, 0.224, 0.225])
+EXPORT_SUFFIX = '.export.pt'
+# Number of (input size, output size) pairs whose preprocessing buffers are
+# kept, e.g. one per patch size
+PREPROCESS_BUFFERS = 4
+
+
+def load_checkpoint(model_path):
+    """
+    Loads a fully pickled grasp model and fixes it up for the installed torch
+    version.
+
+    :param model_path: Path of the checkpoint
+    :type model_path: string
+
+    :returns: The grasp model in eval mode
+    :rtype: deeper_models.IfullRobHWNet
+    """
+    torch.nn.Module.dump_patches = True
+    model = torch.load(model_path, map_location='cpu')
+    recursion_change_bn(model)
+    model.eval()
+    model.avgpool = torch.nn.AdaptiveAvgPool2d((1, 1))
+    return model
+
+
+def load_artifact(model_path):
+    """
+    Memory-maps an artifact exported by model_export.py.
+
+    :param model_path: Path of the exported artifact
+    :type model_path: string
+
+    :returns: The artifact
+    :rtype: dict
+    """
+    try:
+        artifact = torch.load(model_path, map_location='cpu', mmap=True,
+                              weights_only=True)
+    except TypeError:
+        # torch < 2.1 can neither memory-map nor restrict unpickling
+        artifact = torch.load(model_path, map_location='cpu')
+    assert artifact['arch'] == 'IfullRobHWNet'
+    return artifact
+
+
+def is_fused_export(model_path):
+    """
+    :returns: Whether an exported artifact has its BatchNorm layers folded
+    :rtype: bool
+    """
+    return load_artifact(model_path).get('fused_bn', False)
+
+
+def load_exported_model(model_path):
+    """
+    Loads a grasp model exported by model_export.py. The weights are
+    memory-mapped and assigned to a model built on the meta device, so
+    nothing is randomly initialized or copied (on torch >= 2.1). Artifacts
+    exported with folded BatchNorm layers are loaded into a model with the
+    same folded layout.
+
+    :param model_path: Path of the exported artifact
+    :type model_path: string
+
+    :returns: The grasp model in eval mode
+    :rtype: deeper_models.IfullRobHWNet
+    """
+    artifact = load_artifact(model_path)
+    fused_bn = artifact.get('fused_bn', False)
+    try:
+        with torch.device('meta'):
+            model = deeper_models.IfullRobHWNet(pretrained_resnet18=False,
+                                                **artifact['kwargs']).eval()
+            if fused_bn:
+                fuse_conv_bn(model)
+        model.load_state_dict(artifact['state_dict'], assign=True)
+    except (AttributeError, TypeError):
+        model = deeper_models.IfullRobHWNet(pretrained_resnet18=False,
+                                            **artifact['kwargs']).eval()
+        if fused_bn:
+            fuse_conv_bn(model)
+        model.load_state_dict(artifact['state_dict'])
+    return model.eval()
+
+
+def fuse_conv_bn(module):
+    """
+    Folds every BatchNorm2d that directly follows a convolution inside the
+    ResNet trunk into that convolution. Only valid in eval mode.
+
+    :param module: Root module of the grasp model
+    :type module: torch.nn.Module
+
+    :returns: The same module
+    :rtype: torch.nn.Module
+    """
+    pairs = [(module, 'conv1', 'bn1')]
+    for layer in [module.layer1, module.layer2,
+                  module.layer3, module.layer4]:
+        for block in layer:
+            pairs.append((block, 'conv1', 'bn1'))
+            pairs.append((block, 'conv2', 'bn2'))
+            if block.downsample is not None:
+                pairs.append((block.downsample, '0', '1'))
+    for parent, conv_name, bn_name in pairs:
+        conv = parent._modules[conv_name]
+        bn = parent._modules[bn_name]
+        if not isinstance(bn, torch.nn.BatchNorm2d):
+            continue
+        parent._modules[conv_name] = fuse_conv_bn_eval(conv, bn)
+        parent._modules[bn_name] = torch.nn.Identity()
+    return module
+
+
+def has_bn(module):
+    """
+    :returns: Whether a model still has BatchNorm layers
+    :rtype: bool
+    """
+    return any(isinstance(m, torch.nn.BatchNorm2d) for m in module.modules())
+
+
+def recursion_change_bn(module):
+    """
+    Marks every BatchNorm2d of a model pickled with an older torch version as
+    tracking running statistics.
+
+    :param module: Root module
+    :type module: torch.nn.Module
+
+    :returns: The same module
+    :rtype: torch.nn.Module
+    """
+    if isinstance(module, torch.nn.BatchNorm2d):
+        module.track_running_stats = 1
+    else:
+        for i, (name, module1) in enumerate(module._modules.items()):
+            module1 = recursion_change_bn(module1)
+    return module
+
+
+def resize_bilinear(x, size):
+    """
+    Resizes a batch of images like the PIL bilinear resize of the default
+    transform, which averages over the whole footprint of an output pixel
+    when shrinking.
+
+    :param x: Images of shape (N, C, H, W)
+    :param size: Output (height, width)
+    :type x: torch Tensor
+    :type size: tuple
+
+    :returns: Resized images of shape (N, C, height, width)
+    :rtype: torch Tensor
+    """
+    try:
+        return F.interpolate(x, size=size, mode='bilinear',
+                             align_corners=False, antialias=True)
+    except TypeError:
+        # torch < 1.11 cannot antialias, shrinking averages the covered
+        # pixels instead
+        if x.shape[2] >= size[0] and x.shape[3] >= size[1]:
+            return F.interpolate(x, size=size, mode='area')
+        return F.interpolate(x, size=size, mode='bilinear',
+                             align_corners=False)
+
+
+class ExecutionProfile(object):
+    """
+    This class describes how a :class:`GraspTorchObj` runs the grasp model.
+    """
+
+    def __init__(self, inference_mode=True, intra_op_threads=None,
+                 inter_op_threads=None, fuse_bn=True, channels_last=False,
+                 quantize=False):
+        """
+        The constructor for :class:`ExecutionProfile` class.
+
+        :param inference_mode: Run the model under torch.inference_mode (or
+                               torch.no_grad on older torch versions)
+        :param intra_op_threads: Number of threads used inside an operator,
+                                 None keeps the torch default
+        :param inter_op_threads: Number of threads used across operators,
+                                 None keeps the torch default
+        :param fuse_bn: Fold every BatchNorm layer into the preceding
+                        convolution at load time. Exported artifacts are
+                        folded at export time instead, see model_export.py
+        :param channels_last: Use the channels_last memory format for the
+                              model and its input buffers
+        :param quantize: Run an int8 copy of the model on the CPU, see
+                         :meth:`GraspTorchObj.quantize`
+        :type inference_mode: bool
+        :type intra_op_threads: int
+        :type inter_op_threads: int
+        :type fuse_bn: bool
+        :type channels_last: bool
+        :type quantize: bool
+        """
+        self.inference_mode = inference_mode
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.fuse_bn = fuse_bn
+        self.channels_last = channels_last
+        self.quantize = quantize
+
+    def apply(self):
+        """
+        Applies the thread settings to the torch runtime.
+        """
+        if self.intra_op_threads is not None:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                # Can only be set before any inter-op parallel work started
+                print('Could not set inter-op threads to {}, keeping {}'
+                      ''.format(self.inter_op_threads,
+                                torch.get_num_interop_threads()))
+
+    def context(self):
+        """
+        Returns the context manager the model should be run under.
+
+        :returns: A torch grad mode context manager
+        :rtype: context manager
+        """
+        if not self.inference_mode:
+            # Leave the caller's grad mode untouched
+            return torch.set_grad_enabled(torch.is_grad_enabled())
+        if hasattr(torch, 'inference_mode'):
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def __str__(self):
+        return ('inference_mode={}, intra_op_threads={}, '
+                'inter_op_threads={}, fuse_bn={}, channels_last={}, '
+                'dtype={}'.format(self.inference_mode,
+                                  torch.get_num_threads(),
+                                  torch.get_num_interop_threads(),
+                                  self.fuse_bn, self.channels_last,
+                                  'int8' if self.quantize else 'float32'))
 
 
 class GraspTorchObj(object):
@@ -31,33 +280,100 @@ class GraspTorchObj(object):
     This class contains functionality to wrap a torch grasp model with testing operations.
     """
 
-    def __init__(self, model_path, transform=None):
+    def __init__(self, model_path, transform=None, profile=None,
+                 warmup=False):
         """
             The constructor for :class:`GraspTorchObj` class.
     
-            :param model_path: Path where the grasp model should be loaded from
-            :param transform: A PyTorch transform that gets applied on the input
+            :param model_path: Path where the grasp model should be loaded from.
+                               Paths ending in `EXPORT_SUFFIX` are loaded as
+                               exported artifacts (see model_export.py)
+            :param transform: A PyTorch transform that gets applied on the input.
+                              When not given, inputs are resized and normalized
+                              as whole batches instead of one PIL image at a time
+            :param profile: Execution settings of the model, defaults to
+                            :class:`ExecutionProfile` ()
+            :param warmup: Run a warm-up forward pass after loading
             :type model_path: string
             :type transform: A torchvision.Transform object
+            :type profile: ExecutionProfile
+            :type warmup: bool
             """
-        torch.nn.Module.dump_patches = True
-        check_point = torch.load(model_path)
-        self.model = check_point
-        for i, (name, module) in enumerate(self.model._modules.items()):
-            module = self.recursion_change_bn(self.model)
-        self.model.eval()
-        self.model.avgpool = torch.nn.AdaptiveAvgPool2d((1, 1))
+        st_time = time.time()
+        if profile is None:
+            profile = ExecutionProfile()
+        self.profile = profile
+        self.profile.apply()
+        exported = model_path.endswith(EXPORT_SUFFIX)
+        if exported:
+            self.model = load_exported_model(model_path)
+        else:
+            self.model = load_checkpoint(model_path)
+        # Quantization fuses conv/bn/relu itself and needs the BatchNorm layers
+        if self.profile.quantize and not has_bn(self.model):
+            raise ValueError('{} was exported with folded BatchNorm layers '
+                             'and cannot be quantized, export it with '
+                             '--keep_bn'.format(model_path))
+        # Folding copies the weights, which would undo the memory-mapped
+        # load of an artifact
+        if self.profile.fuse_bn and not self.profile.quantize and \
+                not exported:
+            self.fuse_bn(self.model)
         self.image_size = 224
-        if is_gpu:
+        # Quantized kernels only exist for the CPU
+        self.use_gpu = is_gpu and not self.profile.quantize
+        if self.use_gpu:
             self.model = self.model.cuda()
+        self.channels_last = self.profile.channels_last
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        # Patches no longer need to be resized by the caller when the
+        # default transform is applied batch-wise
+        self.batched_preprocess = transform is None
         if transform is None:
             self.transform = self.get_default_transform()
         else:
             self.transform = transform
+        # Normalize([mean], [std]) on [0, 255] inputs as x * scale + bias
+        self._norm_scale = (1. / (255. * IMAGE_STD)).view(1, 3, 1, 1)
+        self._norm_bias = (-IMAGE_MEAN / IMAGE_STD).view(1, 3, 1, 1)
+        self._buffers = OrderedDict()
+        self.load_time = time.time() - st_time
+        self.warmup_time = 0.
+        if warmup:
+            st_time = time.time()
+            self.warmup()
+            self.warmup_time = time.time() - st_time
+
+    def warmup(self):
+        """
+        Runs the model once on a blank input so that the first real request
+        does not pay for lazy initialization.
+        """
+        blank = np.zeros((1, self.image_size, self.image_size, 3),
+                         dtype=np.uint8)
+        scene_embedding = self.encode_scene(blank[0])
+        self.test_one_batch(blank, [0], [0], [0], [0],
+                            scene_embedding=scene_embedding)
+
+    def quantize(self, inputs, backend=None):
+        """
+        Replaces the model by its int8 version, see
+        :func:`grasp_samplers.quantization.quantize_grasp_model`.
+
+        :param inputs: Normalized image tensors used for calibration, for
+                       instance from
+                       :func:`grasp_samplers.quantization.calibration_inputs`
+        :param backend: Quantized engine, defaults to the one of this host
+        :type inputs: iterable
+        :type backend: string
+        """
+        assert self.profile.quantize, 'The profile must enable quantize'
+        self.model = quantize_grasp_model(self.model, inputs, backend)
 
     def test_one_batch(self, x, h, w,
                        angle_labels, robot_labels,
-                       full_x):
+                       full_x=None, scene_embedding=None):
         """
         Runs the torch model on a batch of inputs.
     
@@ -67,36 +383,103 @@ class GraspTorchObj(object):
             :param angle_labels: List of labels corresponding to the angle to grasp
             :param robot_labels: List of robot_id corresponding to the robot
             :param full_x: List of original image where the patch comes from.
+            :param scene_embedding: Precomputed embedding of the original image
+                                    (see :meth:`encode_scene`), used instead
+                                    of `full_x` when given
             :type x: list
             :type h: list
             :type w: list
             :type angle_labels: list
             :type robot_labels: list
             :type full_x: list
+            :type scene_embedding: torch Tensor
     
             :returns: List of grasp predictions
             :rtype: list
         """
-        torch_patches_var = Variable(self.convert_cv2_patches(x))
-        h_var = Variable(self.convert_hw(h))
-        w_var = Variable(self.convert_hw(w))
-        one_hot_var = self.convert_one_hot(angle_labels)
-        robot_one_hot_var = self.convert_robot_one_hot(robot_labels)
-        torch_images_var = Variable(self.convert_cv2_patches(full_x))
+        assert full_x is not None or scene_embedding is not None
+        with span('preprocess'):
+            torch_patches_var = self.convert_cv2_patches(x)
+            h_var = self.convert_hw(h)
+            w_var = self.convert_hw(w)
+            one_hot_var = self.convert_one_hot(angle_labels)
+            robot_one_hot_var = self.convert_robot_one_hot(robot_labels)
+            torch_images_var = None
+            if scene_embedding is None:
+                torch_images_var = self.convert_cv2_patches(full_x)
+        return self.forward(torch_patches_var, h_var, w_var, one_hot_var,
+                            robot_one_hot_var, torch_images_var,
+                            scene_embedding)
+
+    def forward(self, torch_patches_var, h_var, w_var, one_hot_var,
+                robot_one_hot_var, torch_images_var=None,
+                scene_embedding=None):
+        """
+        Runs the torch model on converted inputs, see :meth:`test_one_batch`.
+
+        :param torch_patches_var: Normalized patches, see
+                                  :meth:`convert_cv2_patches`
+        :param h_var: Heights of the patch centers
+        :param w_var: Widths of the patch centers
+        :param one_hot_var: One-hot angle labels
+        :param robot_one_hot_var: One-hot robot labels
+        :param torch_images_var: Normalized scene image of every patch
+        :param scene_embedding: Precomputed scene embeddings, used instead of
+                                `torch_images_var` when given
+        :type torch_patches_var: torch Tensor
+        :type h_var: torch FloatTensor
+        :type w_var: torch FloatTensor
+        :type one_hot_var: torch Tensor
+        :type robot_one_hot_var: torch Tensor
+        :type torch_images_var: torch Tensor
+        :type scene_embedding: torch Tensor
 
-        if is_gpu:
+        :returns: Array of grasp predictions
+        :rtype: np.ndarray
+        """
+        if self.use_gpu:
             torch_patches_var = torch_patches_var.cuda()
             h_var = h_var.cuda()
             w_var = w_var.cuda()
             one_hot_var = one_hot_var.cuda()
             robot_one_hot_var = robot_one_hot_var.cuda()
-            torch_images_var = torch_images_var.cuda()
-        predictions, _ = self.model(x=torch_patches_var,
-                                    h=h_var, w=w_var,
-                                    one_hot_labels=one_hot_var,
-                                    robot_one_hot_labels=robot_one_hot_var,
-                                    full_x=torch_images_var)
-        return predictions.data.cpu().numpy()
+            if torch_images_var is not None:
+                torch_images_var = torch_images_var.cuda()
+            if scene_embedding is not None:
+                scene_embedding = scene_embedding.cuda()
+        with span('forward'), self.profile.context():
+            # The model's own forward, split to time the trunk and the heads
+            with span('backbone'):
+                if scene_embedding is None:
+                    scene_embedding = self.model.encode_scene(
+                        torch_images_var)
+                pool_out = self.model.encode_scene(torch_patches_var)
+            with span('heads'):
+                predictions, _ = self.model.heads(pool_out, scene_embedding,
+                                                  robot_one_hot_var,
+                                                  h_var, w_var)
+            return predictions.detach().cpu().numpy()
+
+    def encode_scene(self, img):
+        """
+        Computes the embedding of a scene image once, so that it can be
+        shared by every patch sampled from that image.
+
+        :param img: Scene image, or a stack of scene images
+        :type img: np.ndarray
+
+        :returns: A torch Tensor of scene embeddings, one row per image
+        :rtype: torch Tensor
+        """
+        if len(img.shape) == 3:
+            img = img[np.newaxis]
+        with span('preprocess'):
+            torch_images = self.convert_cv2_patches(img)
+        if self.use_gpu:
+            torch_images = torch_images.cuda()
+        with span('encode_scene'), self.profile.context():
+            with span('backbone'):
+                return self.model.encode_scene(torch_images)
 
     def convert_cv2_patches(self, P):
         """
@@ -109,6 +492,8 @@ class GraspTorchObj(object):
         :rtype: torch Tensor
         """
         assert len(P.shape) == 4
+        if self.batched_preprocess:
+            return self.preprocess_batch(P)
         im_list = []
         for p in P:
             p = np.uint8(p)
@@ -120,6 +505,94 @@ class GraspTorchObj(object):
         im_stacked = torch.stack(im_list)
         return im_stacked
 
+    def preprocess_batch(self, P, size=None):
+        """
+        Resizes and normalizes a batch of images with the default transform in
+        a single pass. The result is written into a buffer that is reused by
+        the next call with the same image and output sizes. Buffers hold the
+        largest batch seen for their sizes, and only the last
+        `PREPROCESS_BUFFERS` sizes are kept.
+
+        :param P: Array of images of shape (N, H, W, 3)
+        :param size: Output (height, width), defaults to the model image size
+        :type P: np.ndarray
+        :type size: tuple
+
+        :returns: A torch Tensor of normalized images of shape
+                  (N, 3, height, width)
+        :rtype: torch Tensor
+        """
+        assert len(P.shape) == 4
+        n, im_h, im_w = P.shape[:3]
+        if size is None:
+            size = (self.image_size, self.image_size)
+        key = (im_h, im_w) + tuple(size)
+        staging, out = self._buffers.pop(key, (None, None))
+        if staging is None or len(staging) < n:
+            memory_format = torch.contiguous_format
+            if self.channels_last:
+                memory_format = torch.channels_last
+            staging = torch.empty((n, 3, im_h, im_w)).contiguous(
+                memory_format=memory_format)
+            out = torch.empty((n, 3) + tuple(size)).contiguous(
+                memory_format=memory_format)
+        # Most recently used last
+        self._buffers[key] = (staging, out)
+        while len(self._buffers) > PREPROCESS_BUFFERS:
+            self._buffers.popitem(last=False)
+        staging, out = staging[:n], out[:n]
+        x = staging.copy_(torch.from_numpy(np.ascontiguousarray(P))
+                          .permute(0, 3, 1, 2))
+        if (im_h, im_w) != tuple(size):
+            x = resize_bilinear(x, size)
+        return torch.addcmul(self._norm_bias, x, self._norm_scale, out=out)
+
+    def dense_predict(self, img, patch_size, stride=None):
+        """
+        Runs the grasp model densely over a scene image. The image is scaled
+        so that a patch of `patch_size` pixels spans the model input size, the
+        ResNet trunk runs once on the whole image and every window of the
+        feature map is pooled and scored like a sampled patch.
+
+        :param img: Scene image
+        :param patch_size: Size of a grasp patch in the scene image
+        :param stride: Distance in pixels between neighbouring patch
+                       centers, rounded to whole feature cells. Defaults to
+                       one feature cell
+        :type img: np.ndarray
+        :type patch_size: int
+        :type stride: int
+
+        :returns: Raw angle predictions of shape (H', W', n_class), and the
+                  heights and widths of the patch centers
+        :rtype: tuple
+        """
+        assert self.batched_preprocess, \
+            'Dense prediction requires the default transform'
+        scale = self.image_size / float(patch_size)
+        size = (int(round(img.shape[0] * scale)),
+                int(round(img.shape[1] * scale)))
+        window = self.image_size // deeper_models.feature_stride
+        cell_size = patch_size / float(window)
+        stride_cells = 1
+        if stride is not None:
+            stride_cells = max(1, int(round(stride / cell_size)))
+        with span('preprocess'):
+            x = self.preprocess_batch(img[np.newaxis], size=size)
+        if self.use_gpu:
+            x = x.cuda()
+        with span('forward'), self.profile.context():
+            with span('backbone'):
+                x = self.model.feature_map(x)
+            with span('heads'):
+                heatmap = self.model.dense_heads(x, window, stride_cells)[0]
+            heatmap = heatmap.detach().cpu().numpy()
+        step = deeper_models.feature_stride * stride_cells
+        half_window = self.image_size / 2.
+        hs = (np.arange(heatmap.shape[0]) * step + half_window) / scale
+        ws = (np.arange(heatmap.shape[1]) * step + half_window) / scale
+        return heatmap, hs.astype(int), ws.astype(int)
+
     def convert_hw(self, h):
         """
         Converts a list of floats to a torch Tensor
@@ -143,9 +616,8 @@ class GraspTorchObj(object):
         :rtype: torch Tensor
         """
         batch_size = len(labels)
-        labels_tensor = Variable(torch.LongTensor(labels))
-        y_onehot = Variable(torch.DoubleTensor(batch_size, n_class))
-        y_onehot.zero_()
+        labels_tensor = torch.LongTensor(labels)
+        y_onehot = torch.zeros(batch_size, n_class)
         labels_onehot = y_onehot.scatter_(1, labels_tensor.view(-1, 1), 1)
         return labels_onehot
 
@@ -160,9 +632,8 @@ class GraspTorchObj(object):
         :rtype: torch Tensor
         """
         batch_size = len(labels)
-        labels_tensor = Variable(torch.LongTensor(labels))
-        y_onehot = Variable(torch.DoubleTensor(batch_size, n_rob))
-        y_onehot.zero_()
+        labels_tensor = torch.LongTensor(labels)
+        y_onehot = torch.zeros(batch_size, n_rob)
         labels_onehot = y_onehot.scatter_(1, labels_tensor.view(-1, 1), 1)
         return labels_onehot
 
@@ -176,14 +647,19 @@ class GraspTorchObj(object):
         image_transforms = transforms.Compose([
             transforms.Resize((self.image_size, self.image_size)),
             transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+            transforms.Normalize(IMAGE_MEAN.tolist(), IMAGE_STD.tolist())
         ])
         return image_transforms
 
     def recursion_change_bn(self, module):
-        if isinstance(module, torch.nn.BatchNorm2d):
-            module.track_running_stats = 1
-        else:
-            for i, (name, module1) in enumerate(module._modules.items()):
-                module1 = self.recursion_change_bn(module1)
-        return module
+        return recursion_change_bn(module)
+
+    def fuse_bn(self, module):
+        """
+        Folds the BatchNorm layers of the ResNet trunk, see
+        :func:`fuse_conv_bn`.
+
+        :param module: Root module of the grasp model
+        :type module: torch.nn.Module
+        """
+        fuse_conv_bn(module)
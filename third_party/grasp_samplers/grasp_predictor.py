@@ -11,10 +11,13 @@ import copy
 
 import cv2
 import numpy as np
+from grasp_samplers.tracing import span
+from numpy.lib.stride_tricks import as_strided
 
 n_class = 18
 min_patch_std = 1
 angle_dependence = [0.25, 0.5, 0.25]
+samplers = ['integral', 'rejection']
 
 try:
     xrange
@@ -22,24 +25,260 @@ except NameError:
     xrange = range
 
 
+def run_grasp_model(grasp_obj, patch_Is, patch_hs, patch_ws,
+                    scene_embedding=None, full_x=None):
+    """
+    Runs the grasp model on a batch of sampled patches.
+
+    :param grasp_obj: An object that contains grasp model operations
+    :param patch_Is: Array of image patches of shape (N, patch, patch, 3)
+    :param patch_hs: Heights of the patch centers in their scene image
+    :param patch_ws: Widths of the patch centers in their scene image
+    :param scene_embedding: Embedding of the scene image(s) the patches come
+                            from, either one row or one row per patch
+    :param full_x: Scene image of every patch, or a single scene image shared
+                   by the patches, used when no embedding is given
+    :type grasp_obj: GraspTorchObj
+    :type patch_Is: np.ndarray
+    :type patch_hs: np.ndarray
+    :type patch_ws: np.ndarray
+    :type scene_embedding: torch Tensor
+    :type full_x: np.ndarray
+
+    :returns: Raw angle predictions and the patches fed to the model
+    :rtype: tuple
+    """
+    num_samples = len(patch_Is)
+    if grasp_obj.batched_preprocess:
+        # Resized together with normalization by the grasp object
+        patch_Is_resized = patch_Is
+    else:
+        with span('preprocess'):
+            patch_Is_resized = np.zeros((num_samples,
+                                         grasp_obj.image_size,
+                                         grasp_obj.image_size,
+                                         patch_Is.shape[3]))
+            for looper in xrange(num_samples):
+                patch_Is_resized[looper] = cv2.resize(
+                    patch_Is[looper].astype(np.float64),
+                    (grasp_obj.image_size, grasp_obj.image_size),
+                    interpolation=cv2.INTER_CUBIC)
+    vals = grasp_obj.test_one_batch(x=patch_Is_resized,
+                                    h=patch_hs,
+                                    w=patch_ws,
+                                    angle_labels=[0] * num_samples,
+                                    robot_labels=[0] * num_samples,
+                                    full_x=full_x,
+                                    scene_embedding=scene_embedding)
+    return vals, patch_Is_resized
+
+
+def smooth_angles(vals, legacy=True):
+    """
+    Normalizes the angle uncertainty of raw predictions with the circular
+    `angle_dependence` kernel.
+
+    :param vals: Raw predictions of shape (N, n_class)
+    :param legacy: Reproduce the original in-place smoothing, where each
+                   angle already sees its smoothed left neighbour (and the
+                   last angle its smoothed right neighbour). False applies
+                   the kernel to the raw predictions only
+    :type vals: np.ndarray
+    :type legacy: bool
+
+    :returns: Smoothed predictions
+    :rtype: np.ndarray
+    """
+    wf = angle_dependence
+    with span('smooth'):
+        if not legacy:
+            return (wf[1] * vals +
+                    wf[0] * np.roll(vals, 1, axis=1) +
+                    wf[2] * np.roll(vals, -1, axis=1))
+        norm_vals = vals.copy()
+        for norm_looper in xrange(n_class):
+            norm_vals[:, norm_looper] = (
+                wf[1] * norm_vals[:, norm_looper] +
+                wf[0] * norm_vals[:, (norm_looper - 1) % n_class] +
+                wf[2] * norm_vals[:, (norm_looper + 1) % n_class])
+        return norm_vals
+
+
+def angle_distance(a, b):
+    """
+    :returns: Distance between two grasp angles, which are pi periodic
+    :rtype: float
+    """
+    d = abs(a - b) % np.pi
+    return min(d, np.pi - d)
+
+
+def diverse_grasps(predictions, patch_hs, patch_ws, k, min_distance,
+                   min_angle, selected=None):
+    """
+    Ranks the (patch, angle) pairs of the predictions by score and keeps the
+    best ones greedily, dropping every grasp closer than `min_distance`
+    pixels and `min_angle` radians to a kept grasp (non-maximum
+    suppression over height, width and angle).
+
+    :param predictions: Angle scores of shape (N, n_class)
+    :param patch_hs: Heights of the patch centers
+    :param patch_ws: Widths of the patch centers
+    :param k: Number of grasps to return
+    :param min_distance: Pixel distance under which grasps are duplicates
+    :param min_angle: Angle difference under which grasps are duplicates
+    :param selected: Grasp (height, width, angle, confidence) to rank first
+    :type predictions: np.ndarray
+    :type patch_hs: np.ndarray
+    :type patch_ws: np.ndarray
+    :type k: int
+    :type min_distance: float
+    :type min_angle: float
+    :type selected: tuple
+
+    :returns: Up to `k` grasps (height, width, angle, confidence), best first
+    :rtype: list
+    """
+    num_angles = predictions.shape[1]
+    scores = predictions.ravel()
+    kept = [] if selected is None else [tuple(selected)]
+    for ind in np.argsort(-scores, kind='mergesort'):
+        if len(kept) >= k:
+            break
+        patch_ind, theta_ind = divmod(ind, num_angles)
+        grasp = (patch_hs[patch_ind], patch_ws[patch_ind],
+                 theta_ind * (np.pi / num_angles) - np.pi / 2, scores[ind])
+        if not any(np.hypot(grasp[0] - h, grasp[1] - w) < min_distance and
+                   angle_distance(grasp[2], angle) < min_angle
+                   for h, w, angle, _ in kept):
+            kept.append(grasp)
+    return kept
+
+
+class RunningTopK(object):
+    """
+    This class keeps the `k` candidates with the highest angle score out of
+    a stream of prediction batches, in preallocated arrays.
+    """
+
+    def __init__(self, k, batch_size):
+        """
+        The constructor for :class:`RunningTopK` class.
+
+        :param k: Number of candidates to keep
+        :param batch_size: Largest number of candidates pushed at once
+        :type k: int
+        :type batch_size: int
+        """
+        self.k = k
+        self.batch_size = batch_size
+        self.count = 0
+        self._vals = None
+        self._hs = None
+        self._ws = None
+
+    def push(self, vals, patch_hs, patch_ws):
+        """
+        Adds a batch of candidates.
+
+        :param vals: Predictions of shape (N, n_class)
+        :param patch_hs: Heights of the patch centers
+        :param patch_ws: Widths of the patch centers
+        :type vals: np.ndarray
+        :type patch_hs: np.ndarray
+        :type patch_ws: np.ndarray
+        """
+        n = len(vals)
+        assert n <= self.batch_size
+        if self._vals is None:
+            size = self.k + self.batch_size
+            self._vals = np.empty((size, vals.shape[1]), dtype=vals.dtype)
+            self._hs = np.empty(size, dtype=np.asarray(patch_hs).dtype)
+            self._ws = np.empty(size, dtype=np.asarray(patch_ws).dtype)
+        end = self.count + n
+        self._vals[self.count:end] = vals
+        self._hs[self.count:end] = patch_hs
+        self._ws[self.count:end] = patch_ws
+        scores = self._vals[:end].max(1)
+        if end > self.k:
+            keep = np.argpartition(-scores, self.k - 1)[:self.k]
+        else:
+            keep = np.arange(end)
+        keep = keep[np.argsort(-scores[keep], kind='mergesort')]
+        self.count = len(keep)
+        self._vals[:self.count] = self._vals[keep]
+        self._hs[:self.count] = self._hs[keep]
+        self._ws[:self.count] = self._ws[keep]
+
+    def result(self):
+        """
+        :returns: Predictions, heights and widths of the kept candidates,
+                  best first
+        :rtype: tuple
+        """
+        return (self._vals[:self.count].copy(), self._hs[:self.count].copy(),
+                self._ws[:self.count].copy())
+
+
 # Given image, returns image point and theta to grasp
 class Predictors:
     """
     This class contains functionality to sample grasp patches from the scene image.
     """
 
-    def __init__(self, img, grasp_obj=None):
+    def __init__(self, img, grasp_obj=None, cache_scene=True,
+                 sampler='integral', legacy_smoothing=True,
+                 sample_weights=None):
         """
         The constructor for :class:`Predictors` class.
     
             :param img: An image of the scene
             :param grasp_obj: An object that contains grasp model operations
+            :param cache_scene: Encode the scene image once and share the
+                                embedding across every sampled batch
+            :param sampler: Patch sampler, one of `samplers`. 'integral'
+                            draws every patch in one call from the centers
+                            that pass `min_patch_std`; 'rejection' is the
+                            original one-at-a-time resampling loop
+            :param legacy_smoothing: Smooth angles with the original
+                                     in-place semantics, see
+                                     :func:`smooth_angles`
+            :param sample_weights: Non-negative map of the image size;
+                                   patches are centered on a pixel with a
+                                   probability proportional to its weight,
+                                   e.g. a mask of the objects. Requires the
+                                   'integral' sampler
             :type img: np.ndarray
             :type grasp_obj: GraspTorchObj
+            :type cache_scene: bool
+            :type sampler: string
+            :type legacy_smoothing: bool
+            :type sample_weights: np.ndarray
         """
+        assert sampler in samplers
+        assert sample_weights is None or sampler == 'integral', \
+            'Sample weights require the integral sampler'
         self.img = img
         self.img_h, self.img_w, self.img_c = self.img.shape
         self.grasp_obj = grasp_obj
+        self.cache_scene = cache_scene
+        self._scene_embedding = None
+        self.sampler = sampler
+        self.legacy_smoothing = legacy_smoothing
+        self._valid_corners = {}
+        self.sample_weights = sample_weights
+        self._corner_cdfs = {}
+
+    def scene_embedding(self):
+        """
+        Returns the embedding of the scene image, computing it on first use.
+
+        :returns: Embedding of the scene image
+        :rtype: torch Tensor
+        """
+        if self._scene_embedding is None:
+            self._scene_embedding = self.grasp_obj.encode_scene(self.img)
+        return self._scene_embedding
 
     def random_grasp(self):
         """
@@ -65,17 +304,182 @@ class Predictors:
         t_g = np.int(n_class / 2)
         return h_g, w_g, t_g
 
-    def graspNet_grasp(self, patch_size=300, num_samples=128):
+    def sample_patches(self, patch_size, num_samples, out=None):
         """
-        Select grasp based on the grasp model.
-    
+        Samples patches whose pixel standard deviation exceeds
+        `min_patch_std`, using the sampler chosen at construction.
+
         :param patch_size: Size of patch to be sampled
-        :param num_samples: Number of patches to run
+        :param num_samples: Number of patches to sample
+        :param out: Array of shape (num_samples, patch, patch, channels) to
+                    write the patches into instead of a new array
         :type patch_size: int
         :type num_samples: int
+        :type out: np.ndarray
+
+        :returns: Heights and widths of the patch centers, and the patches
+        :rtype: tuple
         """
-        self.patch_size = patch_size
-        half_patch_size = np.int(patch_size / 2) + 1
+        with span('sample'):
+            if self.sampler == 'integral':
+                return self._sample_patches_integral(patch_size, num_samples,
+                                                     out)
+            return self._sample_patches_rejection(patch_size, num_samples,
+                                                  out)
+
+    def valid_patch_corners(self, patch_size):
+        """
+        Computes the flat indices of every patch top-left corner whose
+        patch passes the `min_patch_std` check. The per-window mean and
+        variance are read off an integral image, so the cost is independent
+        of the patch size. Results are cached per patch size.
+
+        :param patch_size: Size of patch to be sampled
+        :type patch_size: int
+
+        :returns: Flat indices into the (h_range, w_range) corner grid
+        :rtype: np.ndarray
+        """
+        if patch_size in self._valid_corners:
+            return self._valid_corners[patch_size]
+        h_range = self.img_h - patch_size - 2
+        w_range = self.img_w - patch_size - 2
+        if np.issubdtype(self.img.dtype, np.integer):
+            acc_type = np.int64
+        else:
+            acc_type = np.float64
+        I = self.img.astype(acc_type)
+        sums = np.zeros((self.img_h + 1, self.img_w + 1), dtype=acc_type)
+        sq_sums = np.zeros((self.img_h + 1, self.img_w + 1), dtype=acc_type)
+        sums[1:, 1:] = I.sum(2).cumsum(0).cumsum(1)
+        sq_sums[1:, 1:] = (I * I).sum(2).cumsum(0).cumsum(1)
+
+        def window_sum(S):
+            p = patch_size
+            return (S[p:p + h_range, p:p + w_range] -
+                    S[:h_range, p:p + w_range] -
+                    S[p:p + h_range, :w_range] +
+                    S[:h_range, :w_range])
+
+        # std > min_patch_std  <=>  n * sum(x^2) - sum(x)^2 > (std * n)^2
+        n = patch_size * patch_size * self.img_c
+        s = window_sum(sums)
+        spread = n * window_sum(sq_sums) - s * s
+        valid = np.flatnonzero(spread > (min_patch_std * n) ** 2)
+        if len(valid) == 0:
+            print('No patch passes the minimum deviation check; '
+                  'sampling uniformly')
+            valid = np.arange(h_range * w_range)
+        self._valid_corners[patch_size] = valid
+        return valid
+
+    def valid_centers(self, patch_size, patch_hs, patch_ws):
+        """
+        Checks which points are the centers of patches that fit in the
+        scene image, i.e. that :meth:`patches_at` can gather.
+
+        :param patch_size: Size of the patches
+        :param patch_hs: Heights of the patch centers
+        :param patch_ws: Widths of the patch centers
+        :type patch_size: int
+        :type patch_hs: np.ndarray
+        :type patch_ws: np.ndarray
+
+        :returns: Whether every patch fits in the image
+        :rtype: np.ndarray
+        """
+        half_patch_size = int(patch_size / 2) + 1
+        h_bs = np.asarray(patch_hs) - half_patch_size
+        w_bs = np.asarray(patch_ws) - half_patch_size
+        return (h_bs >= 0) & (h_bs <= self.img_h - patch_size) & \
+            (w_bs >= 0) & (w_bs <= self.img_w - patch_size)
+
+    def patches_at(self, patch_size, patch_hs, patch_ws, out=None):
+        """
+        Gathers the patches centered at the given points through a strided
+        window view of the scene image. Every patch must fit in the image,
+        see :meth:`valid_centers`.
+
+        :param patch_size: Size of the patches
+        :param patch_hs: Heights of the patch centers
+        :param patch_ws: Widths of the patch centers
+        :param out: Array to write the patches into instead of a new array
+        :type patch_size: int
+        :type patch_hs: np.ndarray
+        :type patch_ws: np.ndarray
+        :type out: np.ndarray
+
+        :returns: Array of patches of shape (N, patch, patch, 3)
+        :rtype: np.ndarray
+        """
+        # Negative indices would wrap around the view
+        assert self.valid_centers(patch_size, patch_hs, patch_ws).all(), \
+            'Patch centers outside of the image'
+        half_patch_size = int(patch_size / 2) + 1
+        s_h, s_w, s_c = self.img.strides
+        windows = as_strided(self.img,
+                             shape=(self.img_h - patch_size + 1,
+                                    self.img_w - patch_size + 1,
+                                    patch_size, patch_size, self.img_c),
+                             strides=(s_h, s_w, s_h, s_w, s_c))
+        h_bs = patch_hs - half_patch_size
+        w_bs = patch_ws - half_patch_size
+        if out is None:
+            return windows[h_bs, w_bs]
+        for looper in xrange(len(h_bs)):
+            out[looper] = windows[h_bs[looper], w_bs[looper]]
+        return out
+
+    def sample_corners(self, patch_size, num_samples):
+        """
+        Draws patch top-left corners among :meth:`valid_patch_corners`,
+        uniformly or following `sample_weights` at the patch centers.
+
+        :param patch_size: Size of patch to be sampled
+        :param num_samples: Number of corners to draw
+        :type patch_size: int
+        :type num_samples: int
+
+        :returns: Flat indices into the (h_range, w_range) corner grid
+        :rtype: np.ndarray
+        """
+        valid = self.valid_patch_corners(patch_size)
+        cdf = self._corner_cdf(patch_size)
+        if cdf is None:
+            return valid[np.random.randint(len(valid), size=num_samples)]
+        draws = np.random.rand(num_samples) * cdf[-1]
+        return valid[np.searchsorted(cdf, draws, side='right')]
+
+    def _corner_cdf(self, patch_size):
+        if self.sample_weights is None:
+            return None
+        if patch_size not in self._corner_cdfs:
+            half_patch_size = int(patch_size / 2) + 1
+            w_range = self.img_w - patch_size - 2
+            h_bs, w_bs = np.divmod(self.valid_patch_corners(patch_size),
+                                   w_range)
+            cdf = np.cumsum(self.sample_weights[h_bs + half_patch_size,
+                                                w_bs + half_patch_size],
+                            dtype=np.float64)
+            if len(cdf) == 0 or cdf[-1] <= 0:
+                print('No valid patch has a sample weight; '
+                      'sampling uniformly')
+                cdf = None
+            self._corner_cdfs[patch_size] = cdf
+        return self._corner_cdfs[patch_size]
+
+    def _sample_patches_integral(self, patch_size, num_samples, out=None):
+        half_patch_size = int(patch_size / 2) + 1
+        w_range = self.img_w - patch_size - 2
+        corners = self.sample_corners(patch_size, num_samples)
+        h_bs, w_bs = np.divmod(corners, w_range)
+        patch_hs = h_bs + half_patch_size
+        patch_ws = w_bs + half_patch_size
+        return patch_hs, patch_ws, self.patches_at(patch_size, patch_hs,
+                                                   patch_ws, out)
+
+    def _sample_patches_rejection(self, patch_size, num_samples, out=None):
+        half_patch_size = int(patch_size / 2) + 1
         h_range = self.img_h - patch_size - 2
         w_range = self.img_w - patch_size - 2
 
@@ -85,12 +489,10 @@ class Predictors:
         patch_ws = np.random.randint(w_range,
                                      size=num_samples) + half_patch_size
 
-        patch_Is = np.zeros((num_samples, patch_size,
-                             patch_size, self.img_c))
-        patch_Is_resized = np.zeros((num_samples,
-                                     self.grasp_obj.image_size,
-                                     self.grasp_obj.image_size,
-                                     self.img_c))
+        patch_Is = out
+        if patch_Is is None:
+            patch_Is = np.zeros((num_samples, patch_size,
+                                 patch_size, self.img_c))
         for looper in xrange(num_samples):
             isWhiteFlag = 1
             while isWhiteFlag == 1:
@@ -107,32 +509,91 @@ class Predictors:
                     isWhiteFlag = 0
                 else:
                     isWhiteFlag = 1
-            patch_Is_resized[looper] = cv2.resize(patch_Is[looper],
-                                                  (self.grasp_obj.image_size,
-                                                   self.grasp_obj.image_size),
-                                                  interpolation=cv2.INTER_CUBIC)
-        angle_labels = [0 for _ in patch_Is_resized]
-        robot_labels = [0 for _ in patch_Is_resized]
-        full_x = np.array([self.img for _ in patch_Is_resized])
-        param_dict = {'x': patch_Is_resized,
-                      'h': patch_hs,
-                      'w': patch_ws,
-                      'angle_labels': angle_labels,
-                      'robot_labels': robot_labels,
-                      'full_x': full_x}
-        self.vals = self.grasp_obj.test_one_batch(**param_dict)
-
-        # Normalizing angle uncertainity
-        wf = angle_dependence
-        self.norm_vals = copy.deepcopy(self.vals)
-        for looper in xrange(num_samples):
-            for norm_looper in xrange(n_class):
-                n_val = (wf[1] * self.norm_vals[looper, norm_looper] +
-                         wf[0] * self.norm_vals[looper, (norm_looper -
-                                                         1) % n_class] +
-                         wf[2] * self.norm_vals[looper, (norm_looper + 1) %
-                                                n_class])
-                self.norm_vals[looper, norm_looper] = n_val
+        return patch_hs, patch_ws, patch_Is
+
+    def graspNet_grasp(self, patch_size=300, num_samples=128, out=None):
+        """
+        Select grasp based on the grasp model.
+    
+        :param patch_size: Size of patch to be sampled
+        :param num_samples: Number of patches to run
+        :param out: Buffer to sample the patches into, see
+                    :meth:`sample_patches`
+        :type patch_size: int
+        :type num_samples: int
+        :type out: np.ndarray
+        """
+        self.patch_size = patch_size
+        patch_hs, patch_ws, patch_Is = self.sample_patches(patch_size,
+                                                           num_samples, out)
+        self._evaluate(patch_Is, patch_hs, patch_ws)
+
+    def graspNet_points(self, patch_size, patch_hs, patch_ws):
+        """
+        Evaluates the grasp model on the patches centered at given points,
+        e.g. to re-score known candidates on a new image of the scene. Every
+        patch must fit in the image, see :meth:`valid_centers`.
+
+        :param patch_size: Size of the patches
+        :param patch_hs: Heights of the patch centers
+        :param patch_ws: Widths of the patch centers
+        :type patch_size: int
+        :type patch_hs: np.ndarray
+        :type patch_ws: np.ndarray
+        """
+        self.patch_size = patch_size
+        patch_hs = np.asarray(patch_hs, dtype=int)
+        patch_ws = np.asarray(patch_ws, dtype=int)
+        self._evaluate(self.patches_at(patch_size, patch_hs, patch_ws),
+                       patch_hs, patch_ws)
+
+    def _evaluate(self, patch_Is, patch_hs, patch_ws):
+        if self.cache_scene:
+            result = run_grasp_model(self.grasp_obj, patch_Is, patch_hs,
+                                     patch_ws,
+                                     scene_embedding=self.scene_embedding())
+        else:
+            result = run_grasp_model(self.grasp_obj, patch_Is, patch_hs,
+                                     patch_ws, full_x=self.img[np.newaxis])
+        self.vals, patch_Is_resized = result
+        self.norm_vals = smooth_angles(self.vals, self.legacy_smoothing)
         self.patch_hs = patch_hs
         self.patch_ws = patch_ws
         self.patch_Is_resized = patch_Is_resized
+
+    def graspNet_dense(self, patch_size=300, stride=None):
+        """
+        Select grasp based on a dense evaluation of the grasp model over a
+        regular grid of patch centers.
+
+        :param patch_size: Size of the grasp patch
+        :param stride: Distance in pixels between neighbouring patch centers
+        :type patch_size: int
+        :type stride: int
+        """
+        self.patch_size = patch_size
+        heatmap, hs, ws = self.grasp_obj.dense_predict(self.img, patch_size,
+                                                       stride)
+        grid_hs, grid_ws = np.meshgrid(hs, ws, indexing='ij')
+
+        # Skip patches that the samplers would reject
+        half_patch_size = int(patch_size / 2) + 1
+        h_range = self.img_h - patch_size - 2
+        w_range = self.img_w - patch_size - 2
+        h_bs = grid_hs - half_patch_size
+        w_bs = grid_ws - half_patch_size
+        valid_corners = np.zeros(h_range * w_range, dtype=bool)
+        valid_corners[self.valid_patch_corners(patch_size)] = True
+        valid = (h_bs >= 0) & (h_bs < h_range) & (w_bs >= 0) & (w_bs < w_range)
+        valid[valid] = valid_corners[h_bs[valid] * w_range + w_bs[valid]]
+        if not valid.any():
+            valid[:] = True
+
+        self.heatmap = smooth_angles(heatmap.reshape(-1, n_class),
+                                     self.legacy_smoothing).reshape(
+            heatmap.shape)
+        self.heatmap_valid = valid
+        self.vals = heatmap[valid]
+        self.norm_vals = self.heatmap[valid]
+        self.patch_hs = grid_hs[valid]
+        self.patch_ws = grid_ws[valid]
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+Class definition for AdaptiveGraspSearch
+"""
+import time
+
+import numpy as np
+from grasp_samplers.grasp_predictor import run_grasp_model, smooth_angles
+from grasp_samplers.tracing import span
+
+CEM_N_ELITE = 5
+CEM_EXPLORE_FRAC = 0.2
+CEM_TOL = 1e-3
+CEM_PATIENCE = 2
+
+
+class AdaptiveGraspSearch(object):
+    """
+    This class contains functionality to search the best grasp patch with the
+    cross-entropy method instead of sampling every patch uniformly.
+    """
+
+    def __init__(self, predictor, patch_size, batch_size, max_samples,
+                 n_elite=CEM_N_ELITE, explore_frac=CEM_EXPLORE_FRAC,
+                 tol=CEM_TOL, patience=CEM_PATIENCE, budget_ms=None):
+        """
+        The constructor for :class:`AdaptiveGraspSearch` class.
+
+        :param predictor: Predictors object of the scene image
+        :param patch_size: Size of patch to be sampled
+        :param batch_size: Number of patches evaluated per round
+        :param max_samples: Maximum number of patches to evaluate
+        :param n_elite: Number of best patches the sampling distribution is
+                        refit around
+        :param explore_frac: Fraction of every round drawn uniformly
+        :param tol: Minimum improvement of the best score for a round to count
+                    as progress
+        :param patience: Number of rounds without progress before stopping
+        :param budget_ms: Latency budget in milliseconds, None for no budget
+        :type predictor: Predictors
+        :type patch_size: int
+        :type batch_size: int
+        :type max_samples: int
+        :type n_elite: int
+        :type explore_frac: float
+        :type tol: float
+        :type patience: int
+        :type budget_ms: float
+        """
+        self.predictor = predictor
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.max_samples = max_samples
+        self.n_elite = n_elite
+        self.explore_frac = explore_frac
+        self.tol = tol
+        self.patience = patience
+        self.budget_ms = budget_ms
+        self.num_forwards = 0
+        self.num_rounds = 0
+        self.stop_reason = None
+
+    def run(self):
+        """
+        Runs the search.
+
+        :returns: Smoothed predictions, heights and widths of every evaluated
+                  patch
+        :rtype: tuple
+        """
+        start_time = time.time()
+        P = self.predictor
+        half_patch_size = int(self.patch_size / 2) + 1
+        h_range = P.img_h - self.patch_size - 2
+        w_range = P.img_w - self.patch_size - 2
+        valid = P.valid_patch_corners(self.patch_size)
+        valid_mask = np.zeros(h_range * w_range, dtype=bool)
+        valid_mask[valid] = True
+
+        predictions = np.zeros((0, 0))
+        corners = np.zeros(0, dtype=int)
+        best_score = -np.inf
+        stalled = 0
+        self.num_forwards = 0
+        self.num_rounds = 0
+        self.stop_reason = 'max_samples'
+        while self.num_forwards < self.max_samples:
+            n = min(self.batch_size, self.max_samples - self.num_forwards)
+            new_corners = P.sample_corners(self.patch_size, n)
+            if self.num_rounds > 0:
+                n_refit = n - int(self.explore_frac * n)
+                scores = predictions.max(1)
+                elite = corners[np.argsort(scores)[-self.n_elite:]]
+                elite_hs, elite_ws = np.divmod(elite, w_range)
+                sigma_h = max(np.std(elite_hs), 1.)
+                sigma_w = max(np.std(elite_ws), 1.)
+                parents = np.random.randint(len(elite), size=n_refit)
+                hs = np.round(elite_hs[parents] +
+                              sigma_h * np.random.randn(n_refit)).astype(int)
+                ws = np.round(elite_ws[parents] +
+                              sigma_w * np.random.randn(n_refit)).astype(int)
+                hs = np.clip(hs, 0, h_range - 1)
+                ws = np.clip(ws, 0, w_range - 1)
+                refit_corners = hs * w_range + ws
+                # Centers that fail min_patch_std stay uniform draws
+                keep = valid_mask[refit_corners]
+                new_corners[:n_refit][keep] = refit_corners[keep]
+
+            h_bs, w_bs = np.divmod(new_corners, w_range)
+            patch_hs = h_bs + half_patch_size
+            patch_ws = w_bs + half_patch_size
+            with span('sample'):
+                patch_Is = P.patches_at(self.patch_size, patch_hs, patch_ws)
+            if P.cache_scene:
+                vals, _ = run_grasp_model(
+                    P.grasp_obj, patch_Is, patch_hs, patch_ws,
+                    scene_embedding=P.scene_embedding())
+            else:
+                vals, _ = run_grasp_model(
+                    P.grasp_obj, patch_Is, patch_hs, patch_ws,
+                    full_x=P.img[np.newaxis])
+            norm_vals = smooth_angles(vals, P.legacy_smoothing)
+            if self.num_rounds == 0:
+                predictions = norm_vals
+            else:
+                predictions = np.concatenate([predictions, norm_vals])
+            corners = np.concatenate([corners, new_corners])
+            self.num_forwards += n
+            self.num_rounds += 1
+
+            round_best = predictions.max()
+            if round_best - best_score < self.tol:
+                stalled += 1
+            else:
+                stalled = 0
+            best_score = max(best_score, round_best)
+            if stalled >= self.patience:
+                self.stop_reason = 'converged'
+                break
+            if self.budget_ms is not None:
+                elapsed_ms = (time.time() - start_time) * 1000.
+                round_ms = elapsed_ms / self.num_rounds
+                if elapsed_ms + round_ms > self.budget_ms:
+                    self.stop_reason = 'budget'
+                    break
+
+        h_bs, w_bs = np.divmod(corners, w_range)
+        return predictions, h_bs + half_patch_size, w_bs + half_patch_size
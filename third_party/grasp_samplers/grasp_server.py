@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+"""
+Grasp inference server shared by several robot and evaluation processes.
+
+The server loads one :class:`GraspTorchObj` and answers
+:class:`grasp_samplers.grasp_client.RemoteGraspObj` clients over a Unix
+socket, with images handed over in shared memory. Patch batches of concurrent
+clients are merged into a single forward pass of up to `max_batch` patches,
+waiting at most `max_wait` seconds for the batch to fill.
+
+Usage::
+
+    python -m grasp_samplers.grasp_server --model_name model.pth
+
+and in the clients::
+
+    GraspModel(server_address=SERVER_ADDRESS, ...)
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+from grasp_samplers.grasp_client import SERVER_ADDRESS, arena_arrays, \
+    map_file, recv_message, send_message
+from grasp_samplers.grasp_model import resolve_model_path
+from grasp_samplers.grasp_object import ExecutionProfile, GraspTorchObj
+from grasp_samplers.quantization import CALIBRATION_DIR, calibration_inputs, \
+    load_calibration_images
+from grasp_samplers.tracing import Histogram, span
+
+MAX_BATCH = 64
+MAX_WAIT = 0.005
+STATS_PERIOD = 10.
+STOPPED_ERROR = 'server stopped'
+
+
+class _Request(object):
+    """
+    A predict request waiting for its batch.
+    """
+
+    def __init__(self, x, h, w, angle_labels, robot_labels, embedding):
+        self.x = x
+        self.h = h
+        self.w = w
+        self.angle_labels = angle_labels
+        self.robot_labels = robot_labels
+        self.embedding = embedding
+        self.size = len(x)
+        self.enqueued = time.time()
+        self.vals = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, vals=None, error=None):
+        self.vals = vals
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        return self.vals
+
+
+class MicroBatcher(object):
+    """
+    This class merges queued requests into batches for a single worker
+    thread. A batch is run once it holds `max_batch` patches or once its
+    oldest request waited `max_wait` seconds. Requests are never split, so a
+    request larger than `max_batch` runs alone.
+    """
+
+    def __init__(self, run_batch, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        """
+        The constructor for :class:`MicroBatcher` class.
+
+        :param run_batch: Called with the list of requests of a batch
+        :param max_batch: Maximum number of patches per batch
+        :param max_wait: Seconds a request may wait for its batch to fill
+        :type run_batch: function
+        :type max_batch: int
+        :type max_wait: float
+        """
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = deque()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._wait = Histogram()
+        self._stats = {'requests': 0, 'batches': 0, 'patches': 0,
+                       'max_queue_depth': 0}
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, request):
+        with self._cond:
+            if self._stopped:
+                request.finish(error=STOPPED_ERROR)
+                return
+            self._pending.append(request)
+            self._queued += request.size
+            self._stats['max_queue_depth'] = max(
+                self._stats['max_queue_depth'], len(self._pending))
+            self._cond.notify()
+
+    def _collect(self):
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                # Requests left in the queue would wait forever
+                while self._pending:
+                    self._pending.popleft().finish(error=STOPPED_ERROR)
+                self._queued = 0
+                return []
+            deadline = self._pending[0].enqueued + self.max_wait
+            while self._queued < self.max_batch and not self._stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._pending.popleft()]
+            size = batch[0].size
+            while self._pending and \
+                    size + self._pending[0].size <= self.max_batch:
+                batch.append(self._pending.popleft())
+                size += batch[-1].size
+            self._queued -= size
+            now = time.time()
+            for request in batch:
+                self._wait.add(now - request.enqueued)
+            self._stats['requests'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['patches'] += size
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            try:
+                self.run_batch(batch)
+            except Exception:
+                error = traceback.format_exc()
+                for request in batch:
+                    request.finish(error=error)
+
+    def stats(self):
+        """
+        :returns: Current queue depth in requests and patches, the largest
+                  queue depth, and per batch the mean number of requests and
+                  the mean fill ratio of `max_batch`, with percentiles of the
+                  time requests waited for their batch
+        :rtype: dict
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._pending)
+            stats['queued_patches'] = self._queued
+            batches = max(stats['batches'], 1)
+            stats['requests_per_batch'] = stats['requests'] / float(batches)
+            stats['batch_fill'] = stats['patches'] / float(
+                batches * self.max_batch)
+            for q in [50, 90, 99]:
+                stats['wait_p{}_ms'.format(q)] = \
+                    self._wait.percentile(q) * 1e3
+            return stats
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class GraspServer(object):
+    """
+    This class serves a :class:`GraspTorchObj` to
+    :class:`grasp_samplers.grasp_client.RemoteGraspObj` clients.
+    """
+
+    def __init__(self, grasp_obj, address=SERVER_ADDRESS,
+                 max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        """
+        The constructor for :class:`GraspServer` class.
+
+        :param grasp_obj: The grasp model to serve, with the default
+                          (batch-wise) transform
+        :param address: Path of the Unix socket to listen on
+        :param max_batch: Maximum number of patches per forward pass
+        :param max_wait: Seconds a request may wait for its batch to fill
+        :type grasp_obj: GraspTorchObj
+        :type address: string
+        :type max_batch: int
+        :type max_wait: float
+        """
+        assert grasp_obj.batched_preprocess, \
+            'The server requires the default transform'
+        self.grasp_obj = grasp_obj
+        self.address = address
+        # Preprocessing reuses buffers of the grasp object
+        self._model_lock = threading.Lock()
+        self.batcher = MicroBatcher(self._run_batch, max_batch, max_wait)
+        self.connections = 0
+        self._connections_lock = threading.Lock()
+        if os.path.exists(address):
+            os.unlink(address)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(address)
+        self._sock.listen(16)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while not self._stopped:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        with self._connections_lock:
+            self.connections += 1
+        # Arena path -> (size, mapping)
+        arenas = {}
+        try:
+            while True:
+                message = recv_message(conn)
+                if message is None:
+                    return
+                try:
+                    arrays = {}
+                    if 'shm' in message:
+                        shm = message['shm']
+                        size, buf = arenas.get(shm['path'], (0, None))
+                        if size != shm['size']:
+                            if buf is not None:
+                                buf.close()
+                            buf = map_file(shm['path'], shm['size'])
+                            arenas[shm['path']] = (shm['size'], buf)
+                        arrays = arena_arrays(buf, shm['arrays'])
+                    reply = self._handle(message, arrays)
+                except Exception:
+                    reply = {'error': traceback.format_exc()}
+                # Drop the views before the arena may be remapped
+                arrays = None
+                send_message(conn, reply)
+        except socket.error:
+            return
+        finally:
+            with self._connections_lock:
+                self.connections -= 1
+            conn.close()
+            for _, buf in arenas.values():
+                buf.close()
+
+    def _handle(self, message, arrays):
+        op = message['op']
+        if op == 'info':
+            return {'image_size': self.grasp_obj.image_size,
+                    'profile': str(self.grasp_obj.profile)}
+        if op == 'stats':
+            return {'stats': self.stats()}
+        if op == 'predict':
+            request = _Request(arrays['x'], message['h'], message['w'],
+                               message['angle_labels'],
+                               message['robot_labels'], arrays['embedding'])
+            self.batcher.submit(request)
+            vals = request.wait()
+            if request.error is not None:
+                return {'error': request.error}
+            return {'vals': vals}
+        if op == 'encode_scene':
+            with self._model_lock:
+                embedding = self.grasp_obj.encode_scene(arrays['img'])
+                return {'embedding': embedding.detach().cpu().numpy()}
+        if op == 'dense_predict':
+            with self._model_lock:
+                heatmap, hs, ws = self.grasp_obj.dense_predict(
+                    arrays['img'], message['patch_size'], message['stride'])
+            return {'heatmap': heatmap, 'hs': hs, 'ws': ws}
+        raise ValueError('Unknown operation {}'.format(op))
+
+    def _run_batch(self, batch):
+        """
+        Runs the patches of every request in one forward pass. Patches of the
+        same size are normalized together.
+
+        :param batch: Requests of the batch
+        :type batch: list
+        """
+        groups = OrderedDict()
+        for request in batch:
+            groups.setdefault(request.x.shape[1:], []).append(request)
+        order = [request for requests in groups.values()
+                 for request in requests]
+        with self._model_lock, span('server_batch'):
+            with span('preprocess'):
+                # Groups differ in shape, so they never share a
+                # preprocessing buffer of the grasp object
+                xs = []
+                for requests in groups.values():
+                    x = requests[0].x if len(requests) == 1 else \
+                        np.concatenate([request.x for request in requests])
+                    xs.append(self.grasp_obj.convert_cv2_patches(x))
+                x = xs[0] if len(xs) == 1 else torch.cat(xs)
+                h = torch.from_numpy(np.concatenate(
+                    [request.h for request in order]))
+                w = torch.from_numpy(np.concatenate(
+                    [request.w for request in order]))
+                one_hot = self.grasp_obj.convert_one_hot(
+                    sum([request.angle_labels for request in order], []))
+                robot_one_hot = self.grasp_obj.convert_robot_one_hot(
+                    sum([request.robot_labels for request in order], []))
+                embedding = torch.cat(
+                    [torch.from_numpy(request.embedding).expand(
+                        request.size, -1) for request in order])
+            vals = self.grasp_obj.forward(x, h, w, one_hot, robot_one_hot,
+                                          scene_embedding=embedding)
+        st = 0
+        for request in order:
+            request.finish(vals[st:st + request.size])
+            st += request.size
+
+    def stats(self):
+        stats = self.batcher.stats()
+        stats['connections'] = self.connections
+        return stats
+
+    def stop(self):
+        self._stopped = True
+        try:
+            # Wakes up the accepting thread
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        self.batcher.stop()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def format_stats(stats):
+    return ('{connections} clients, queue {queue_depth} requests '
+            '({queued_patches} patches, max {max_queue_depth}), '
+            '{batches} batches, {requests_per_batch:.2f} requests and '
+            '{batch_fill:.0%} full per batch, wait p50 {wait_p50_ms:.1f}ms '
+            'p99 {wait_p99_ms:.1f}ms'.format(**stats))
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Serve the grasp model')
+    parser.add_argument('--model_name', default='model.pth')
+    parser.add_argument('--url', default=None,
+                        help='URL of the model, only needed if it is missing')
+    parser.add_argument('--address', default=SERVER_ADDRESS)
+    parser.add_argument('--max_batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max_wait_ms', type=float, default=MAX_WAIT * 1e3)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--channels_last', action='store_true')
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--patchsize', type=int, default=100,
+                        help='Patch size the int8 model is calibrated on')
+    parser.add_argument('--stats_period', type=float, default=STATS_PERIOD)
+
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    model_path = resolve_model_path(args.model_name, args.url, args.quantize)
+    profile = ExecutionProfile(intra_op_threads=args.threads,
+                               channels_last=args.channels_last,
+                               quantize=args.quantize)
+    print('Loading grasp model from {}'.format(model_path))
+    grasp_obj = GraspTorchObj(model_path, profile=profile)
+    if profile.quantize:
+        images = load_calibration_images(CALIBRATION_DIR)
+        grasp_obj.quantize(calibration_inputs(grasp_obj, images,
+                                              args.patchsize))
+    grasp_obj.warmup()
+    print('Execution profile: {}'.format(grasp_obj.profile))
+    server = GraspServer(grasp_obj, args.address, args.max_batch,
+                         args.max_wait_ms / 1e3)
+    print('Serving grasps on {}'.format(args.address))
+    try:
+        while True:
+            time.sleep(args.stats_period)
+            print(format_stats(server.stats()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Exports a pickled grasp checkpoint to a self-contained artifact.
+
+The artifact holds the IfullRobHWNet constructor arguments and a state_dict
+with the BatchNorm and pooling fixes already applied, so that it can be
+loaded without unpickling modules and memory-mapped by
+:func:`grasp_samplers.grasp_object.load_exported_model`. The BatchNorm layers
+are folded into the convolutions at export time, so that the loaded weights
+are used as mapped; pass --keep_bn for an artifact that can be quantized.
+
+Usage::
+
+    python -m grasp_samplers.model_export models/model.pth models/model.export.pt
+"""
+import argparse
+import os
+import time
+
+import torch
+from grasp_samplers import deeper_models
+from grasp_samplers.grasp_object import EXPORT_SUFFIX, GraspTorchObj, \
+    fuse_conv_bn, load_checkpoint
+
+
+def export_model(checkpoint_path, export_path, fuse_bn=True):
+    """
+    Exports a pickled grasp checkpoint.
+
+    :param checkpoint_path: Path of the pickled checkpoint
+    :param export_path: Path of the artifact, must end in `EXPORT_SUFFIX`
+    :param fuse_bn: Fold the BatchNorm layers into the convolutions. Folded
+                    artifacts cannot be quantized
+    :type checkpoint_path: string
+    :type export_path: string
+    :type fuse_bn: bool
+    """
+    assert export_path.endswith(EXPORT_SUFFIX), \
+        'Exported models must end in {}'.format(EXPORT_SUFFIX)
+    checkpoint = load_checkpoint(checkpoint_path)
+    kwargs = {'h_size': checkpoint.fc_noise_0.out_features,
+              'out_size': checkpoint.fc_angle_1.out_features,
+              'noise_size': checkpoint.fc_noise_3.out_features}
+    model = deeper_models.IfullRobHWNet(pretrained_resnet18=False, **kwargs)
+    # Checkpoints pickled by older torch versions lack num_batches_tracked
+    result = model.load_state_dict(checkpoint.state_dict(), strict=False)
+    assert not result.unexpected_keys, result.unexpected_keys
+    assert all(key.endswith('num_batches_tracked')
+               for key in result.missing_keys), result.missing_keys
+    model.eval()
+    if fuse_bn:
+        fuse_conv_bn(model)
+    torch.save({'arch': 'IfullRobHWNet',
+                'kwargs': kwargs,
+                'fused_bn': fuse_bn,
+                'state_dict': model.state_dict()}, export_path)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Export a grasp checkpoint')
+    parser.add_argument('checkpoint', help='Pickled grasp checkpoint')
+    parser.add_argument('export', nargs='?', default=None,
+                        help='Output artifact, defaults to the checkpoint '
+                             'path with the {} suffix'.format(EXPORT_SUFFIX))
+    parser.add_argument('--keep_bn', action='store_true',
+                        help='Keep the BatchNorm layers, for a model that '
+                             'is quantized when loaded')
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    export_path = args.export
+    if export_path is None:
+        export_path = os.path.splitext(args.checkpoint)[0] + EXPORT_SUFFIX
+    export_model(args.checkpoint, export_path, fuse_bn=not args.keep_bn)
+    print('Exported {} to {}'.format(args.checkpoint, export_path))
+
+    st_time = time.time()
+    grasp_obj = GraspTorchObj(args.checkpoint)
+    print('Checkpoint startup: {:.3f}s'.format(time.time() - st_time))
+    grasp_obj = GraspTorchObj(export_path, warmup=True)
+    print('Exported startup: {:.3f}s load + {:.3f}s warm-up'.format(
+        grasp_obj.load_time, grasp_obj.warmup_time))
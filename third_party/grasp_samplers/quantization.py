@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+Int8 quantization of the grasp model for CPU inference.
+
+The ResNet trunk is statically quantized (conv/bn/relu fusion, observers
+calibrated on patches sampled from stored scene images) and the fully
+connected heads are dynamically quantized.
+"""
+import glob
+import os
+
+import cv2
+import numpy as np
+import torch
+from grasp_samplers import deeper_models
+from grasp_samplers.grasp_predictor import Predictors
+
+try:
+    from torch.ao import quantization
+except ImportError:
+    from torch import quantization
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+CALIBRATION_DIR = os.path.join(dir_path, 'demo_images')
+CALIBRATION_SAMPLES = 32
+HEAD_MODULES = ['fc_noise_0', 'fc_noise_1', 'fc_noise_2', 'fc_noise_3',
+                'fc_angle_0', 'fc_angle_1']
+
+
+def load_calibration_images(image_dir=CALIBRATION_DIR):
+    """
+    Loads the RGB scene images of a directory.
+
+    :param image_dir: Directory of .jpg/.png scene images
+    :type image_dir: string
+
+    :returns: List of RGB images
+    :rtype: list
+    """
+    paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) +
+                   glob.glob(os.path.join(image_dir, '*.png')))
+    assert len(paths) > 0, 'No calibration images in {}'.format(image_dir)
+    return [cv2.imread(path)[:, :, [2, 1, 0]] for path in paths]
+
+
+def calibration_inputs(grasp_obj, images, patch_size,
+                       num_samples=CALIBRATION_SAMPLES):
+    """
+    Yields preprocessed model inputs that match what the grasp model sees at
+    inference time: patches sampled like :class:`Predictors` does, and the
+    scene image itself.
+
+    :param grasp_obj: The (float) grasp object
+    :param images: Scene images
+    :param patch_size: Size of the sampled patches
+    :param num_samples: Number of patches per image
+    :type grasp_obj: GraspTorchObj
+    :type images: list
+    :type patch_size: int
+    :type num_samples: int
+
+    :returns: Generator of normalized image tensors
+    :rtype: generator
+    """
+    for img in images:
+        P = Predictors(img, grasp_obj)
+        _, _, patch_Is = P.sample_patches(patch_size, num_samples)
+        yield grasp_obj.convert_cv2_patches(patch_Is).clone()
+        yield grasp_obj.convert_cv2_patches(img[np.newaxis]).clone()
+
+
+def quantize_grasp_model(model, inputs, backend=None):
+    """
+    Converts a float grasp model into a :class:`QuantIfullRobHWNet`.
+
+    :param model: Float grasp model in eval mode, without folded BatchNorm
+    :param inputs: Normalized image tensors used to calibrate the trunk
+    :param backend: Quantized engine ('fbgemm' on x86, 'qnnpack' on ARM),
+                    defaults to the engine torch selected for this host
+    :type model: deeper_models.IfullRobHWNet
+    :type inputs: iterable
+    :type backend: string
+
+    :returns: The quantized grasp model
+    :rtype: deeper_models.QuantIfullRobHWNet
+    """
+    if backend is None:
+        backend = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    qmodel = deeper_models.QuantIfullRobHWNet(
+        h_size=model.fc_noise_0.out_features,
+        out_size=model.fc_angle_1.out_features,
+        noise_size=model.fc_noise_3.out_features)
+    state_dict = model.state_dict()
+    result = qmodel.trunk.load_state_dict(state_dict, strict=False)
+    assert all(key.endswith('num_batches_tracked')
+               for key in result.missing_keys), result.missing_keys
+    result = qmodel.load_state_dict(state_dict, strict=False)
+    assert all(key.startswith('trunk.')
+               for key in result.missing_keys), result.missing_keys
+    qmodel.eval()
+
+    qmodel.trunk.fuse_model()
+    qmodel.trunk.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(qmodel.trunk, inplace=True)
+    with torch.no_grad():
+        for x in inputs:
+            qmodel._features(x)
+    quantization.convert(qmodel.trunk, inplace=True)
+    quantization.quantize_dynamic(
+        qmodel,
+        dict((name, quantization.default_dynamic_qconfig)
+             for name in HEAD_MODULES),
+        dtype=torch.qint8, inplace=True)
+    return qmodel
@@ -0,0 +1,100 @@
+import sys
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_model import GraspModel
+from model_fixtures import random_model
+
+MODEL_URL = 'https://www.dropbox.com/s/fta8zebyzfrt3fw/checkpoint.pth.20?dl=0'
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Compare dense and sampled grasp prediction')
+    parser.add_argument('--model', default=None,
+                        help='Grasp checkpoint, a random model if not given')
+    parser.add_argument('--nsamples', type=int, default=78)
+    parser.add_argument('--patchsize', type=int, default=100)
+    parser.add_argument('--stride', type=int, default=None,
+                        help='Dense stride in pixels')
+    parser.add_argument('--imsize', type=int, default=224,
+                        help='Side of the resized demo images, 0 to keep')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser
+
+
+def load_demo_images(imsize):
+    current_dir = os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test")
+    data = []
+    for name in range(1, 5):
+        img = cv2.imread('{}/grasp_samplers/demo_images/{}.jpg'.format(current_dir, name))[:, :, [2, 1, 0]]
+        if imsize > 0:
+            img = cv2.resize(img, (imsize, imsize))
+        data.append(img)
+    return data
+
+
+def time_predict(grasp_model, img, repeats, **kwargs):
+    grasp_model.predict(img.copy(), **kwargs)
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        result = grasp_model.predict(img.copy(), **kwargs)
+        times.append(time.time() - start)
+    return result, np.median(times)
+
+
+def run_benchmark(args, model_path):
+    grasp_model = GraspModel(model_name=model_path,
+                             url=MODEL_URL,
+                             nsamples=args.nsamples,
+                             patchsize=args.patchsize)
+    rows = []
+    for i, img in enumerate(load_demo_images(args.imsize)):
+        np.random.seed(args.seed)
+        sampled, sampled_time = time_predict(grasp_model, img, args.repeats)
+        (dense, heatmap), dense_time = time_predict(grasp_model, img,
+                                                    args.repeats,
+                                                    mode='dense',
+                                                    stride=args.stride)
+        distance = np.hypot(float(sampled[0] - dense[0]),
+                            float(sampled[1] - dense[1]))
+        rows.append({'image': i + 1,
+                     'sampled_s': sampled_time,
+                     'dense_s': dense_time,
+                     'grid': heatmap.shape[:2],
+                     'center_px': distance,
+                     'same_angle': bool(np.isclose(sampled[2], dense[2])),
+                     'sampled_score': float(sampled[3]),
+                     'dense_score': float(dense[3])})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.model is None:
+        with random_model(args.seed) as (_, model_path):
+            rows = run_benchmark(args, model_path)
+    else:
+        rows = run_benchmark(args, os.path.abspath(args.model))
+
+    print('image  sampled(s)  dense(s)  grid      center(px)  angle  '
+          'sampled_score  dense_score')
+    for row in rows:
+        print('{image:5d}  {sampled_s:10.4f}  {dense_s:8.4f}  {grid!s:8}  '
+              '{center_px:10.1f}  {same_angle!s:5}  {sampled_score:13.4f}  '
+              '{dense_score:11.4f}'.format(**row))
+    near = [row['center_px'] <= args.patchsize / 2. for row in rows]
+    print('Mean latency: sampled {:.4f}s, dense {:.4f}s'.format(
+        np.mean([row['sampled_s'] for row in rows]),
+        np.mean([row['dense_s'] for row in rows])))
+    print('Top grasp agreement: {}/{} within half a patch, {}/{} same angle'
+          ''.format(sum(near), len(rows),
+                    sum(row['same_angle'] for row in rows), len(rows)))
@@ -0,0 +1,32 @@
+"""
+Randomly initialized grasp models shared by the tests.
+"""
+import sys
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.benchmark import build_random_model
+
+
+@contextmanager
+def random_model(seed=0, random_bn=False):
+    """
+    Saves a seeded, randomly initialized grasp model in a temporary
+    directory, removed on exit.
+
+    :param seed: Seed of the weights
+    :param random_bn: Also randomize the BatchNorm running statistics
+    :type seed: int
+    :type random_bn: bool
+
+    :returns: The temporary directory and the path of the checkpoint
+    :rtype: tuple
+    """
+    model_dir = tempfile.mkdtemp()
+    try:
+        yield model_dir, build_random_model(model_dir, seed, random_bn)
+    finally:
+        shutil.rmtree(model_dir)
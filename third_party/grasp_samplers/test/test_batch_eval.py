@@ -0,0 +1,82 @@
+import sys
+import os
+import json
+import tarfile
+import cv2
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.batch_eval import run_batch_eval
+from model_fixtures import random_model
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        '..', 'demo_images')
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_batch_eval_resumes():
+    with random_model() as (tmp_dir, model_path):
+        image_dir = os.path.join(tmp_dir, 'images')
+        os.makedirs(os.path.join(image_dir, 'scene'))
+        for name in ['1.jpg', '2.jpg', '3.jpg']:
+            img = cv2.imread(os.path.join(DEMO_DIR, name))
+            cv2.imwrite(os.path.join(image_dir, 'scene', name),
+                        cv2.resize(img, (224, 224)))
+        with open(os.path.join(image_dir, 'broken.jpg'), 'w') as f:
+            f.write('not an image')
+        model_kwargs = {'model_name': model_path, 'nsamples': 10,
+                        'patchsize': 80}
+
+        output = os.path.join(tmp_dir, 'grasps.jsonl')
+        render_dir = os.path.join(tmp_dir, 'rendered')
+        stats = run_batch_eval(image_dir, output, model_kwargs, workers=2,
+                               render_dir=render_dir, threads=1)
+        assert (stats['predicted'], stats['failed']) == (3, 1)
+        records = read_records(output)
+        assert sorted(record['key'] for record in records) == \
+            ['broken.jpg', 'scene/1.jpg', 'scene/2.jpg', 'scene/3.jpg']
+        assert len(os.listdir(render_dir)) == 3
+
+        # Simulate a run interrupted while writing a line
+        with open(output) as f:
+            lines = f.readlines()
+        good = [line for line in lines if 'error' not in line]
+        with open(output, 'w') as f:
+            f.writelines(good[:2] + [good[2][:10]])
+        stats = run_batch_eval(image_dir, output, model_kwargs, workers=1,
+                               threads=1)
+        assert (stats['predicted'], stats['failed'], stats['skipped']) == \
+            (1, 1, 2)
+        assert len(read_records(output)) == 4
+
+        # Archives give the same, scheduling independent, grasps
+        archive = os.path.join(tmp_dir, 'images.tar.gz')
+        with tarfile.open(archive, 'w:gz') as f:
+            f.add(os.path.join(image_dir, 'scene'), arcname='scene')
+        tar_output = os.path.join(tmp_dir, 'tar_grasps.jsonl')
+        stats = run_batch_eval(archive, tar_output, model_kwargs, workers=2,
+                               threads=1)
+        assert stats['predicted'] == 3
+        grasps = dict((record['key'], (record['h'], record['w'],
+                                       record['angle']))
+                      for record in read_records(output)
+                      if 'error' not in record)
+        for record in read_records(tar_output):
+            assert grasps[record['key']] == \
+                (record['h'], record['w'], record['angle'])
+
+        # Resuming with other settings is refused
+        try:
+            run_batch_eval(image_dir, output,
+                           dict(model_kwargs, nsamples=20), threads=1)
+            assert False, 'Changed settings were not detected'
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+    test_batch_eval_resumes()
+    print("Batch evaluation tests passed")
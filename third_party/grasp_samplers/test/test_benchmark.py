@@ -0,0 +1,61 @@
+import sys
+import os
+import csv
+import json
+import shutil
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.benchmark import compare_to_baseline, main
+
+TINY_CONFIG = ['--image_sizes', '160', '--nsamples', '6', '--patchsizes',
+               '80', '--batch_sizes', '3', '--threads', '1', '--repeats', '2']
+
+
+def test_benchmark_outputs():
+    out_dir = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(out_dir, 'bench.json')
+        csv_path = os.path.join(out_dir, 'bench.csv')
+        assert main(TINY_CONFIG + ['--json', json_path, '--csv', csv_path]) == 0
+        with open(json_path) as f:
+            results = json.load(f)
+        with open(csv_path) as f:
+            csv_rows = list(csv.DictReader(f))
+        # Same configuration against its own results
+        assert main(TINY_CONFIG + ['--baseline', json_path,
+                                   '--tolerance', '10']) == 0
+    finally:
+        shutil.rmtree(out_dir)
+    rows = results['results']
+    stages = [row['stage'] for row in rows]
+    assert stages == ['sample', 'preprocess', 'backbone', 'heads', 'smooth',
+                      'sensitivity', 'total']
+    assert [row['stage'] for row in csv_rows] == stages
+    assert results['meta']['repeats'] == 2
+    by_stage = dict((row['stage'], row) for row in rows)
+    assert by_stage['backbone']['p50_ms'] > 0
+    assert by_stage['total']['p50_ms'] >= by_stage['backbone']['p50_ms']
+    for row in rows:
+        assert row['min_ms'] <= row['p50_ms'] <= row['p90_ms'] <= row['p99_ms']
+
+
+def test_compare_to_baseline():
+    baseline = [{'image_size': 224, 'nsamples': 78, 'patchsize': 100,
+                 'batch_size': 20, 'threads': 1, 'n_sen': 0,
+                 'stage': stage, 'p50_ms': ms}
+                for stage, ms in [('backbone', 100.), ('heads', 1.)]]
+    current = [dict(row) for row in baseline]
+    current[0]['p50_ms'] = 150.
+    current[1]['p50_ms'] = 1.8
+    regressions = compare_to_baseline(current, baseline, tolerance=0.2)
+    # The heads slowdown is relative but below the noise floor
+    assert [(row['stage'], ref) for row, ref in regressions] == \
+        [('backbone', 100.)]
+    assert compare_to_baseline(current, baseline, tolerance=0.6) == []
+
+
+if __name__ == "__main__":
+    test_benchmark_outputs()
+    test_compare_to_baseline()
+    print("Benchmark tests passed")
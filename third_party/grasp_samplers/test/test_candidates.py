@@ -0,0 +1,115 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.grasp_predictor import Predictors, angle_distance, \
+    diverse_grasps
+from model_fixtures import random_model
+
+
+def test_diverse_grasps_suppresses_duplicates():
+    predictions = np.zeros((3, 18))
+    predictions[0, 9] = 1.
+    # Same place, neighbouring angle: a duplicate
+    predictions[0, 10] = 0.9
+    # Same place, perpendicular angle: kept
+    predictions[0, 0] = 0.8
+    # Next to the first patch: a duplicate
+    predictions[1, 9] = 0.7
+    predictions[2, 9] = 0.6
+    hs = np.array([100, 105, 200])
+    ws = np.array([100, 100, 200])
+    grasps = diverse_grasps(predictions, hs, ws, 3, min_distance=20,
+                            min_angle=np.pi / 6)
+    assert [(h, w, score) for h, w, _, score in grasps] == \
+        [(100, 100, 1.), (100, 100, 0.8), (200, 200, 0.6)]
+    assert np.isclose(grasps[0][2], 0.)
+    assert np.isclose(grasps[1][2], -np.pi / 2)
+    assert np.isclose(angle_distance(-np.pi / 2 + 0.1, np.pi / 2 - 0.1), 0.2)
+
+
+def test_patch_centers_fit_in_the_image():
+    img = np.zeros((240, 320, 3), dtype=np.uint8)
+    P = Predictors(img)
+    # Patches of 80 pixels centered 41 pixels after their corner
+    hs = np.array([41, 201, 40, 202, -10, 100])
+    ws = np.array([41, 281, 100, 100, 100, 282])
+    assert P.valid_centers(80, hs, ws).tolist() == \
+        [True, True, False, False, False, False]
+    assert P.patches_at(80, hs[:2], ws[:2]).shape == (2, 80, 80, 3)
+    for i in range(2, len(hs)):
+        try:
+            P.patches_at(80, hs[i:i + 1], ws[i:i + 1])
+            assert False, 'Gathered a patch outside of the image'
+        except AssertionError as e:
+            assert 'outside of the image' in str(e)
+
+
+def test_grasp_model_candidates():
+    with random_model() as (_, model_path):
+        grasp_model = GraspModel(model_name=model_path, nsamples=40,
+                                 patchsize=80, n_candidates=4, warmup=False)
+        img = np.random.RandomState(0).randint(
+            0, 255, (240, 320, 3)).astype(np.uint8)
+        original = img.copy()
+        selected = grasp_model.predict(img)
+        candidates = grasp_model.candidates
+        assert len(candidates) == 4
+        assert candidates[0] == selected
+        for i in range(4):
+            for j in range(i):
+                assert np.hypot(candidates[i][0] - candidates[j][0],
+                                candidates[i][1] - candidates[j][1]) >= 40 \
+                    or angle_distance(candidates[i][2],
+                                      candidates[j][2]) >= np.pi / 6
+
+        # The prediction is drawn lazily, on a copy of the image
+        assert np.array_equal(img, original)
+        assert not np.array_equal(grasp_model.predicted_image(), original)
+
+        # Re-scoring on the same image keeps every candidate and its score
+        rescored = grasp_model.rescore(img, candidates[::-1])
+        assert grasp_model.num_forwards == 4
+        assert sorted(rescored, key=lambda grasp: -grasp[3]) == rescored
+        for h, w, angle, score in candidates:
+            match = [grasp for grasp in rescored
+                     if grasp[0] == h and grasp[1] == w]
+            assert len(match) == 1
+            assert match[0][3] >= score - 1e-5
+        assert grasp_model.candidates == rescored
+
+        # Candidates at the same point keep distinct angles
+        h, w = candidates[0][:2]
+        grasps = [(h, w, 0., 0.5), (h, w, -np.pi / 2, 0.4),
+                  (candidates[1][0], candidates[1][1], 0., 0.3)]
+        rescored = grasp_model.rescore(img, grasps)
+        assert grasp_model.num_forwards == 2
+        assert len(rescored) == 3
+        assert set((grasp[0], grasp[1]) for grasp in rescored) <= \
+            set((grasp[0], grasp[1]) for grasp in grasps)
+        for i in range(3):
+            for j in range(i):
+                assert (rescored[i][0], rescored[i][1]) != \
+                    (rescored[j][0], rescored[j][1]) \
+                    or angle_distance(rescored[i][2],
+                                      rescored[j][2]) >= np.pi / 6
+
+        # Points whose patch leaves the image are dropped before the forward
+        # pass, and the image is predicted on again when none is left
+        outside = [(5, 5, 0., 0.9), (-50, 100, 0., 0.9), (230, 310, 0., 0.9)]
+        rescored = grasp_model.rescore(img, [candidates[0]] + outside)
+        assert grasp_model.num_forwards == 1
+        assert set((grasp[0], grasp[1]) for grasp in rescored) == \
+            set([candidates[0][:2]])
+        rescored = grasp_model.rescore(img, outside)
+        assert len(rescored) == 4
+        assert grasp_model.candidates == rescored
+
+
+if __name__ == "__main__":
+    test_diverse_grasps_suppresses_duplicates()
+    test_patch_centers_fit_in_the_image()
+    test_grasp_model_candidates()
+    print("Grasp candidate tests passed")
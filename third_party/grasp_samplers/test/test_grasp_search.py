@@ -0,0 +1,86 @@
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.benchmark import load_images
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.grasp_object import GraspTorchObj
+from grasp_samplers.grasp_predictor import Predictors
+from grasp_samplers.grasp_search import AdaptiveGraspSearch
+from model_fixtures import random_model
+
+PATCH_SIZE = 80
+BATCH = 20
+MAX_SAMPLES = 200
+SEEDS = [0, 1]
+STOP_REASONS = ['max_samples', 'converged', 'budget']
+
+
+def run_search(grasp_obj, img, seed, max_samples=MAX_SAMPLES,
+               budget_ms=None):
+    np.random.seed(seed)
+    search = AdaptiveGraspSearch(Predictors(img, grasp_obj), PATCH_SIZE,
+                                 BATCH, max_samples, budget_ms=budget_ms)
+    st_time = time.time()
+    predictions, hs, ws = search.run()
+    elapsed_ms = (time.time() - st_time) * 1e3
+    assert predictions.shape == (search.num_forwards, 18)
+    assert len(hs) == len(ws) == search.num_forwards
+    assert search.stop_reason in STOP_REASONS
+    return search, predictions, elapsed_ms
+
+
+def test_cem_beats_uniform_sampling():
+    with random_model() as (_, model_path):
+        grasp_obj = GraspTorchObj(model_path)
+        img = load_images(224)[0]
+        cem_best, uniform_best = [], []
+        for seed in SEEDS:
+            search, predictions, _ = run_search(grasp_obj, img, seed)
+            assert search.num_forwards <= MAX_SAMPLES
+            assert search.num_rounds == \
+                int(np.ceil(search.num_forwards / float(BATCH)))
+            # Converges before using up the samples
+            assert search.stop_reason == 'converged'
+            assert search.num_forwards < MAX_SAMPLES
+            cem_best.append(predictions.max())
+
+            np.random.seed(seed + len(SEEDS))
+            P = Predictors(img, grasp_obj)
+            P.graspNet_grasp(patch_size=PATCH_SIZE, num_samples=MAX_SAMPLES)
+            uniform_best.append(P.norm_vals.max())
+        # As good with fewer forward passes
+        assert np.mean(cem_best) >= np.mean(uniform_best)
+
+
+def test_cem_stays_within_budget():
+    with random_model() as (_, model_path):
+        grasp_obj = GraspTorchObj(model_path)
+        img = load_images(224)[0]
+        search, _, round_ms = run_search(grasp_obj, img, 0,
+                                         max_samples=BATCH)
+        assert search.num_rounds == 1
+        assert search.stop_reason == 'max_samples'
+
+        budget_ms = 2.5 * round_ms
+        search, _, elapsed_ms = run_search(grasp_obj, img, 0,
+                                           budget_ms=budget_ms)
+        assert search.stop_reason in ['budget', 'converged']
+        assert search.num_forwards < MAX_SAMPLES
+        # Rounds are only started if they are expected to fit
+        assert elapsed_ms <= budget_ms + round_ms
+
+        grasp_model = GraspModel(model_name=model_path, nsamples=3 * BATCH,
+                                 patchsize=PATCH_SIZE, batch_size=BATCH,
+                                 search='cem', warmup=False)
+        h, w, angle, score = grasp_model.predict(img)
+        assert grasp_model.num_forwards <= 3 * BATCH
+        assert -np.pi / 2 <= angle < np.pi / 2
+
+
+if __name__ == "__main__":
+    test_cem_beats_uniform_sampling()
+    test_cem_stays_within_budget()
+    print("Grasp search tests passed")
@@ -0,0 +1,162 @@
+import sys
+import os
+import threading
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_client import RemoteGraspObj
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.grasp_object import PREPROCESS_BUFFERS, GraspTorchObj
+from grasp_samplers.grasp_server import STOPPED_ERROR, GraspServer, \
+    MicroBatcher, _Request
+from model_fixtures import random_model
+
+NUM_CLIENTS = 4
+NUM_REQUESTS = 5
+BATCH = 8
+
+
+def serve_random_model(tmp_dir, model_path, max_wait):
+    grasp_obj = GraspTorchObj(model_path)
+    address = os.path.join(tmp_dir, 'grasp_server.sock')
+    return grasp_obj, GraspServer(grasp_obj, address, max_batch=4 * BATCH,
+                                  max_wait=max_wait)
+
+
+def test_concurrent_clients_are_batched():
+    with random_model() as (tmp_dir, model_path):
+        grasp_obj, server = serve_random_model(tmp_dir, model_path,
+                                               max_wait=0.05)
+        try:
+            rng = np.random.RandomState(0)
+            img = rng.randint(0, 255, (240, 320, 3)).astype(np.uint8)
+            # Clients use different patch sizes
+            patches = [rng.randint(0, 255, (BATCH, size, size, 3))
+                       .astype(np.uint8) for size in [60, 80, 60, 100]]
+            hs = [rng.randint(50, 150, BATCH) for _ in patches]
+            ws = [rng.randint(50, 250, BATCH) for _ in patches]
+            labels = [0] * BATCH
+            embedding = grasp_obj.encode_scene(img)
+            expected = [grasp_obj.test_one_batch(x, h, w, labels, labels,
+                                                 scene_embedding=embedding)
+                        for x, h, w in zip(patches, hs, ws)]
+
+            clients = [RemoteGraspObj(server.address)
+                       for _ in range(NUM_CLIENTS)]
+            remote_embedding = clients[0].encode_scene(img)
+            assert np.allclose(remote_embedding.numpy(), embedding.numpy(),
+                               atol=1e-5)
+            results = [[] for _ in clients]
+            barrier = threading.Event()
+
+            def run(i):
+                barrier.wait()
+                for _ in range(NUM_REQUESTS):
+                    results[i].append(clients[i].test_one_batch(
+                        patches[i], hs[i], ws[i], labels, labels,
+                        scene_embedding=remote_embedding))
+
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(NUM_CLIENTS)]
+            for thread in threads:
+                thread.start()
+            barrier.set()
+            for thread in threads:
+                thread.join()
+            for i in range(NUM_CLIENTS):
+                for vals in results[i]:
+                    assert np.allclose(vals, expected[i], atol=1e-4)
+
+            stats = clients[0].server_stats()
+            assert stats['connections'] == NUM_CLIENTS
+            assert stats['requests'] == NUM_CLIENTS * NUM_REQUESTS
+            assert stats['batches'] < stats['requests']
+            assert stats['requests_per_batch'] > 1
+            assert 0 < stats['batch_fill'] <= 1
+            assert stats['queue_depth'] == 0
+            for client in clients:
+                client.close()
+        finally:
+            server.stop()
+
+
+def test_preprocess_buffers_are_bounded():
+    with random_model() as (_, model_path):
+        grasp_obj = GraspTorchObj(model_path)
+        rng = np.random.RandomState(0)
+        # Merged batches of any size, for more patch sizes than are kept
+        for size in [60, 80, 100, 120, 140, 60]:
+            for n in [1, 7, 3, 4 * BATCH, 2]:
+                P = rng.randint(0, 255, (n, size, size, 3)).astype(np.uint8)
+                x = grasp_obj.preprocess_batch(P).clone()
+                assert x.shape[0] == n
+                assert len(grasp_obj._buffers) <= PREPROCESS_BUFFERS
+                for staging, out in grasp_obj._buffers.values():
+                    assert len(staging) == len(out) <= 4 * BATCH
+                # A buffer sized for a larger batch gives the same result
+                assert np.allclose(x[:1].numpy(),
+                                   grasp_obj.preprocess_batch(P[:1]).numpy())
+
+
+def test_stop_fails_pending_requests():
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_batch(batch):
+        started.set()
+        release.wait()
+        for request in batch:
+            request.finish(vals='done')
+
+    def request():
+        return _Request(np.zeros((1, 8, 8, 3)), [0], [0], [0], [0], None)
+
+    batcher = MicroBatcher(run_batch, max_batch=1, max_wait=0.)
+    requests = [request() for _ in range(3)]
+    batcher.submit(requests[0])
+    started.wait()
+    # Queued behind the running batch
+    batcher.submit(requests[1])
+    batcher.submit(requests[2])
+    stopper = threading.Thread(target=batcher.stop)
+    stopper.start()
+    while not batcher._stopped:
+        time.sleep(0.001)
+    release.set()
+    stopper.join()
+    assert requests[0].wait() == 'done'
+    for pending in requests[1:]:
+        assert pending.wait() is None
+        assert pending.error == STOPPED_ERROR
+    late = request()
+    batcher.submit(late)
+    late.wait()
+    assert late.error == STOPPED_ERROR
+
+
+def test_grasp_model_client():
+    with random_model() as (tmp_dir, model_path):
+        grasp_obj, server = serve_random_model(tmp_dir, model_path,
+                                               max_wait=0.)
+        try:
+            grasp_model = GraspModel(nsamples=20, patchsize=80,
+                                     server_address=server.address, n_sen=2,
+                                     n_sen_samples=4, sen_pixels=10)
+            img = np.random.randint(0, 255, (240, 320, 3)).astype(np.uint8)
+            h, w, angle, score = grasp_model.predict(img)
+            assert 40 <= h < 200 and 40 <= w < 280
+            assert -np.pi / 2 <= angle < np.pi / 2
+            _, heatmap = grasp_model.predict(img, mode='dense')
+            assert heatmap.shape[-1] == 18
+            grasp_model.grasp_obj.close()
+        finally:
+            server.stop()
+
+
+if __name__ == "__main__":
+    test_concurrent_clients_are_batched()
+    test_preprocess_buffers_are_bounded()
+    test_stop_fails_pending_requests()
+    test_grasp_model_client()
+    print("Grasp server tests passed")
@@ -0,0 +1,84 @@
+import sys
+import os
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_object import EXPORT_SUFFIX, ExecutionProfile, \
+    GraspTorchObj, has_bn
+from grasp_samplers.model_export import export_model
+from model_fixtures import random_model
+
+MAX_STARTUP_TIME = 10
+
+
+def mapped_regions(path):
+    """
+    :returns: Address ranges of this process mapping a file, empty where
+              /proc is not available
+    :rtype: list
+    """
+    regions = []
+    if not os.path.isfile('/proc/self/maps'):
+        return regions
+    with open('/proc/self/maps') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 6 and fields[5] == os.path.realpath(path):
+                start, end = [int(x, 16) for x in fields[0].split('-')]
+                regions.append((start, end))
+    return regions
+
+
+def predict(grasp_obj, patches, img):
+    n = len(patches)
+    h = np.arange(n) + 50
+    w = np.arange(n) + 60
+    return grasp_obj.test_one_batch(patches, h, w, [0] * n, [0] * n,
+                                    scene_embedding=grasp_obj.encode_scene(img))
+
+
+def test_exported_model_matches_checkpoint():
+    # Non-trivial BatchNorm statistics, so that folding them is checked
+    with random_model(random_bn=True) as (model_dir, checkpoint_path):
+        export_path = os.path.join(model_dir, 'random_model' + EXPORT_SUFFIX)
+        export_model(checkpoint_path, export_path)
+
+        st_time = time.time()
+        checkpoint_obj = GraspTorchObj(checkpoint_path)
+        checkpoint_time = time.time() - st_time
+        st_time = time.time()
+        exported_obj = GraspTorchObj(export_path, warmup=True)
+        exported_time = time.time() - st_time
+        print('Startup: checkpoint {:.3f}s, exported {:.3f}s '
+              '({:.3f}s load + {:.3f}s warm-up)'.format(
+                  checkpoint_time, exported_time, exported_obj.load_time,
+                  exported_obj.warmup_time))
+        assert exported_obj.load_time > 0.
+        assert exported_obj.warmup_time > 0.
+        assert exported_time < MAX_STARTUP_TIME
+
+        # The BatchNorm layers are folded at export time, so every weight is
+        # used where it is mapped (on torch versions that memory-map)
+        assert not has_bn(exported_obj.model)
+        regions = mapped_regions(export_path)
+        if regions:
+            for param in exported_obj.model.parameters():
+                assert any(start <= param.data_ptr() < end
+                           for start, end in regions)
+        try:
+            GraspTorchObj(export_path, profile=ExecutionProfile(quantize=True))
+            assert False, 'A folded artifact was quantized'
+        except ValueError:
+            pass
+
+        rng = np.random.RandomState(0)
+        img = rng.randint(0, 255, size=(120, 160, 3)).astype(np.uint8)
+        patches = rng.randint(0, 255, size=(4, 50, 50, 3)).astype(np.uint8)
+        assert np.allclose(predict(checkpoint_obj, patches, img),
+                           predict(exported_obj, patches, img), atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_exported_model_matches_checkpoint()
+    print("Exported model matches the checkpoint")
@@ -0,0 +1,39 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.benchmark import load_images
+from grasp_samplers.grasp_object import GraspTorchObj
+from model_fixtures import random_model
+
+# In normalized units, where one gray level is about 0.017
+MAX_ERROR = 0.03
+MEAN_ERROR = 0.005
+
+
+def test_batched_preprocess_matches_pil_transform():
+    with random_model() as (_, model_path):
+        grasp_obj = GraspTorchObj(model_path)
+        assert grasp_obj.batched_preprocess
+        # The original per-patch PIL path
+        pil_obj = GraspTorchObj(model_path,
+                                transform=grasp_obj.get_default_transform())
+        assert not pil_obj.batched_preprocess
+        img = load_images(480)[0]
+        rng = np.random.RandomState(0)
+        # Upsampled, unchanged and shrunk patches
+        for size in [40, 100, 224, 300, 400]:
+            corners = rng.randint(0, img.shape[0] - size, (8, 2))
+            P = np.stack([img[h:h + size, w:w + size] for h, w in corners])
+            x = grasp_obj.convert_cv2_patches(P).numpy()
+            expected = pil_obj.convert_cv2_patches(P).numpy()
+            assert x.shape == expected.shape == (8, 3, 224, 224)
+            error = np.abs(x - expected)
+            assert error.max() < MAX_ERROR, (size, error.max())
+            assert error.mean() < MEAN_ERROR, (size, error.mean())
+
+
+if __name__ == "__main__":
+    test_batched_preprocess_matches_pil_transform()
+    print("Preprocessing tests passed")
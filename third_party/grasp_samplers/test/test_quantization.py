@@ -0,0 +1,110 @@
+import sys
+import os
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_object import ExecutionProfile, GraspTorchObj
+from grasp_samplers.grasp_predictor import Predictors, smooth_angles
+from grasp_samplers.quantization import calibration_inputs, \
+    load_calibration_images
+from model_fixtures import random_model
+
+PATCH_SIZE = 100
+NUM_SAMPLES = 78
+IMAGE_SIZE = 224
+MIN_ANGLE_AGREEMENT = 0.5
+MAX_SCORE_DRIFT = 0.1
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Compare the int8 grasp model against the float model')
+    parser.add_argument('--model', default=None,
+                        help='Grasp checkpoint, a random model if not given')
+    parser.add_argument('--nsamples', type=int, default=NUM_SAMPLES)
+    parser.add_argument('--patchsize', type=int, default=PATCH_SIZE)
+    parser.add_argument('--imsize', type=int, default=IMAGE_SIZE,
+                        help='Side of the resized demo images, 0 to keep')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser
+
+
+def score_patches(grasp_obj, img, patch_hs, patch_ws, patch_Is):
+    n = len(patch_Is)
+    start = time.time()
+    vals = grasp_obj.test_one_batch(patch_Is, patch_hs, patch_ws,
+                                    [0] * n, [0] * n,
+                                    scene_embedding=grasp_obj.encode_scene(img))
+    return smooth_angles(vals), time.time() - start
+
+
+def compare_models(model_path, images, patch_size, num_samples, seed):
+    """
+    Scores the same patches with the float and the int8 model and returns
+    the top-1 angle agreement, the mean absolute score drift and the
+    latency of both models.
+    """
+    float_obj = GraspTorchObj(model_path,
+                              profile=ExecutionProfile(fuse_bn=False))
+    quant_obj = GraspTorchObj(model_path,
+                              profile=ExecutionProfile(quantize=True))
+    quant_obj.quantize(calibration_inputs(quant_obj, images, patch_size))
+
+    agreement = []
+    drift = []
+    float_time = 0.
+    quant_time = 0.
+    for img in images:
+        np.random.seed(seed)
+        patch_hs, patch_ws, patch_Is = Predictors(img).sample_patches(
+            patch_size, num_samples)
+        float_vals, t = score_patches(float_obj, img, patch_hs, patch_ws,
+                                      patch_Is)
+        float_time += t
+        quant_vals, t = score_patches(quant_obj, img, patch_hs, patch_ws,
+                                      patch_Is)
+        quant_time += t
+        agreement.append(np.mean(float_vals.argmax(1) ==
+                                 quant_vals.argmax(1)))
+        drift.append(np.mean(np.abs(float_vals - quant_vals)))
+    return np.mean(agreement), np.mean(drift), float_time, quant_time
+
+
+def resize_images(images, imsize):
+    import cv2
+    if imsize <= 0:
+        return images
+    return [cv2.resize(img, (imsize, imsize)) for img in images]
+
+
+def test_quantized_model_matches_float_model():
+    with random_model(random_bn=True) as (_, model_path):
+        images = resize_images(load_calibration_images(), IMAGE_SIZE)
+        agreement, drift, _, _ = compare_models(model_path, images,
+                                                PATCH_SIZE, 16, 0)
+        print('Top-1 angle agreement {:.3f}, score drift {:.4f}'.format(
+            agreement, drift))
+        assert agreement >= MIN_ANGLE_AGREEMENT
+        assert drift <= MAX_SCORE_DRIFT
+
+
+if __name__ == "__main__":
+    args = create_parser().parse_args()
+    images = resize_images(load_calibration_images(), args.imsize)
+    if args.model is None:
+        with random_model(args.seed, random_bn=True) as (_, model_path):
+            agreement, drift, float_time, quant_time = compare_models(
+                model_path, images, args.patchsize, args.nsamples,
+                args.seed)
+    else:
+        agreement, drift, float_time, quant_time = compare_models(
+            os.path.abspath(args.model), images, args.patchsize,
+            args.nsamples, args.seed)
+
+    print('Top-1 angle agreement: {:.3f}'.format(agreement))
+    print('Mean absolute score drift: {:.4f}'.format(drift))
+    print('Latency over {} images: float {:.3f}s, int8 {:.3f}s'.format(
+        len(images), float_time, quant_time))
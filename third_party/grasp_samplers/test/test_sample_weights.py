@@ -0,0 +1,47 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_predictor import Predictors
+
+
+def sample_centers(P, patch_size, num_samples):
+    half_patch_size = int(patch_size / 2) + 1
+    w_range = P.img_w - patch_size - 2
+    h_bs, w_bs = np.divmod(P.sample_corners(patch_size, num_samples),
+                           w_range)
+    return h_bs + half_patch_size, w_bs + half_patch_size
+
+
+def test_weighted_corners():
+    img = np.random.RandomState(0).randint(
+        0, 255, (240, 320, 3)).astype(np.uint8)
+    weights = np.zeros(img.shape[:2])
+    weights[100:130, 200:240] = 1.
+    weights[150:160, 60:70] = 3.
+    P = Predictors(img, sample_weights=weights)
+    np.random.seed(0)
+    hs, ws = sample_centers(P, 80, 2000)
+    assert np.all(weights[hs, ws] > 0)
+    # Both objects are sampled in proportion to their weight
+    small = weights[hs, ws] == 3.
+    assert 0.15 < small.mean() < 0.35
+
+    # Without weights, the corners are drawn as before
+    np.random.seed(1)
+    corners = Predictors(img).sample_corners(80, 100)
+    np.random.seed(1)
+    valid = P.valid_patch_corners(80)
+    assert np.array_equal(
+        corners, valid[np.random.randint(len(valid), size=100)])
+
+    # No valid patch has a weight: uniform sampling
+    P = Predictors(img, sample_weights=np.zeros(img.shape[:2]))
+    np.random.seed(1)
+    assert np.array_equal(P.sample_corners(80, 100), corners)
+
+
+if __name__ == "__main__":
+    test_weighted_corners()
+    print("Sample weight tests passed")
@@ -0,0 +1,59 @@
+import sys
+import os
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_object import GraspTorchObj
+from grasp_samplers.grasp_predictor import Predictors
+from model_fixtures import random_model
+
+PATCH_SIZE = 50
+NUM_SAMPLES = 8
+
+
+def random_scene(seed=0, size=(120, 160)):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 255, size=size + (3,)).astype(np.uint8)
+
+
+def test_cached_scene_matches_per_patch_scene():
+    with random_model() as (_, model_path):
+        grasp_obj = GraspTorchObj(model_path)
+        img = random_scene()
+        results = []
+        for cache_scene in [False, True]:
+            np.random.seed(1)
+            P = Predictors(img, grasp_obj, cache_scene=cache_scene)
+            with torch.no_grad():
+                P.graspNet_grasp(patch_size=PATCH_SIZE,
+                                 num_samples=NUM_SAMPLES)
+            results.append(P)
+        assert np.array_equal(results[0].patch_hs, results[1].patch_hs)
+        assert np.array_equal(results[0].patch_ws, results[1].patch_ws)
+        assert np.allclose(results[0].vals, results[1].vals, atol=1e-5)
+        assert np.allclose(results[0].norm_vals, results[1].norm_vals,
+                           atol=1e-5)
+
+        # The noise head is the only consumer of the scene embedding
+        P = results[1]
+        x = grasp_obj.convert_cv2_patches(P.patch_Is_resized)
+        h = grasp_obj.convert_hw(P.patch_hs)
+        w = grasp_obj.convert_hw(P.patch_ws)
+        robot_one_hot = grasp_obj.convert_robot_one_hot([0] * NUM_SAMPLES)
+        full_x = grasp_obj.convert_cv2_patches(
+            np.array([img for _ in range(NUM_SAMPLES)]))
+        with torch.no_grad():
+            _, noise_full = grasp_obj.model(
+                x=x, h=h, w=w, robot_one_hot_labels=robot_one_hot,
+                full_x=full_x)
+            _, noise_cached = grasp_obj.model(
+                x=x, h=h, w=w, robot_one_hot_labels=robot_one_hot,
+                full_pool_out=P.scene_embedding())
+        assert np.allclose(noise_full.numpy(), noise_cached.numpy(),
+                           atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_cached_scene_matches_per_patch_scene()
+    print("Cached scene embedding matches per-patch scene embedding")
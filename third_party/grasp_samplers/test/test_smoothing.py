@@ -0,0 +1,56 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.grasp_predictor import Predictors, angle_dependence, \
+    n_class, smooth_angles
+from model_fixtures import random_model
+
+
+def loop_smoothing(vals, in_place=True):
+    # Per-sample loop of graspNet_grasp before smooth_angles, reading the
+    # neighbours from the raw predictions if not `in_place`
+    wf = angle_dependence
+    norm_vals = vals.copy()
+    source = norm_vals if in_place else vals
+    for looper in range(len(vals)):
+        for norm_looper in range(n_class):
+            n_val = (wf[1] * source[looper, norm_looper] +
+                     wf[0] * source[looper, (norm_looper - 1) % n_class] +
+                     wf[2] * source[looper, (norm_looper + 1) % n_class])
+            norm_vals[looper, norm_looper] = n_val
+    return norm_vals
+
+
+def test_legacy_smoothing_matches_loop():
+    rng = np.random.RandomState(0)
+    for dtype in [np.float32, np.float64]:
+        vals = rng.rand(50, n_class).astype(dtype)
+        original = vals.copy()
+        # The default keeps the scores the thresholds were tuned on
+        assert np.array_equal(smooth_angles(vals), loop_smoothing(vals))
+        assert np.array_equal(smooth_angles(vals, legacy=True),
+                              loop_smoothing(vals))
+        assert np.allclose(smooth_angles(vals, legacy=False),
+                           loop_smoothing(vals, in_place=False))
+        # The two differ
+        assert not np.allclose(smooth_angles(vals, legacy=False),
+                               loop_smoothing(vals))
+        assert np.array_equal(vals, original)
+    assert smooth_angles(np.zeros((0, n_class))).shape == (0, n_class)
+
+
+def test_legacy_smoothing_is_the_default():
+    img = np.zeros((100, 100, 3), dtype=np.uint8)
+    assert Predictors(img).legacy_smoothing
+    with random_model() as (_, model_path):
+        assert GraspModel(model_name=model_path,
+                          warmup=False).legacy_smoothing
+
+
+if __name__ == "__main__":
+    test_legacy_smoothing_matches_loop()
+    test_legacy_smoothing_is_the_default()
+    print("Smoothing tests passed")
@@ -0,0 +1,106 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.grasp_model import GraspModel
+from grasp_samplers.grasp_predictor import RunningTopK
+from model_fixtures import random_model
+
+MAX_MEMORY_GROWTH = 1.2
+
+
+def test_running_top_k():
+    rng = np.random.RandomState(0)
+    vals = rng.rand(95, 18)
+    hs = np.arange(95)
+    top = RunningTopK(7, 20)
+    for st in range(0, 95, 20):
+        top.push(vals[st:st + 20], hs[st:st + 20], hs[st:st + 20] + 1)
+    top_vals, top_hs, top_ws = top.result()
+    expected = np.argsort(-vals.max(1))[:7]
+    assert np.array_equal(top_hs, expected)
+    assert np.array_equal(top_ws, expected + 1)
+    assert np.array_equal(top_vals, vals[expected])
+
+
+def test_streaming_matches_batches():
+    with random_model() as (_, model_path):
+        kwargs = {'model_name': model_path, 'nsamples': 50, 'patchsize': 80,
+                  'batch_size': 8, 'n_importance': 2, 'n_sen': 3,
+                  'n_sen_samples': 4, 'sen_pixels': 10, 'warmup': False}
+        grasp_model = GraspModel(**kwargs)
+        streaming_model = GraspModel(streaming=True, **kwargs)
+        img = np.random.RandomState(1).randint(
+            0, 255, (240, 320, 3)).astype(np.uint8)
+        for seed in range(3):
+            np.random.seed(seed)
+            expected = grasp_model.predict(img.copy())
+            np.random.seed(seed)
+            assert streaming_model.predict(img.copy()) == expected
+        assert streaming_model.num_forwards == 50
+
+        np.random.seed(0)
+        partial = list(streaming_model.predict_stream(img.copy()))
+        assert [n for _, n in partial] == [8, 16, 24, 32, 40, 48, 50]
+        scores = [grasp[3] for grasp, _ in partial]
+        assert scores == sorted(scores)
+
+        # Patches are sampled into one batch-sized buffer, whatever the
+        # number of samples
+        buffers = []
+        for nsamples in [40, 400]:
+            streaming_model.nsamples = nsamples
+            streaming_model.predict(img.copy())
+            buffers.append(streaming_model._patch_buffer)
+        assert buffers[0] is buffers[1]
+        assert len(buffers[0]) == kwargs['batch_size']
+
+        # Python 3 only, and blind to the allocations of torch
+        try:
+            import tracemalloc
+        except ImportError:
+            return
+        peaks = []
+        for nsamples in [40, 400]:
+            streaming_model.nsamples = nsamples
+            tracemalloc.start()
+            streaming_model.predict(img.copy())
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        assert peaks[1] < MAX_MEMORY_GROWTH * peaks[0]
+
+
+
+def test_streaming_keeps_diverse_candidates():
+    with random_model() as (_, model_path):
+        kwargs = {'model_name': model_path, 'nsamples': 200,
+                  'patchsize': 80, 'batch_size': 20, 'n_candidates': 4,
+                  'warmup': False}
+        grasp_model = GraspModel(**kwargs)
+        streaming_model = GraspModel(streaming=True, **kwargs)
+        img = np.random.RandomState(1).randint(
+            0, 255, (240, 320, 3)).astype(np.uint8)
+        # Seeds where a pool of n_candidates patches loses fallbacks to
+        # near-duplicates
+        for seed in [0, 1]:
+            np.random.seed(seed)
+            grasp_model.predict(img.copy())
+            np.random.seed(seed)
+            streaming_model.predict(img.copy())
+            assert len(streaming_model.candidates) == 4
+            assert streaming_model.candidates == grasp_model.candidates
+
+        streaming_model.nsamples = 0
+        try:
+            streaming_model.predict(img.copy())
+            assert False, 'Predicted without samples'
+        except AssertionError as e:
+            assert 'at least one sample' in str(e)
+
+
+if __name__ == "__main__":
+    test_running_top_k()
+    test_streaming_matches_batches()
+    test_streaming_keeps_diverse_candidates()
+    print("Streaming tests passed")
@@ -0,0 +1,90 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)).rstrip("grasp_samplers/test"))
+from grasp_samplers.tracing import Histogram, Tracer, summary_columns
+
+MAX_SPAN_OVERHEAD = 50e-6
+
+
+def test_spans_nest_per_thread():
+    tracer = Tracer('test')
+
+    def work():
+        with tracer.span('outer'):
+            with tracer.span('inner'):
+                pass
+            with tracer.span('inner'):
+                pass
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = tracer.summary()
+    assert sorted(summary) == ['outer', 'outer/inner']
+    assert summary['outer']['count'] == 4
+    assert summary['outer/inner']['count'] == 8
+    columns = summary_columns(summary)
+    assert columns['names'] == ['outer', 'outer/inner']
+    assert columns['counts'] == [4, 8]
+
+
+def test_histogram_percentiles():
+    rng = np.random.RandomState(0)
+    durations = rng.lognormal(np.log(1e-3), 1., size=10000)
+    histogram = Histogram()
+    for duration in durations:
+        histogram.add(duration)
+    for q in [50, 90, 99]:
+        exact = np.percentile(durations, q)
+        estimate = histogram.percentile(q)
+        assert exact * 0.99 <= estimate <= exact * 2 ** 0.25 * 1.01
+    assert np.isclose(histogram.mean(), durations.mean())
+    assert histogram.max == durations.max()
+
+
+def test_chrome_trace_dump():
+    tracer = Tracer('test', max_events=3)
+    for _ in range(5):
+        with tracer.span('step'):
+            time.sleep(1e-3)
+    trace_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(trace_dir, 'trace.json')
+        tracer.dump_chrome_trace(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+    finally:
+        shutil.rmtree(trace_dir)
+    spans = [event for event in events if event['ph'] == 'X']
+    assert len(spans) == 3
+    assert all(span['dur'] >= 1e3 for span in spans)
+    assert tracer.summary()['step']['count'] == 5
+
+
+def test_span_overhead():
+    tracer = Tracer('test')
+    n = 10000
+    st_time = time.time()
+    for _ in range(n):
+        with tracer.span('noop'):
+            pass
+    overhead = (time.time() - st_time) / n
+    print('Span overhead: {:.2f}us'.format(overhead * 1e6))
+    assert overhead < MAX_SPAN_OVERHEAD
+
+
+if __name__ == "__main__":
+    test_spans_nest_per_thread()
+    test_histogram_percentiles()
+    test_chrome_trace_dump()
+    test_span_overhead()
+    print("Tracing tests passed")
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+Lightweight stage timing shared by the pick-and-place nodes.
+
+Spans nest per thread, so a span opened inside another one is recorded as
+`outer/inner`. Every span name keeps a log-bucketed histogram of its
+durations, and the last spans are kept for a Chrome trace
+(chrome://tracing, https://ui.perfetto.dev) dump. A span costs a few
+microseconds, so tracing can stay enabled.
+
+Usage::
+
+    from grasp_samplers.tracing import span
+
+    with span('forward'):
+        model(x)
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = 32 * BUCKETS_PER_OCTAVE
+MAX_EVENTS = 20000
+PERCENTILES = [50, 90, 99]
+
+
+class Histogram(object):
+    """
+    This class counts durations in logarithmic buckets of 2^(1/4) us.
+    """
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration):
+        """
+        :param duration: Duration in seconds
+        :type duration: float
+        """
+        us = duration * 1e6
+        bucket = 0
+        if us > 1.:
+            bucket = min(int(math.log(us, 2) * BUCKETS_PER_OCTAVE),
+                         NUM_BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, q):
+        """
+        :param q: Percentile in [0, 100]
+        :type q: float
+
+        :returns: Upper bound of the bucket holding the percentile, in
+                  seconds, at most 19% above the exact value
+        :rtype: float
+        """
+        if self.count == 0:
+            return 0.
+        rank = q / 100. * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                upper = 2 ** ((bucket + 1.) / BUCKETS_PER_OCTAVE) * 1e-6
+                return min(upper, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+
+class Tracer(object):
+    """
+    This class records nested spans of one process.
+    """
+
+    def __init__(self, name=None, max_events=MAX_EVENTS):
+        """
+        The constructor for :class:`Tracer` class.
+
+        :param name: Name of the process in the trace, e.g. the node name
+        :param max_events: Number of last spans kept for the Chrome trace,
+                           0 to only keep histograms
+        :type name: string
+        :type max_events: int
+        """
+        self.name = name if name is not None else str(os.getpid())
+        self.enabled = True
+        self.histograms = {}
+        self.events = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name):
+        """
+        Times the enclosed block.
+
+        :param name: Name of the span
+        :type name: string
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        path = stack[-1] + '/' + name if stack else name
+        stack.append(path)
+        st_time = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - st_time
+            stack.pop()
+            self.record(path, st_time, duration)
+
+    def record(self, path, st_time, duration):
+        """
+        Records a span timed by the caller.
+
+        :param path: Full name of the span
+        :param st_time: Start time in seconds since the epoch
+        :param duration: Duration in seconds
+        :type path: string
+        :type st_time: float
+        :type duration: float
+        """
+        with self._lock:
+            histogram = self.histograms.get(path)
+            if histogram is None:
+                histogram = self.histograms[path] = Histogram()
+            histogram.add(duration)
+            if self.events.maxlen:
+                self.events.append((path, st_time, duration,
+                                    threading.current_thread().ident))
+
+    def summary(self):
+        """
+        :returns: Per span name: count, mean, percentiles and max in ms
+        :rtype: dict
+        """
+        with self._lock:
+            summary = {}
+            for path, histogram in self.histograms.items():
+                stats = {'count': histogram.count,
+                         'mean_ms': histogram.mean() * 1e3,
+                         'max_ms': histogram.max * 1e3}
+                for q in PERCENTILES:
+                    stats['p{}_ms'.format(q)] = histogram.percentile(q) * 1e3
+                summary[path] = stats
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.events.clear()
+
+    def chrome_trace(self):
+        """
+        :returns: The kept spans in the Chrome trace event format
+        :rtype: dict
+        """
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+        trace_events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                         'args': {'name': self.name}}]
+        for path, st_time, duration, tid in events:
+            trace_events.append({'name': path.rsplit('/', 1)[-1],
+                                 'cat': path, 'ph': 'X',
+                                 'ts': st_time * 1e6, 'dur': duration * 1e6,
+                                 'pid': pid, 'tid': tid})
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def dump_chrome_trace(self, path):
+        """
+        Writes the kept spans to a Chrome trace JSON file. Timestamps are
+        wall-clock times, so the files of several nodes can be merged.
+
+        :param path: Output file
+        :type path: string
+        """
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def summary_columns(summary):
+    """
+    Turns a :meth:`Tracer.summary` into parallel lists sorted by span name,
+    the layout of baseline_navi/StageStats.
+
+    :param summary: Tracer summary
+    :type summary: dict
+
+    :returns: names, counts, mean_ms, p50_ms, p90_ms, p99_ms and max_ms lists
+    :rtype: dict
+    """
+    names = sorted(summary)
+    columns = {'names': names}
+    for key in ['count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']:
+        column = 'counts' if key == 'count' else key
+        columns[column] = [summary[name][key] for name in names]
+    return columns
+
+
+class PeriodicReporter(object):
+    """
+    This class hands the tracer summary to a callback at a fixed period, from
+    a background thread.
+    """
+
+    def __init__(self, tracer, report_fn, period=10.):
+        """
+        The constructor for :class:`PeriodicReporter` class.
+
+        :param tracer: Tracer to summarize
+        :param report_fn: Called with the tracer summary, e.g. to publish it
+        :param period: Seconds between two reports
+        :type tracer: Tracer
+        :type report_fn: function
+        :type period: float
+        """
+        self.tracer = tracer
+        self.report_fn = report_fn
+        self.period = period
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.period):
+            self.report_fn(self.tracer.summary())
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """
+    :returns: The tracer of this process
+    :rtype: Tracer
+    """
+    return _tracer
+
+
+def span(name):
+    """
+    Times the enclosed block with the tracer of this process.
+
+    :param name: Name of the span
+    :type name: string
+    """
+    return _tracer.span(name)